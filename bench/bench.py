@@ -0,0 +1,288 @@
+"""
+Benchmark harness for the World Population API.
+
+Runs the ingest path (decode_data/fetch_latest_data), the read routes and the worker
+rendering (plot_data) against fakeredis (default) or a local Redis, using a synthetic
+dataset shaped like the WPP Demographic Indicators file. Results are written as json
+and compared against a stored baseline; any case whose median is slower than the baseline
+by more than the tolerance makes the run fail. With the cases run in interleaved rounds,
+the medians of 15 rounds vary by at most ~12% between runs on one machine, well inside
+the default tolerance of 25%. Record the baseline again on the machine that compares
+against it, and whenever a change alters what a case does.
+
+Usage (from the repository root):
+    python bench/bench.py                                  # compare against bench/baseline.json
+    python bench/bench.py --save-baseline                  # record a new baseline
+    python bench/bench.py --scale medium --redis-url redis://localhost:6379
+"""
+import argparse
+import csv
+import fnmatch
+import gzip
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+sys.path.insert(0, SRC_DIR)
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+# (number of locations, first year, last year)
+SCALES = {
+    "small": (20, 1950, 1979),
+    "medium": (100, 1950, 2100),
+    "large": (300, 1950, 2100),
+}
+
+COLUMNS = ['SortOrder', 'LocID', 'Notes', 'ISO3_code', 'ISO2_code', 'SDMX_code', 'LocTypeID', 'LocTypeName',
+           'ParentID', 'Location', 'VarID', 'Variant', 'Time', 'TPopulation1Jan', 'TPopulation1July',
+           'TPopulationMale1July', 'TPopulationFemale1July', 'PopDensity', 'PopSexRatio', 'MedianAgePop',
+           'NatChange', 'NatChangeRT', 'PopChange', 'PopGrowthRate', 'DoublingTime', 'Births', 'Births1519',
+           'CBR', 'TFR', 'NRR', 'MAC', 'SRB', 'Deaths', 'DeathsMale', 'DeathsFemale', 'CDR', 'LEx', 'LExMale',
+           'LExFemale', 'LE15', 'LE15Male', 'LE15Female', 'LE65', 'LE65Male', 'LE65Female', 'LE80', 'LE80Male',
+           'LE80Female', 'InfantDeaths', 'IMR', 'LBsurvivingAge1', 'Under5Deaths', 'Q5', 'Q0040', 'Q0040Male',
+           'Q0040Female', 'Q0060', 'Q0060Male', 'Q0060Female', 'Q1550', 'Q1550Male', 'Q1550Female', 'Q1560',
+           'Q1560Male', 'Q1560Female', 'NetMigrations', 'CNMR']
+TEXT_COLUMNS = {'Notes', 'ISO3_code', 'ISO2_code', 'LocTypeName', 'Location', 'Variant'}
+
+def location_names(num_locations):
+    """Location names as they appear in the source file (spaces are rewritten at ingest)."""
+    return ["World"] + [f"Synthetic Region {i:03d}" for i in range(1, num_locations)]
+
+def write_dataset(path, num_locations, start_year, end_year, seed=332):
+    """Write a gzipped csv with one row per location and year, shaped like the WPP file."""
+    rng = random.Random(seed)
+    with gzip.open(path, "wt", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for index, location in enumerate(location_names(num_locations)):
+            for year in range(start_year, end_year + 1):
+                row = []
+                for column in COLUMNS:
+                    if column == "Location":
+                        row.append(location)
+                    elif column == "Time":
+                        row.append(year)
+                    elif column in ("LocID", "SortOrder", "SDMX_code", "ParentID"):
+                        row.append(index + 1)
+                    elif column in ("ISO3_code", "ISO2_code"):
+                        row.append(f"S{index:02d}"[: 3 if column == "ISO3_code" else 2])
+                    elif column == "Variant":
+                        row.append("Medium")
+                    elif column == "LocTypeName":
+                        row.append("Country/Area")
+                    elif column == "Notes":
+                        row.append("")
+                    else:
+                        row.append(round(rng.uniform(0.5, 5000.0), 3))
+                writer.writerow(row)
+
+def make_redis_factory(redis_url):
+    """Return a function creating a client for a given database number."""
+    if redis_url:
+        import redis
+        return lambda db: redis.Redis.from_url(redis_url, db=db)
+    import fakeredis
+    server = fakeredis.FakeServer()
+    return lambda db: fakeredis.FakeRedis(server=server, db=db)
+
+def use_redis(factory):
+    """Point the shared clients of every module at the benchmark databases."""
+    import metrics
+    import storage
+    from hotqueue import HotQueue
+    clients = {}
+    for name in ("data", "jobs", "results", "queue"):
+        clients[name] = metrics.instrument_redis(factory(storage.DATABASES[name]), name)
+        storage.set_client(name, clients[name])
+    # workers check the queue database for cancellations between frames
+    storage.set_client("queue", HotQueue(storage.QUEUE_NAME, connection_pool=clients["queue"].connection_pool))
+    return clients["data"], clients["jobs"], clients["results"]
+
+def measure(cases, repeat):
+    """
+    Run every (name, function, setup) case once to warm up, then `repeat` rounds of every case
+    in turn, and return the timings of each case in milliseconds. Interleaving the cases spreads
+    a slow phase of the machine over all of them instead of the few it would otherwise hit.
+    """
+    timings = {name: [] for name, _, _ in cases}
+    for warm in [True] + [False] * repeat:
+        for name, fn, setup in cases:
+            if setup:
+                setup()
+            start = time.perf_counter()
+            fn()
+            if not warm:
+                timings[name].append((time.perf_counter() - start) * 1000)
+    return {name: {
+        "repeat": repeat,
+        "min_ms": round(min(values), 3),
+        "median_ms": round(statistics.median(values), 3),
+        "mean_ms": round(statistics.fmean(values), 3),
+    } for name, values in timings.items()}
+
+def build_cases(api, worker, rd, num_locations, start_year, end_year):
+    """Return the list of (name, function, setup) benchmark cases."""
+    import dataset
+    client = api.app.test_client()
+    locations = [name.replace(" ", "_") for name in location_names(num_locations)]
+    all_years = end_year - start_year + 1
+
+    def get(url):
+        def run():
+            response = client.get(url)
+            assert response.status_code < 500, f"{url} returned {response.status_code}"
+        return run
+
+    def reset_data():
+        rd.flushdb()
+
+    def ensure_loaded():
+        # each case loads the dataset it reads, whichever cases --only selected before it
+        if not dataset.get_version():
+            api.fetch_latest_data()
+
+    cases = [
+        ("ingest/decode_data", api.decode_data, None),
+        ("ingest/fetch_latest_data", api.fetch_latest_data, reset_data),
+        ("ingest/fetch_latest_data/unchanged", api.fetch_latest_data, ensure_loaded),
+    ]
+    cases += [
+        ("routes/years", get("/years"), ensure_loaded),
+        ("routes/regions", get("/regions"), ensure_loaded),
+        ("routes/data", get("/data"), ensure_loaded),
+        ("routes/regions/<region>", get(f"/regions/{locations[-1]}"), ensure_loaded),
+    ]
+    for span in sorted({1, min(10, all_years), all_years}):
+        years = f"{start_year}-{start_year + span - 1}"
+        cases.append((f"routes/years/<years>/regions/span={span}", get(f"/years/{years}/regions"), ensure_loaded))
+        for count in sorted({1, min(10, num_locations), num_locations}):
+            names = ",".join(locations[:count])
+            cases.append((f"routes/years/<years>/regions/span={span}/regions={count}",
+                          get(f"/years/{years}/regions?names={names}"), ensure_loaded))
+        cases.append((f"routes/regions/<region>/<eras>/span={span}",
+                      get(f"/regions/{locations[-1]}/{years}"), ensure_loaded))
+
+    plot_years = min(5, all_years)
+    plot_end = start_year + plot_years - 1
+    plot_locations = locations[:min(5, num_locations)]
+    plot_job = {"start": start_year, "end": plot_end, "location": ",".join(plot_locations)}
+    plot_input = {}
+
+    def load_plot_data():
+        if not plot_input:
+            ensure_loaded()
+            plot_input["data"] = worker.manipulate_data(plot_job)
+
+    for plot_type, animate in (("line", False), ("bar", False), ("bar", True), ("scatter", False), ("scatter", True)):
+        # plot_data drops query2 when query1 is the default population column
+        queries = ("LEx", "TFR") if plot_type == "scatter" else ("TPopulation1Jan", None)
+
+        def render(plot_type=plot_type, animate=animate, queries=queries):
+            worker.plot_data(plot_input["data"], f"bench-{plot_type}", start_year, plot_end, plot_type,
+                             list(plot_locations), *queries, animate)
+        cases.append((f"worker/plot_data/{plot_type}/animate={animate}", render, load_plot_data))
+    return cases
+
+def compare(results, baseline, tolerance, floor_ms):
+    """Return the cases whose median regressed beyond the tolerance against the baseline."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        allowed = max(base["median_ms"] * (1 + tolerance), base["median_ms"] + floor_ms)
+        if result["median_ms"] > allowed:
+            regressions.append({"case": name, "baseline_ms": base["median_ms"],
+                                "median_ms": result["median_ms"],
+                                "ratio": round(result["median_ms"] / base["median_ms"], 2)})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the World Population API.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small")
+    parser.add_argument("--locations", type=int, help="override the number of locations of the scale")
+    parser.add_argument("--years", help="override the year range of the scale, e.g. 1950-2000")
+    parser.add_argument("--repeat", type=int, default=15)
+    parser.add_argument("--only", help="glob pattern of case names to run, e.g. 'routes/*'")
+    parser.add_argument("--redis-url", help="use a local Redis instead of fakeredis (databases 0, 2 and 3 are flushed)")
+    parser.add_argument("--output", help="write json results to this file instead of stdout")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--floor-ms", type=float, default=2.0, help="allowed absolute slowdown for tiny cases")
+    args = parser.parse_args(argv)
+
+    num_locations, start_year, end_year = SCALES[args.scale]
+    if args.locations:
+        num_locations = args.locations
+    if args.years:
+        start_year, end_year = (int(y) for y in args.years.split("-"))
+
+    workdir = tempfile.mkdtemp(prefix="wpp-bench-")
+    os.chdir(workdir)  # ingest and rendering write their temporary files to the working directory
+    os.makedirs("cache")
+    write_dataset(os.path.join("cache", "bench.csv.gz"), num_locations, start_year, end_year)
+
+    import api
+    import worker
+    logging.getLogger().setLevel(logging.WARNING)
+    api.data_sources = [os.path.join("cache", "bench.csv.gz")]
+    rd, jdb, resdb = use_redis(make_redis_factory(args.redis_url))
+    for client in (rd, jdb, resdb):
+        client.flushdb()
+
+    cases = [case for case in build_cases(api, worker, rd, num_locations, start_year, end_year)
+             if not args.only or fnmatch.fnmatch(case[0], args.only)]
+    results = measure(cases, args.repeat)
+    for name, result in results.items():
+        print(f"{name:<60} {result['median_ms']:>10.3f} ms", file=sys.stderr)
+
+    report = {
+        "scale": {"locations": num_locations, "start": start_year, "end": end_year,
+                  "redis": "redis" if args.redis_url else "fakeredis"},
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baseline to {args.baseline}", file=sys.stderr)
+    else:
+        regressions = []
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if baseline["scale"] == report["scale"]:
+                regressions = compare(results, baseline["results"], args.tolerance, args.floor_ms)
+            else:
+                print("Baseline was recorded at a different scale, skipping comparison.", file=sys.stderr)
+        report["regressions"] = regressions
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if report.get("regressions"):
+        for regression in report["regressions"]:
+            print(f"REGRESSION {regression['case']}: {regression['median_ms']} ms vs "
+                  f"{regression['baseline_ms']} ms baseline", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Cold start report for the processes of the World Population API.
+
+Imports each entry point module (worker, api, asgi) in a fresh interpreter, the way a new
+pod starts, and reports the median wall time of the import over the interpreter's own start
+up, plus the packages that took longest to import according to `python -X importtime`.
+Any module over its budget, or importing a package it should only load on demand, makes
+the run fail.
+
+Usage (from the repository root):
+    python bench/startup.py                     # report and check against the budgets
+    python bench/startup.py --output startup.json
+    python bench/startup.py --repeat 10 --top 15
+    python bench/startup.py --budget worker=300
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+
+# module -> milliseconds its import may take on top of a bare interpreter
+BUDGETS = {"worker": 300, "api": 500, "asgi": 550}
+# packages each module must only import on the code paths that need them
+DEFERRED = {
+    "worker": ("flask", "pandas", "matplotlib", "sklearn", "pyarrow", "requests"),
+    "api": ("pandas", "matplotlib", "sklearn", "pyarrow", "requests"),
+    "asgi": ("pandas", "matplotlib", "sklearn", "pyarrow", "requests"),
+}
+
+
+def run_python(code, *flags):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, MPLBACKEND="Agg", LOG_LEVEL="WARNING")
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, *flags, "-c", code], cwd=SRC_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result
+
+
+def import_ms(module, repeat):
+    """Median wall time in milliseconds of importing `module` in a fresh interpreter, minus a bare start."""
+    bare = statistics.median(run_python("pass")[0] for _ in range(repeat))
+    loaded = statistics.median(run_python(f"import {module}")[0] for _ in range(repeat))
+    return round(max(loaded - bare, 0) * 1000, 1)
+
+
+def heaviest_packages(module, top):
+    """Top level packages by total import time (their own time plus their submodules), from -X importtime."""
+    _, result = run_python(f"import {module}", "-X", "importtime")
+    totals = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + int(self_us)
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+    return [{"package": package, "ms": round(us / 1000, 1)} for package, us in ranked]
+
+
+def loaded_packages(module, packages):
+    """The packages of `packages` that importing `module` loads."""
+    code = f"import sys, {module}; print(' '.join(p for p in {list(packages)!r} if p in sys.modules))"
+    return run_python(code)[1].stdout.split()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the import time of the API and worker entry points.")
+    parser.add_argument("--modules", default=",".join(BUDGETS), help="comma separated modules to import")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="number of heaviest packages to list")
+    parser.add_argument("--budget", action="append", default=[], help="override a budget, e.g. worker=300")
+    parser.add_argument("--output", help="write the json report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    budgets = dict(BUDGETS)
+    for override in args.budget:
+        module, ms = override.split("=")
+        budgets[module] = float(ms)
+
+    report = {"python": sys.version.split()[0], "modules": {}}
+    failures = []
+    for module in args.modules.split(","):
+        ms = import_ms(module, args.repeat)
+        eager = loaded_packages(module, DEFERRED.get(module, ()))
+        report["modules"][module] = {"import_ms": ms, "budget_ms": budgets.get(module),
+                                     "heaviest": heaviest_packages(module, args.top), "eager": eager}
+        print(f"{module:<10} {ms:>8.1f} ms (budget {budgets.get(module)} ms)", file=sys.stderr)
+        if module in budgets and ms > budgets[module]:
+            failures.append(f"{module} imports in {ms} ms, over its budget of {budgets[module]} ms")
+        if eager:
+            failures.append(f"{module} imports {', '.join(eager)} at start up")
+
+    report["failures"] = failures
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Admission control for job submissions.
+
+Before jobs are queued, `check_spec` validates them against the catalog of the current
+dataset version (its years, locations and indicators) and `admit` charges the submitting
+client's token buckets and refuses work while the queue's backlog is too expensive:
+    ADMISSION_RATE=1, ADMISSION_BURST=20                submissions per second per client, and at once
+    ADMISSION_COST_RATE=100, ADMISSION_COST_BURST=20000 estimated cost (frames x locations) per
+                                                        second per client, and at once
+    ADMISSION_BATCH_COST_RATE=10,                       estimated cost per second per client, and at once,
+    ADMISSION_BATCH_COST_BURST=500000                   of POST /jobs/batch, sized for a nightly batch of
+                                                        ~2000 jobs of about 250 each
+    ADMISSION_MAX_BACKLOG=50000                         backlog cost above which submissions are refused;
+                                                        single submissions only count jobs queued outside batches
+    ADMISSION_RETRY_AFTER=30                            seconds a client refused for the backlog should wait
+Every job of a batch must cost at most ADMISSION_COST_BURST, and a batch takes one
+submission and its total cost from the batch budget, which single submissions leave alone.
+A rate or threshold of 0 turns its check off. The buckets of a client are a hash,
+Admission:<client>, in the queue database, updated in a WATCH transaction so every API
+process draws from the same buckets. Clients are told apart by address (the hop the
+ingress added to X-Forwarded-For, see TRUSTED_PROXIES in api.py).
+"""
+import math
+import os
+import time
+
+import dataset
+import locations
+import metrics
+from jobs import _queue_redis, queue_stats
+from log_config import get_logger
+from query import KEY_FIELDS
+
+logger = get_logger(__name__)
+
+KEY_PREFIX = "Admission:"
+RATE = float(os.environ.get("ADMISSION_RATE", 1))
+BURST = float(os.environ.get("ADMISSION_BURST", 20))
+COST_RATE = float(os.environ.get("ADMISSION_COST_RATE", 100))
+COST_BURST = float(os.environ.get("ADMISSION_COST_BURST", 20000))
+BATCH_COST_RATE = float(os.environ.get("ADMISSION_BATCH_COST_RATE", 10))
+BATCH_COST_BURST = float(os.environ.get("ADMISSION_BATCH_COST_BURST", 500000))
+MAX_BACKLOG = int(os.environ.get("ADMISSION_MAX_BACKLOG", 50000))
+RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 30))
+
+_catalogs = {} # dataset version -> its catalog, see `catalog`
+
+refused = metrics.counter("wpp_admission_refused_total", "Job submissions refused by admission control.", ("reason",))
+
+def catalog(version=None) -> dict:
+    """The years, locations and indicators of a dataset version (the current one by default)."""
+    version = dataset.get_version() if version is None else int(version)
+    if version not in _catalogs:
+        years = [int(year) for year in dataset.list_years(version)]
+        fields = set()
+        for rows in dataset.read_years([str(years[0])], version) if years else []:
+            for row in rows or []:
+                fields.update(row)
+        _catalogs.clear() # only the current version is ever checked against
+        _catalogs[version] = {"years": (min(years), max(years)) if years else None,
+                              "locations": set(dataset.list_locations(version)),
+                              "indicators": fields - set(KEY_FIELDS)}
+    return _catalogs[version]
+
+def check_spec(data_dict):
+    """
+    Return an error message if a valid job spec asks for data the dataset lacks, otherwise
+    None. Locations given by another identifier than their name are rewritten to it, and a
+    variant to the partition it selects (dropped if it selects the default one).
+    """
+    known = catalog()
+    if known["years"] is None:
+        return "No data loaded, load the dataset with POST /data first."
+    try:
+        partition = dataset.partition(data_dict.get("variant"))
+    except ValueError as e:
+        return str(e)
+    start, end = int(data_dict["start"]), int(data_dict["end"])
+    first, last = known["years"] if partition is None else map(int, dataset.get_partitions()[partition]["years"])
+    if start > end:
+        return "Start must not be after end."
+    if start < first or end > last:
+        return f"Years must be from {first} to {last}."
+    given = [loc for loc in (data_dict.get("location") or "").split(",") if loc] or ["World"]
+    names = locations.resolve(given)
+    unknown = [loc for loc in names if loc not in known["locations"]]
+    if unknown:
+        return f"Unknown locations: {', '.join(unknown)}. See /regions/search?q=."
+    if data_dict.get("location"):
+        data_dict["location"] = ",".join(names) # jobs are queued with the dataset's names, not the given identifiers
+    if partition is None:
+        data_dict.pop("variant", None)
+    else:
+        data_dict["variant"] = partition
+    indicators = [data_dict.get("query1"), data_dict.get("query2")]
+    if data_dict.get("plot_type") == "export":
+        indicators = (data_dict.get("fields") or "").split(",")
+    unknown = [name for name in indicators if name and name not in known["indicators"] and name not in KEY_FIELDS]
+    if unknown:
+        return f"Unknown indicators: {', '.join(unknown)}."
+    return None
+
+def _budget(batch):
+    """The field, rate and capacity of the cost bucket of single submissions or of batches."""
+    return ("batch_budget", BATCH_COST_RATE, BATCH_COST_BURST) if batch else ("budget", COST_RATE, COST_BURST)
+
+def check_cost(cost, batch=False):
+    """Return an error message if `cost` is more than a client may ever submit at once, otherwise None."""
+    _, rate, capacity = _budget(batch)
+    if rate and cost > capacity:
+        kind = "batch" if batch else "submission"
+        return f"Estimated cost {cost} exceeds the limit of {capacity:g} per {kind}; split it into smaller jobs."
+    return None
+
+def _refill(level, capacity, rate, elapsed):
+    return capacity if level is None else min(capacity, float(level) + elapsed * rate)
+
+def _wait(level, amount, rate):
+    """Seconds until a bucket at `level` holds `amount`, 0 if it already does."""
+    return (amount - level) / rate if rate and amount > level else 0
+
+def _take(client, cost, batch=False):
+    """Take one submission and `cost` from the buckets of a client; return the seconds to wait if they lack them."""
+    key = f"{KEY_PREFIX}{client}"
+    field, rate, capacity = _budget(batch)
+    other, other_rate, other_capacity = _budget(not batch) # refilled up to now too, as "updated" moves on
+
+    def transaction(pipe):
+        tokens, budget, spared, updated = pipe.hmget(key, "tokens", field, other, "updated")
+        now = time.time()
+        elapsed = max(now - float(updated), 0) if updated is not None else 0
+        tokens = _refill(tokens, BURST, RATE, elapsed)
+        budget = _refill(budget, capacity, rate, elapsed)
+        wait = max(_wait(tokens, 1, RATE), _wait(budget, cost, rate))
+        pipe.multi()
+        if not wait:
+            pipe.hset(key, mapping={"tokens": tokens - (1 if RATE else 0), field: budget - (cost if rate else 0),
+                                    other: _refill(spared, other_capacity, other_rate, elapsed), "updated": now})
+            # a bucket left alone this long is full again, which is what a missing hash means
+            pipe.expire(key, max(math.ceil(max(BURST / (RATE or 1), COST_BURST / (COST_RATE or 1),
+                                               BATCH_COST_BURST / (BATCH_COST_RATE or 1))), 1))
+        return wait
+
+    return _queue_redis().transaction(transaction, key, value_from_callable=True)
+
+def backlog(batch=False) -> int:
+    """
+    The backlog cost submissions are checked against: all of it for batches, only that of jobs
+    queued outside batches otherwise, so an admitted batch does not lock out single submissions.
+    """
+    stats = queue_stats()
+    return stats["backlog_cost"] if batch else stats["backlog_cost"] - stats["batch_backlog_cost"]
+
+def admit(client, cost, batch=False) -> tuple:
+    """
+    Decide whether `client` may queue jobs of total estimated `cost` now, as a batch or not.
+    Return None if it may, otherwise the reason and the seconds it should wait before retrying.
+    """
+    if MAX_BACKLOG and backlog(batch) > MAX_BACKLOG:
+        logger.warning("Refused jobs of %s: the queue backlog is over %s.", client, MAX_BACKLOG)
+        refused.inc(reason="backlog")
+        return "The queue is too busy, try again later.", RETRY_AFTER
+    if not RATE and not _budget(batch)[1]:
+        return None
+    wait = _take(client, cost, batch) # retried by redis-py if another process changed the buckets meanwhile
+    if wait:
+        logger.info("Refused jobs of %s: rate limited for %.1f seconds.", client, wait)
+        refused.inc(reason="rate")
+        return "Too many submissions, slow down.", wait
+    return None
@@ -1,62 +1,180 @@
 import gzip
+import json
+import math
 import shutil 
 import logging
 from typing import List, Union 
-from flask import Flask, request, jsonify, send_file, Response
-from flask import Flask, request, jsonify, send_file, Response
-from datetime import datetime
-import redis 
+from flask import Flask, request, jsonify, send_file, Response, g, has_request_context
+import time
 import zipfile
 from io import BytesIO
-import json 
-import requests
 import re 
 import os
-import pandas as pd 
 from collections import defaultdict 
-from jobs import add_job, get_job_by_id, get_all_jobs, get_results, string_to_bool 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+from werkzeug.middleware.proxy_fix import ProxyFix
+import admission
+import metrics
+from log_config import Lazy, get_logger, log_sampled
+from storage import LazyClient
+import charts
+import compress
+import dataset
+import export
+import locations
+import query
+import retention
+from jobs import (add_job, add_jobs, cancel_job, delete_job, get_job_by_id, get_all_jobs, get_results, get_group_status,
+                  job_cost, list_jobs, queue_stats, string_to_bool, validate_job_spec)
 
-_redis_host = os.environ.get("REDIS_HOST") # AI used to understand environment function 
-_redis_port = 6379
 data_link = "https://population.un.org/wpp/assets/Excel%20Files/1_Indicator%20(Standard)/CSV_FILES/WPP2024_Demographic_Indicators_Medium.csv.gz" 
-local_data="cache/WPP2024_Demographic_Indicators_Medium.csv.gz" 
+# source files loaded by POST /data (urls or paths, space separated), each Variant of a file is a partition
+data_sources = os.environ.get("DATA_SOURCES", data_link).split()
+default_variant = os.environ.get("DATA_DEFAULT_VARIANT", "Medium") # of the first source, read without variant=
+cache_dir = "cache" # downloaded sources found here are used instead of downloading them again
+_ingest_workers = int(os.environ.get("INGEST_WORKERS", 4))
+_batch_max = int(os.environ.get("JOB_BATCH_MAX", 5000))
+_page_limit_max = int(os.environ.get("PAGE_LIMIT_MAX", 1000))
+_trusted_proxies = int(os.environ.get("TRUSTED_PROXIES", 0)) # proxies adding X-Forwarded-For in front, 1 behind the ingress
+PAGE_LIMIT = 100 # default page size of paginated listings
+SEARCH_LIMIT = 10 # default number of /regions/search matches
+IMAGE_MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
 
 # Redis Database 
-rd=redis.Redis(host=_redis_host, port=_redis_port, db=0) 
-jdb = redis.Redis(host=_redis_host, port=_redis_port, db=2) 
-resdb = redis.Redis(host=_redis_host, port=_redis_port, db=3) 
+jdb = LazyClient("jobs")
+resdb = LazyClient("results")
 
 # Starting Flask App 
 app = Flask(__name__) 
+if _trusted_proxies:
+    # only the hops our own proxies append are trusted, the rest of X-Forwarded-For is up to the client
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=_trusted_proxies)
 
 # Setting Log Level 
-log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-numeric_level = getattr(logging, log_level, logging.INFO)
-logging.basicConfig(level=numeric_level,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-logging.info("Logging level set to %s", log_level) 
+logger = get_logger(__name__)
 
-def download_and_extract_gz():
+request_latency = metrics.histogram("wpp_http_request_seconds", "Latency of API requests by route.",
+                                    ("route", "method", "status"))
+
+@app.before_request
+def _start_request_timer():
+    """Start timing the request and attribute its Redis calls to the endpoint."""
+    g.request_start = time.perf_counter()
+    g.call_site_token = metrics.call_site.set(request.endpoint or "unmatched")
+
+@app.after_request
+def _observe_request_latency(response):
+    """Record the request latency under its route template, not the concrete url."""
+    if "request_start" in g:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_latency.observe(time.perf_counter() - g.request_start, route=route,
+                                method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def _compress_response(response):
+    """Compress the body in the best coding the client accepts, unless it is small, binary or streamed."""
+    if (response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers
+            or response.mimetype not in compress.MIMETYPES or response.status_code in (204, 304)):
+        return response
+    response.vary.add("Accept-Encoding")
+    coding = compress.negotiate(request.headers.get("Accept-Encoding"))
+    if coding is None or response.calculate_content_length() < compress.MIN_BYTES:
+        return response
+    response.set_data(compress.compress(response.get_data(), coding))
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True) # the compressed bytes differ from the entity the tag names
+    return response
+
+def packed_response(plan, nested=False) -> Union[Response, None]:
+    """
+    Answer a read of whole years with their payloads compressed at ingest, if the client
+    accepts a coding they are stored in and the plan's version holds every year; else None.
+    """
+    coding = compress.negotiate(request.headers.get("Accept-Encoding"), compress.PACKED)
+    if coding is None or plan.empty or len(plan.fetch) != len(plan.year_keys):
+        return None
+    packed = dataset.packed_years(plan.fetch, plan.version, coding, plan.partition)
+    if packed is None:
+        return None
+    return Response(compress.join(packed, coding, nested), mimetype="application/json",
+                    headers={"Content-Encoding": coding, "Vary": "Accept-Encoding"})
+
+@app.teardown_request
+def _reset_call_site(exc):
+    if "call_site_token" in g:
+        metrics.call_site.reset(g.pop("call_site_token"))
+
+def paginated(*filters) -> bool:
+    """Whether a listing request asks for a page (a cursor, a limit or a filter) instead of everything."""
+    return any(name in request.args for name in ("cursor", "limit", *filters))
+
+def page_limit() -> int:
+    """The limit argument of a paginated request; raises ValueError unless it is 1 to PAGE_LIMIT_MAX."""
+    limit = request.args.get("limit", str(PAGE_LIMIT))
+    if not limit.isdigit() or not 1 <= int(limit) <= _page_limit_max:
+        raise ValueError(f"Limit must be a number from 1 to {_page_limit_max}.")
+    return int(limit)
+
+def page(items, next_cursor) -> dict:
+    return {"items": items, "next_cursor": next_cursor}
+
+def client_address() -> str:
+    """The address of the client, as seen by the outermost of the TRUSTED_PROXIES."""
+    return request.remote_addr or "unknown"
+
+def admit(cost, batch=False) -> Union[tuple, None]:
+    """
+    Return the response refusing jobs of total estimated `cost` from this client, as a batch
+    or not (400 if they cost too much to ever be admitted, 429 with Retry-After for now),
+    None to queue them.
+    """
+    error = admission.check_cost(cost, batch)
+    if error:
+        return jsonify({"error": error}), 400
+    refusal = admission.admit(client_address(), cost, batch)
+    if refusal is None:
+        return None
+    reason, wait = refusal
+    retry_after = max(math.ceil(wait), 1)
+    return jsonify({"error": reason, "retry_after": retry_after}), 429, {"Retry-After": str(retry_after)}
+
+def local_copy(link: str) -> str:
+    """The path of the cached copy of a source file."""
+    return os.path.join(cache_dir, os.path.basename(unquote(urlparse(link).path)))
+
+def source_release(link: str) -> str:
+    """The WPP release of a source file, the start of its name (WPP2024_..._Medium.csv.gz is WPP2024)."""
+    return re.sub(r"[,\s]+", "_", os.path.basename(local_copy(link)).split(".")[0].split("_")[0])
+
+def download_and_extract_gz(link=None):
     """
     downloads the .gz file from the remote server and extracts it to a .csv file.
     If the .gz file is already present locally, it uses that instead of downloading.
     """
-    gz_path = "data.csv.gz"
-    csv_path = "data.csv"
+    link = link or data_sources[0]
+    local_data = local_copy(link)
+    name = os.path.basename(local_data).split(".")[0]
+    gz_path = f"{name}.download.gz" # named after the source, several are loaded at once
+    csv_path = f"{name}.csv"
 
     if os.path.exists(local_data):
-        logging.info(f"Using cached .gz file from: {local_data}")
+        logger.info("Using cached .gz file from: %s", local_data)
         shutil.copyfile(local_data, gz_path)
     else:
         try:
-            logging.info(f"Downloading data from: {data_link}")
-            response = requests.get(data_link, stream=True)
+            logger.info("Downloading data from: %s", link)
+            import requests
+            response = requests.get(link, stream=True)
             response.raise_for_status()  # Raise error for bad responses
             with open(gz_path, 'wb') as f_out:
                 shutil.copyfileobj(response.raw, f_out)
-            logging.info("Download successful.")
+            logger.info("Download successful.")
         except Exception as e:
-            logging.error(f"Failed to download data: {e}")
+            logger.error("Failed to download data: %s", e)
             raise RuntimeError("No remote or local data available.")
 
     # Decompress .gz to .csv
@@ -64,26 +182,28 @@ def download_and_extract_gz():
         with gzip.open(gz_path, 'rb') as f_in:
             with open(csv_path, 'wb') as f_out:
                 shutil.copyfileobj(f_in, f_out)
-        logging.info(f"Decompressed .gz to .csv at: {csv_path}")
+        logger.info("Decompressed .gz to .csv at: %s", csv_path)
     finally:
         if os.path.exists(gz_path):
             os.remove(gz_path)
-            logging.info(f"Removed .gz file: {gz_path}")
+            logger.info("Removed .gz file: %s", gz_path)
 
     return csv_path
 
-def decode_data(): # AI helped read csv file 
+def decode_data(link=None): # AI helped read csv file 
     """
-    Decodes the data from the csv file and returns a dictionary with the data grouped by year.
+    Decodes the data from the csv file and returns a dictionary with the data grouped by
+    variant and year. Rows without a Variant are of the default variant.
     """
-    path = download_and_extract_gz()
+    import pandas as pd # only needed while loading the dataset, not by every API process
+    path = download_and_extract_gz(link)
     try:
         df = pd.read_csv(path, low_memory=False)
-        logging.info(f"Loaded CSV with {len(df)} rows")
+        logger.info("Loaded CSV with %s rows", len(df))
     finally:
         if os.path.exists(path):
             os.remove(path)
-            logging.info(f"Removed temporary CSV: {path}") 
+            logger.info("Removed temporary CSV: %s", path) 
     
     # Replace all NaNs with empty strings
     df.fillna("", inplace=True)
@@ -99,34 +219,75 @@ def decode_data(): # AI helped read csv file
                 # row[key] = row[key].replace(" ", "_") 
                 row[key] = re.sub(r"[,\s]+", "_", row[key])
 
-    grouped_by_year = defaultdict(list)
+    grouped = defaultdict(lambda: defaultdict(list))
 
     for row in data:
         year = row.get("Time")  # assumes 'Time' is the column name for year
         if year:
-            grouped_by_year[year].append(row) 
+            grouped[row.get("Variant") or default_variant][year].append(row) 
 
-    return dict(grouped_by_year)  # convert defaultdict to normal dict if 
+    return {variant: dict(years) for variant, years in grouped.items()}  # convert defaultdicts to normal dicts
 
-def fetch_latest_data(): 
+def decode_sources() -> tuple:
     """
-    Checks if the Redis database is up to date with the latest data.
-    If not, it fetches the latest data and updates the database.
+    Download and decode every source file, several at once, and name their variants
+    "<release>:<variant>". Returns the name of the default partition, the default variant
+    of the first source (or its first variant), and every partition by name.
     """
+    workers = max(min(_ingest_workers, len(data_sources)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        decoded = list(pool.map(decode_data, data_sources))
+    partitions = {}
+    for link, variants in zip(data_sources, decoded):
+        for variant, years in variants.items():
+            # the same variant may be spread over several files of a release
+            partitions.setdefault(f"{source_release(link)}:{variant}", {}).update(years)
+    first = [f"{source_release(data_sources[0])}:{variant}" for variant in decoded[0]]
+    default = f"{source_release(data_sources[0])}:{default_variant}"
+    return (default if default in first else next(iter(first), None)), partitions
 
-    current_year = datetime.now().year 
-    year_keys = [int(k.decode()) for k in rd.keys() if k.decode().isdigit()]
-    if not year_keys or max(year_keys) < current_year-2: # most up to date was 2023 and we were in 2025 when writing program 
-        logging.debug('Data was outdated, initializing update.') 
-        data = decode_data() 
-        # write data to database inside if statement
-        rd.set('Last-Modified',current_year) # sets the last-modified value for reference 
-        # for loop to write each dictionary to database for easier lookup 
-        for year, entries in data.items(): # AI helped to correctly set data into redis 
-            rd.set(year, json.dumps(entries))
-        logging.info('Data has been updated.') 
-    else: 
-        logging.debug('Data was the same.') 
+def file_source_fingerprint(link=None):
+    """
+    Fingerprints a source file without downloading it: the cached .gz by content hash,
+    otherwise the remote file by its ETag/Last-Modified headers. Returns None if neither works.
+    """
+    link = link or data_sources[0]
+    local_data = local_copy(link)
+    if os.path.exists(local_data):
+        return dataset.file_fingerprint(local_data)
+    import requests
+    try:
+        response = requests.head(link, allow_redirects=True, timeout=10)
+        response.raise_for_status()
+        return dataset.http_fingerprint(response.headers)
+    except Exception as e:
+        logger.warning("Could not fingerprint remote data: %s", e)
+        return None
+
+def source_fingerprint():
+    """
+    Fingerprints the source files, see `file_source_fingerprint`: the fingerprint of the one
+    file, or of every file by link if there are several. None if a file has none.
+    """
+    if len(data_sources) == 1:
+        return file_source_fingerprint(data_sources[0])
+    fingerprints = {link: file_source_fingerprint(link) for link in data_sources}
+    return None if None in fingerprints.values() else fingerprints
+
+def fetch_latest_data(force=False): 
+    """
+    Checks if the Redis database is up to date with the source file.
+    If not, it decodes the latest data and rewrites only the years that changed.
+    """
+    fingerprint = source_fingerprint()
+    if not force and fingerprint is not None and fingerprint == dataset.stored_fingerprint() and dataset.list_years():
+        logger.debug('Data was the same.') 
+        return None
+    logger.debug('Data source changed, initializing update.') 
+    default, partitions = decode_sources() 
+    summary = dataset.apply_update(partitions.pop(default, {}), fingerprint, partitions, default)
+    logger.info('Data has been updated.') 
+    return summary
 
 @app.route('/data', methods=['GET','POST','DELETE'])
 def process_data() -> Union[list, str]: # used AI for Union type annotation option 
@@ -137,20 +298,20 @@ def process_data() -> Union[list, str]: # used AI for Union type annotation opti
     3. Delete all data from the Redis database. (DELETE)
     """ 
     if request.method == 'GET':
-        keys = [key.decode('utf-8') for key in rd.keys() if key.decode('utf-8') != "Last-Modified"] # check for last modified entry and dont include 
-        data = [] 
-        for item in keys:
-            data.append(json.loads(rd.get(item).decode('utf-8'))) 
-        return data 
+        try:
+            plan = query.plan(variant=request.args.get("variant"))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        packed = packed_response(plan, nested=True)
+        return packed if packed is not None else query.execute(plan)
     elif request.method == 'POST':
-        logging.info("POST /data route hit — starting fetch")
-        fetch_latest_data() 
-        logging.debug('Loaded the world population data to a Redis database') 
+        logger.info("POST /data route hit — starting fetch")
+        fetch_latest_data(force=string_to_bool(request.args.get("force", "false"))) 
+        logger.debug('Loaded the world population data to a Redis database') 
         return 'Loaded the world population data to a Redis database\n' 
     elif request.method == 'DELETE':
-        for item in rd.keys(): 
-            rd.delete(item) 
-        logging.debug('Deleted all data from Redis database')
+        dataset.clear()
+        logger.debug('Deleted all data from Redis database')
         return 'Deleted all data from Redis database\n' 
     return {"error": f"Method Not Allowed."}, 405 
 
@@ -161,86 +322,102 @@ def get_all_years() -> List[str]:
     """
     # fetch_latest_data() # needs to fetch data to make sure database is not empty 
     try: 
-        keys = [key.decode('utf-8') for key in rd.keys() if key.decode('utf-8') != "Last-Modified"] # AI used to check for last modified entry 
+        keys = dataset.list_years(partition=dataset.partition(request.args.get("variant")))
         if not keys: 
-            logging.warning("GET /years returned an empty key list")
+            logger.warning("GET /years returned an empty key list")
         keys.sort()
         return keys 
+    except ValueError as e:
+        return {"error": str(e)}, 400
     except Exception as e:
-        logging.error(f"Error fetching genes: {e}")
+        logger.error("Error fetching genes: %s", e)
         return {"error": "Internal Server Error"}, 500
 
+def parse_era(era: str) -> tuple:
+    """
+    Return the (start, end) years of a 'YYYY' or 'YYYY-YYYY' string in increasing order.
+    Raises ValueError if the string is not a year or a range of years.
+    """
+    if '-' in era:
+        start_year, end_year = era.split('-')
+    else:
+        start_year = end_year = era  # Treat single year as both start and end
+    start_year, end_year = int(start_year), int(end_year)
+    if start_year > end_year:
+        start_year, end_year = end_year, start_year
+    return start_year, end_year
+
+def select_years(year_keys: List[str], years_data: list, regions: List[str]) -> Union[list, dict]:
+    """
+    Build the /years/<years>/regions response from the rows read for year_keys,
+    keeping only the given regions (or every region if none are given).
+    """
+    data = []
+    missing_years = []
+    found_regions = set()
+    for year, year_data in zip(year_keys, years_data):
+        if year_data is None:
+            missing_years.append(year)
+            logger.warning("No data found for year: %s", year)
+            continue
+        log_sampled(logger, logging.DEBUG, "Gathered data for year %s", year)
+        if regions:
+            year_data = [d for d in year_data if d.get("Location") in regions]
+            found_regions.update(d.get("Location") for d in year_data)
+        data.extend(year_data)
+
+    if not regions:
+        if missing_years:
+            return {"data": data, "missing_years": missing_years}
+        return data
+
+    missing_regions = set(regions) - found_regions
+    if missing_regions and missing_years:
+        logger.warning("Missing regions in data: %s", Lazy(', '.join, missing_regions))
+        return {"data": data, "missing_regions": list(missing_regions), "missing_years": missing_years} 
+    if missing_regions: 
+        return {"data": data, "missing_regions": list(missing_regions)} 
+    if missing_years: 
+        return {"data": data, "missing_years": missing_years} 
+    return data 
+
 @app.route('/years/<years>/regions', methods=['GET']) 
-def get_year(years:str, region_names=None) -> dict: 
+def get_year(years:str, region_names=None, version=None, field_names=None, variant=None) -> dict: 
     """
     This route uses the GET method to retrieve data for a specific year or range of years for given regions.
+    Jobs pass the dataset version they pinned so every read of the job sees the same data.
     """
 
     try:
         # Try to get region names from Flask request if available
         if region_names is None:
             region_names = request.args.get("names", "")
+        if field_names is None:
+            field_names = request.args.get("fields", "")
+        if variant is None:
+            variant = request.args.get("variant")
     except Exception as e:
         # We're not in a Flask request context
         if region_names is None:
             region_names = ""
 
     regions = region_names.split(",") if region_names else []
+    fields = field_names.split(",") if field_names else []
 
     try:
-        if '-' in years:
-            start_year, end_year = years.split('-')
-        else:
-            start_year = end_year = years  # Treat single year as both start and end
+        start_year, end_year = parse_era(years)
     except ValueError: 
         return {"error": "Invalid era format. Use YYYY-YYYY."}, 404
-    
-    if int(start_year) > int(end_year): 
-        start_year, end_year = end_year, start_year
 
-    data = []
-    missing_years = []
-
-    try: 
-        if not regions: 
-            for i in range(int(start_year),int(end_year)+1):
-                # data.append(json.loads(rd.get(str(i))))
-                raw = rd.get(str(i))
-                if raw is None:
-                    missing_years.append(str(i)) 
-                    logging.warning(f"No data found for year: {i}") 
-                    continue 
-                year_data = json.loads(raw)
-            if missing_years: 
-                return {"data": year_data, "missing_years": missing_years} 
-            return year_data 
-        if regions:
-            found_regions = set()
-            for i in range(int(start_year),int(end_year)+1):
-                raw = rd.get(str(i))
-                if raw is None:
-                    missing_years.append(str(i))
-                    logging.warning(f"No data found for year: {i}")
-                    continue 
-                year_data = json.loads(raw)
-                logging.info(f'gathered year data')
-                logging.info(f'data is of type {type(year_data)}') 
-                matches = [d for d in year_data if d.get("Location") in regions]
-                found_regions.update(d.get("Location") for d in matches)
-                data.extend(matches)
-            missing_regions = set(regions) - found_regions
-            if missing_regions and missing_years:
-                logging.warning(f"Missing regions in data: {', '.join(missing_regions)}")
-                return {"data": data, "missing_regions": list(missing_regions), "missing_years": missing_years} 
-            if missing_regions: 
-                return {"data": data, "missing_regions": list(missing_regions)} 
-            if missing_years: 
-                return {"data": data, "missing_years": missing_years} 
-            return data 
-
-    except TypeError: 
-        logging.error(f"years '{years}' not found") 
-        return {"error": f"years '{years}' not found"}, 404 
+    try:
+        plan = query.plan(start_year, end_year, regions, fields, version, variant)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    if has_request_context() and not regions and not plan.fields:
+        packed = packed_response(plan)
+        if packed is not None:
+            return packed
+    return select_years(plan.year_keys, query.execute(plan), plan.regions)
 
 @app.route('/regions', methods=['GET']) 
 def get_regions() -> dict: 
@@ -248,109 +425,213 @@ def get_regions() -> dict:
     This route uses the GET method to retrieve all regions from the Redis database. 
     """
     try: 
-        keys = [key.decode('utf-8') for key in rd.keys() if key.decode('utf-8') != "Last-Modified"] # AI used to check for last modified entry 
-        if not keys: 
-            logging.warning("GET /years returned an empty key list")
-        locations_set = set() # sets update method avoids duplicates 
-        for item in keys:
-            locations_set.update(loc["Location"] for loc in json.loads(rd.get(item).decode('utf-8')))
-        locations = list(locations_set)
-        logging.debug(f'Type of locations: {type(locations)}')
-        locations.sort()
+        locations = dataset.list_locations()
+        if not locations: 
+            logger.warning("GET /regions returned an empty location list")
         return locations 
     except TypeError as e: 
-        logging.error(f"Raised exception '{e}'") 
+        logger.error("Raised exception '%s'", e) 
         return {"error": f"Raised exception '{e}'"}, 404 
     
+@app.route('/variants', methods=['GET'])
+def get_variants() -> list:
+    """
+    This route returns the partitions of the current dataset version, one per release and
+    variant of the source files, with their years. Read routes and jobs take one as variant=.
+    """
+    return [{"partition": name, **info} for name, info in sorted(dataset.get_partitions().items())]
+
+@app.route('/regions/search', methods=['GET'])
+def search_regions() -> Union[dict, tuple]:
+    """
+    This route returns the regions best matching q, for autocompletion: the region it names
+    or whose ISO3/ISO2 code or LocID it is, then regions whose name or a word of it starts
+    with q, then similarly spelled regions. Any of these identifiers is accepted wherever a
+    region is.
+    """
+    text = request.args.get("q", "")
+    limit = request.args.get("limit", str(SEARCH_LIMIT))
+    if not locations.normalize(text):
+        return {"error": "Please provide a search query with q."}, 400
+    if not limit.isdigit() or not 1 <= int(limit) <= _page_limit_max:
+        return {"error": f"Limit must be a number from 1 to {_page_limit_max}."}, 400
+    return {"query": text, "items": locations.index().search(text, int(limit))}
+
+def region_page(plan, region: str) -> tuple:
+    """
+    Narrow a plan of every year to `limit` years from the cursor on. A cursor is
+    "<dataset version>:<first year>", so every page of a listing reads the same version.
+    Return the narrowed plan and the cursor of the next page, None after the last page.
+    """
+    limit = page_limit()
+    version, year_keys = plan.version, plan.year_keys
+    cursor = request.args.get("cursor")
+    if cursor:
+        version, _, year = cursor.partition(":")
+        if not version.isdigit() or not year.isdigit():
+            raise ValueError("Invalid cursor.")
+        version = int(version)
+        if version != plan.version:
+            year_keys = query.plan(regions=[region], version=version, variant=request.args.get("variant")).year_keys
+        year_keys = [key for key in year_keys if int(key) >= int(year)]
+    years = year_keys[:limit]
+    next_cursor = f"{version}:{year_keys[limit]}" if len(year_keys) > limit else None
+    return query.Plan(version, years, set(years), plan.regions, plan.fields, plan.partition), next_cursor
+
 @app.route('/regions/<region>', methods=['GET']) 
 def get_region(region:str) -> List[dict]: 
     """
     This route returns data for a specific region from the Redis database.
+    With a cursor or limit argument it returns one page of years at a time.
     """
     try: 
-        keys = [key.decode('utf-8') for key in rd.keys() if key.decode('utf-8') != "Last-Modified"] # AI used to check for last modified entry 
-        if not keys: 
-            logging.warning("GET /years returned an empty key list")
+        plan = query.plan(regions=[region], fields=request.args.get("fields", "").split(","),
+                          variant=request.args.get("variant"))
+        region = plan.regions[0]
+        if plan.empty: 
+            logger.warning("GET /years returned an empty key list")
             return {"error": f"No data found for '{region}' region. Database was empty! "}, 404
+        if paginated():
+            plan, next_cursor = region_page(plan, region)
+            return page([row for rows in query.execute(plan) for row in rows or []], next_cursor)
         region_data = [] # list of dictionaries 
-        for year in keys: # iterating through all years, each year has a list of dictionaries with different regions 
-            item = json.loads(rd.get(year).decode('utf-8')) # get list of dictionaries
-            region_data.extend([data_dict for data_dict in item if data_dict["Location"] == region]) # extend used to avoid TypeError 
+        for item in query.execute(plan): # every year has a list of dictionaries with different regions 
+            region_data.extend(item) # extend used to avoid TypeError 
 
         if not region_data:
             return {"error": f"No entries found for region '{region}'."}, 404
         
         return region_data 
+    except ValueError as e:
+        return {"error": str(e)}, 400
     except Exception as e: 
-        logging.error(f"Raised exception '{e}'") 
+        logger.error("Raised exception '%s'", e) 
         return {"error": f"Raised exception '{e}'"}, 404 
 
+def select_region_eras(region: str, start_year: int, end_year: int, year_keys: List[str], years_data: list) -> tuple:
+    """
+    Build the /regions/<region>/<eras> response and status code from the rows read
+    for year_keys.
+    """
+    region_data = []
+    missing_years = []
+
+    for year, year_data in zip(year_keys, years_data):
+        if year_data is None:
+            missing_years.append(year)
+            logger.warning("No data found for year: %s", year)
+            continue
+        region_data.extend(d for d in year_data if d.get("Location") == region)
+
+    if not region_data and missing_years:
+        return {
+            "error": f"No data entries found for region '{region}'.",
+            "missing_years": missing_years
+        }, 404
+
+    if not region_data:
+        return {
+            "error": f"No entries found for region '{region}' in any year from {start_year} to {end_year}."
+        }, 404
+
+    response = {"data": region_data}
+    if missing_years:
+        response["missing_years"] = missing_years
+
+    return response, 206 if missing_years else 200
+
+def empty_database_error(region: str) -> tuple:
+    logger.warning("GET /region_eras found an empty database.")
+    return {"error": f"No data found for '{region}' region. Database was empty!"}, 404
+
 @app.route('/regions/<region>/<eras>', methods=['GET']) 
 def get_region_eras(eras:str, region:str) -> List[dict]: 
     """
     this route returns data for a specific region and year range from the Redis database.
     """    
     try:
-        if '-' in eras:
-            start_year, end_year = eras.split("-")
-        else:
-            start_year = end_year = eras
+        start_year, end_year = parse_era(eras)
     except ValueError:
         return {"error": "Invalid era format. Use YYYY-YYYY."}, 404
 
-    if int(start_year) > int(end_year):
-        start_year, end_year = end_year, start_year
-
     try:
-        keys = [key.decode('utf-8') for key in rd.keys()
-                if key.decode('utf-8') != "Last-Modified"]
-
-        if not keys:
-            logging.warning("GET /region_eras returned an empty key list.")
-            return {
-                "error": f"No data found for '{region}' region. Database was empty!"
-            }, 404
-
-        region_data = []
-        missing_years = []
-
-        for year in range(int(start_year), int(end_year) + 1):
-            str_year = str(year)
-            if str_year not in keys:
-                missing_years.append(str_year)
-                logging.warning(f"No data found for year: {str_year}")
-                continue
-
-            raw = rd.get(str_year)
-            if raw is None:
-                missing_years.append(str_year)
-                logging.warning(f"No data found for year: {str_year}")
-                continue
-
-            year_data = json.loads(raw)
-            matches = [d for d in year_data if d.get("Location") == region]
-            region_data.extend(matches)
-
-        if not region_data and missing_years:
-            return {
-                "error": f"No data entries found for region '{region}'.",
-                "missing_years": missing_years
-            }, 404
+        fields = request.args.get("fields", "").split(",")
+        plan = query.plan(start_year, end_year, [region], fields, variant=request.args.get("variant"))
+        if not plan.version:
+            return empty_database_error(region)
+        return select_region_eras(plan.regions[0], start_year, end_year, plan.year_keys, query.execute(plan))
 
-        if not region_data:
-            return {
-                "error": f"No entries found for region '{region}' in any year from {start_year} to {end_year}."
-            }, 404
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        logger.error("Raised exception '%s'", e)
+        return {"error": f"Raised exception '{e}'"}, 500
 
-        response = {"data": region_data}
-        if missing_years:
-            response["missing_years"] = missing_years
+@app.route('/charts/<plot_type>/<years>', methods=['GET'])
+def get_chart(plot_type: str, years: str):
+    """
+    This route renders small charts inline, once admitted like a job, and returns the image.
+    Larger charts, animations and specs that render one image per year are queued as a job
+    instead (202).
+    """
+    try:
+        start_year, end_year = parse_era(years)
+    except ValueError:
+        return {"error": "Invalid era format. Use YYYY-YYYY."}, 404
+    try:
+        spec = charts.parse_spec(plot_type, start_year, end_year, request.args)
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
-        return response, 206 if missing_years else 200
+    if not charts.renders_inline(spec):
+        job = charts.job_spec(spec)
+        error = admission.check_spec(job)
+        if error:
+            return {"error": error}, 400
+        refusal = admit(charts.cost(spec))
+        if refusal:
+            return refusal
+        job_info = add_job(job)
+        charts.chart_requests.inc(plot_type=plot_type, outcome="queued")
+        logger.info("Chart queued as job %s (cost %d)", job_info["id"], charts.cost(spec))
+        return {"message": "Chart is too large to render inline, queued as a job", "job": job_info}, 202, \
+            {"Location": f"/jobs/{job_info['id']}"}
 
+    try:
+        image, key, version = charts.cached_chart(spec)
+        cached = image is not None
+        if not cached:
+            refusal = admit(charts.cost(spec)) # rendering ties up this process, charge it as a job
+            if refusal:
+                return refusal
+            image = charts.render_chart(spec, key, version)
     except Exception as e:
-        logging.error(f"Raised exception '{e}'")
-        return {"error": f"Raised exception '{e}'"}, 500
+        logger.error("Error rendering chart %s: %s", spec, e)
+        return {"error": f"Could not render chart: {e}"}, 404
+    if image is None:
+        return {"error": "No data found for this chart."}, 404
+    etag = key[len(charts.KEY_PREFIX):]
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304)
+    mimetype = "image/gif" if spec["animate"] else IMAGE_MIMETYPES[spec["format"]]
+    return Response(image, mimetype=mimetype, headers={
+        "ETag": f'"{etag}"', "Cache-Control": f"max-age={charts.CACHE_TTL}",
+        "X-Chart-Cache": "hit" if cached else "miss"})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics() -> Response:
+    """
+    This route returns the API metrics in the Prometheus text format.
+    """
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/queue', methods=['GET'])
+def get_queue():
+    """
+    This route returns the number of queued jobs, how long the oldest one has been waiting and
+    the estimated cost of all of them, for autoscalers of the workers.
+    """
+    return jsonify(queue_stats()), 200
 
 @app.route('/help', methods=['GET'])
 def get_help():
@@ -418,16 +699,29 @@ def get_help():
         <tr><td>/years</td><td>GET</td><td>Return json-formatted list of all the years available from the dataset</td></tr>
         <tr><td>/years/{year}/regions</td><td>GET</td><td>Return all data associated with a specific year and all its regions</td></tr>
         <tr><td>/years/{year}/regions?names=a,b,c</td><td>GET</td><td>Return data associated with a specific year and the specified regions</td></tr>
+        <tr><td>/years/{year}/regions?fields=a,b</td><td>GET</td><td>Return only the given fields (plus Location and Time) of every row</td></tr>
+        <tr><td>/years/{year}/regions?variant=High</td><td>GET</td><td>Read another variant (or release:variant) than the default; also accepted by /data, /years and the /regions/{region} routes</td></tr>
+        <tr><td>/variants</td><td>GET</td><td>Return the release/variant partitions of the dataset with their years</td></tr>
         <tr><td>/regions</td><td>GET</td><td>Return a list of all regions/countries in the dataset</td></tr>
+        <tr><td>/regions/search?q=text&limit=n</td><td>GET</td><td>Return up to n (default 10) regions matching a name, prefix, ISO3/ISO2 code or LocID, best first</td></tr>
         <tr><td>/regions/{region}</td><td>GET</td><td>Return data of all the years for a specific {region}</td></tr>
+        <tr><td>/regions/{region}?limit=n&cursor=c</td><td>GET</td><td>Return the data of a page of n years for a specific {region}</td></tr>
         <tr><td>/regions/{region}/{eras}</td><td>GET</td><td>Return data for a specific region and the specified eras/years</td></tr>
+        <tr><td>/charts/{plot_type}/{years}?names=a,b&query1=x</td><td>GET</td><td>Render a small chart and return the image, or queue it as a job if it is large</td></tr>
+        <tr><td>/metrics</td><td>GET</td><td>Return API metrics in the Prometheus text format</td></tr>
+        <tr><td>/queue</td><td>GET</td><td>Return the queue depth, the age of the oldest queued job, the estimated backlog cost and the number of running jobs</td></tr>
         <tr><td>/help</td><td>GET</td><td>Returns instructions to post a job</td></tr>
         <tr><td>/jobs</td><td>GET</td><td>Return a list of all job IDs</td></tr>
+        <tr><td>/jobs?limit=n&cursor=c&status=s&plot_type=p&since=t&until=t</td><td>GET</td><td>Return a page of job IDs, newest first, filtered by status, plot type and submission time</td></tr>
         <tr><td>/jobs</td><td>POST</td><td>Submits a new job to the queue by sending a json dictionary in the request body</td></tr>
         <tr><td>/jobs</td><td>DELETE</td><td>Deletes all jobs from Redis database</td></tr>
+        <tr><td>/jobs/batch</td><td>POST</td><td>Submits a json list of job specs to the queue as one group</td></tr>
+        <tr><td>/jobs/batch/{groupid}</td><td>GET</td><td>Return a job group and the combined status of its jobs</td></tr>
         <tr><td>/jobs/{jobid}</td><td>GET</td><td>Return all data associated with a {jobid}</td></tr>
         <tr><td>/jobs/{jobid}</td><td>DELETE</td><td>Delete all job data associated with a {jobid}</td></tr>
+        <tr><td>/jobs/{jobid}/cancel</td><td>POST</td><td>Cancel a queued or running job</td></tr>
         <tr><td>/results</td><td>GET</td><td>Return a list of result IDs</td></tr>
+        <tr><td>/results?limit=n&cursor=c</td><td>GET</td><td>Return a page of result IDs</td></tr>
         <tr><td>/results</td><td>DELETE</td><td>Delete all results data</td></tr>
         <tr><td>/results/{jobid}</td><td>GET</td><td>Return the results associated with a {jobid}</td></tr>
         <tr><td>/results/{jobid}</td><td>DELETE</td><td>Delete all results data associated with a {jobid}</td></tr>
@@ -456,6 +750,7 @@ def get_help():
         </tbody>
       <body>
         Must have a valid start and end year. No location wil default to "World", no plot type will default to "line", no query1 or query2 will default to  query1 = "TPopulation1Jan" and query2 = None, no animation will default to False. Line plots canot be animated.
+        A "plot_type" of "export" writes the data instead of plotting it, as "format" "csv" (default), "parquet" or "arrow", optionally only the comma separated "fields"; download it from /download/{jobid}.
       </body>
     </table>
     </body>
@@ -474,60 +769,151 @@ def get_jobs() -> Union[list, str]:
     if request.method == 'POST': 
         try: 
             data = request.get_json()
-            logging.debug("POST data received: %s", data)
+            logger.debug("POST data received: %s", data)
 
-            if not data.get("start") or not data.get("end"):
-                logging.error("Missing start or end date.")
-                return jsonify({"error": "Please provide both start and end dates."}), 400  
+            error = validate_job_spec(data) or admission.check_spec(data)
+            if error:
+                logger.error("Invalid job spec: %s", error)
+                return jsonify({"error": error}), 400  
+            refusal = admit(job_cost(data))
+            if refusal:
+                return refusal
 
             job_info = add_job(data)
-            logging.info(f"Job created: {job_info}")
+            logger.info("Job created: %s", job_info)
             return jsonify({"message": "Job created", "job": job_info}), 201
         except Exception as e: 
-            logging.error(f"Error creating job: {e}")
+            logger.error("Error creating job: %s", e)
             return jsonify({"error": "Internal Server Error"}), 500 
 
     elif request.method == 'GET': 
+        filters = ("status", "plot_type", "since", "until")
+        if paginated(*filters):
+            try:
+                since, until = (float(request.args[name]) if name in request.args else None for name in ("since", "until"))
+                jids, next_cursor = list_jobs(request.args.get("cursor"), page_limit(), request.args.get("status"),
+                                              request.args.get("plot_type"), since, until)
+                return jsonify(page(jids, next_cursor)), 200
+            except ValueError as e:
+                return jsonify({"error": f"Invalid page request: {e}"}), 400
         try: 
             jobs = get_all_jobs()
-            logging.debug("Retrieved all job IDs")
+            logger.debug("Retrieved all job IDs")
             return jsonify(jobs), 200
         except Exception as e:
-            logging.error(f"Error retrieving jobs: {e}")
+            logger.error("Error retrieving jobs: %s", e)
             return jsonify({"error": "Internal Server Error"}), 500
     
     elif request.method == 'DELETE':
-        for item in jdb.keys(): 
-            jdb.delete(item) 
-        logging.debug('Deleted all jobs from Redis database')
+        retention.unlink_all(jdb)
+        logger.debug('Deleted all jobs from Redis database')
         return 'Deleted all jobs from Redis database\n' 
 
-    logging.warning(f"Method {request.method} not allowed on /jobs")
+    logger.warning("Method %s not allowed on /jobs", request.method)
     return jsonify({"error": f"Method {request.method} Not Allowed."}), 405
 
+@app.route('/jobs/batch', methods=['POST'])
+def post_jobs_batch() -> tuple:
+    """
+    This route uses the POST method to submit many jobs at once as a single group.
+    The request body is a json list of job specs (or a dictionary with a "jobs" list).
+    All specs are validated before any job is created.
+    """
+    data = request.get_json(silent=True)
+    specs = data.get("jobs") if isinstance(data, dict) else data
+    if not isinstance(specs, list) or not specs:
+        return jsonify({"error": "Please provide a non-empty list of job specs."}), 400
+    if len(specs) > _batch_max:
+        return jsonify({"error": f"Batches are limited to {_batch_max} jobs."}), 400
+
+    errors = []
+    for index, spec in enumerate(specs):
+        error = validate_job_spec(spec) or admission.check_spec(spec) or admission.check_cost(job_cost(spec))
+        if error:
+            errors.append({"index": index, "error": error})
+    if errors:
+        logger.error("Rejected batch with %s invalid job specs.", len(errors))
+        return jsonify({"error": "Invalid job specs, no jobs were created.", "invalid": errors}), 400
+    refusal = admit(sum(job_cost(spec) for spec in specs), batch=True)
+    if refusal:
+        return refusal
+
+    try:
+        batch = add_jobs(specs)
+        logger.info("Batch created: group %s with %s jobs", batch['group']['id'], len(specs))
+        return jsonify({"message": "Jobs created", **batch}), 201
+    except Exception as e:
+        logger.error("Error creating batch: %s", e)
+        return jsonify({"error": "Internal Server Error"}), 500
+
+@app.route('/jobs/batch/<groupid>', methods=['GET'])
+def get_jobs_batch(groupid: str) -> Union[dict, tuple]:
+    """
+    This route uses the GET method to retrieve a job group with the combined status of its jobs.
+    """
+    try:
+        group = get_group_status(groupid)
+        if "error" in group:
+            return group, 404
+        return group
+    except Exception as e:
+        logger.error("Error fetching group %s: %s", groupid, e)
+        return {"error": "Internal Server Error"}, 500
 
 @app.route('/jobs/<jobid>', methods=['GET', 'DELETE']) 
 def get_job(jobid: str) -> Union[dict,tuple]: 
     """
     This route uses the GET method to retrieve a job by its ID from the Redis database.
-    The DELETE method is used to delete a specific job from the Redis database.
+    The DELETE method is used to delete a specific job from the Redis database, after
+    cancelling it if it has not finished.
     """
     if request.method == 'GET':
         try: 
             job = get_job_by_id(jobid)
-            logging.debug(f"Job fetched: {job}")
+            logger.debug("Job fetched: %s", job)
             return job
         except Exception as e: 
-            logging.error(f"Error fetching job {jobid}: {e}")
+            logger.error("Error fetching job %s: %s", jobid, e)
             return {"error": "Internal Server Error"}, 500  
     elif request.method == 'DELETE': 
-        jdb.delete(jobid) 
-        logging.debug(f'Deleted {jobid} job from Redis database')
+        cancel_job(jobid) # so no worker keeps rendering it
+        delete_job(jobid) 
+        logger.debug('Deleted %s job from Redis database', jobid)
         return f'Deleted {jobid} job from Redis database\n' 
 
-    logging.warning(f"Method {request.method} not allowed on /jobs")
+    logger.warning("Method %s not allowed on /jobs", request.method)
     return jsonify({"error": f"Method {request.method} Not Allowed."}), 405    
 
+@app.route('/jobs/<jobid>/cancel', methods=['POST'])
+def post_job_cancel(jobid: str) -> tuple:
+    """
+    This route uses the POST method to cancel a job that has not finished. A queued job is
+    taken off the queue, and a worker running the job stops before its next frame.
+    """
+    job = get_job_by_id(jobid)
+    if "error" in job:
+        return jsonify(job), 404
+    cancelled = cancel_job(jobid)
+    if "error" in cancelled:
+        return jsonify(cancelled), 409
+    return jsonify({"message": "Job cancelled", "job": cancelled}), 200
+
+def scan_results(cursor, limit) -> tuple:
+    """
+    Return a page of about `limit` job ids with results and the cursor of the next page,
+    None after the last. The cursor is the SCAN cursor of the results database, so a page
+    can hold a few more ids than `limit` and ids added during a listing may be missed.
+    """
+    position = int(cursor or 0)
+    keys = []
+    while len(keys) < limit:
+        position, batch = resdb.scan(position, count=limit)
+        keys.extend(key.decode('utf-8') for key in batch)
+        keys = [key for key in keys if not key.startswith(retention.CACHE_PREFIXES)]
+        if position == 0:
+            break
+    return keys, str(position) if position else None
+
 @app.route('/results', methods=['GET', 'DELETE']) # able to delete all results from database
 
 def results_all():
@@ -536,21 +922,27 @@ def results_all():
     The DELETE method is used to delete all results from the Redis database.
     """ 
     if request.method == 'GET':
+        if paginated():
+            try:
+                keys, next_cursor = scan_results(request.args.get("cursor"), page_limit())
+                return page(keys, next_cursor)
+            except ValueError as e:
+                return {"error": f"Invalid page request: {e}"}, 400
         try:
             keys = resdb.keys()
             keys = [key.decode('utf-8') for key in keys]
-            logging.debug(f"Retrieved all job IDs: {keys}")
+            keys = [key for key in keys if not key.startswith(retention.CACHE_PREFIXES)] # cached charts and frames
+            logger.debug("Retrieved all job IDs: %s", keys)
             return keys 
         except Exception as e:
-            logging.error(f"Error fetching job keys: {e}")
+            logger.error("Error fetching job keys: %s", e)
             return []
     elif request.method == "DELETE":
-        for item in resdb.keys(): 
-            resdb.delete(item) 
-        logging.debug('Deleted all results from Redis database')
+        retention.unlink_all(resdb)
+        logger.debug('Deleted all results from Redis database')
         return 'Deleted all results from Redis database\n' 
 
-    logging.warning(f"Method {request.method} not allowed on /jobs")
+    logger.warning("Method %s not allowed on /jobs", request.method)
     return jsonify({"error": f"Method {request.method} Not Allowed."}), 405
 
 @app.route('/results/<jobid>', methods=['GET', 'DELETE']) 
@@ -562,59 +954,66 @@ def results(jobid: str) -> Union[dict,tuple]:
     if request.method == 'GET':
         try:
             data = get_results(jobid)
-            logging.debug(f"Results fetched: {data}")
+            logger.debug("Results fetched: %s", data)
             return data  
         except Exception as e:
-            logging.error(f"Error retrieving results for job {jobid}: {e}")
+            logger.error("Error retrieving results for job %s: %s", jobid, e)
             return {"error": "Internal Server Error"}, 500 
     elif request.method == "DELETE":
         resdb.delete(jobid) 
-        logging.debug(f'Deleted {jobid} results from Redis database')
+        logger.debug('Deleted %s results from Redis database', jobid)
         return f'Deleted {jobid} results from Redis database\n' 
 
-    logging.warning(f"Method {request.method} not allowed on /jobs")
+    logger.warning("Method %s not allowed on /jobs", request.method)
     return jsonify({"error": f"Method {request.method} Not Allowed."}), 405
 
 @app.route('/download/<jobid>', methods=['GET'])
 def download(jobid):
     """
     This route uses the GET method to download the results of a specific job ID from the Redis database.
-    Depending on the job type, it will return either a GIF, a ZIP file of images, or a PNG file.
+    Depending on the job type, it will return either a GIF, a ZIP file of images, a PNG/SVG file,
+    or the table of an export job, streamed chunk by chunk.
+    With ?thumbnail=true it returns the thumbnails of a job submitted with thumbnails instead.
     """
     job_dict = get_job_by_id(jobid)
-    flag = string_to_bool(job_dict.get("animate"))
     plot_type = job_dict.get("plot_type")
-    logging.debug(f'job_dict is {job_dict}')
-    logging.debug(f'job_dict animate option is {job_dict.get("animate")}')
-    logging.debug(f'flag is {flag}')
+    if plot_type == "export":
+        return download_export(jobid)
+    flag = string_to_bool(job_dict.get("animate")) and plot_type != "line" # line plots are never animated
+    thumbnail = string_to_bool(request.args.get("thumbnail", "false"))
+    prefix = "thumb" if thumbnail else "image"
+    extension = "png" if thumbnail else job_dict.get("format") or "png"
+    mimetype = IMAGE_MIMETYPES[extension]
+    logger.debug('job_dict is %s', job_dict)
+    logger.debug('job_dict animate option is %s', job_dict.get("animate"))
+    logger.debug('flag is %s', flag)
 
     if flag: 
-        logging.debug(f'animation was true')
-        path = f'/app/{jobid}.gif'
-        with open(path, 'wb') as f:
-            f.write(resdb.hget(jobid, 'gif'))   # 'resdb' is a client to the results db
-        return send_file(path, mimetype='image/gif', as_attachment=True)
+        logger.debug('animation was true')
+        gif = resdb.hget(jobid, 'gif')   # 'resdb' is a client to the results db
+        if gif is None:
+            return {"error": f"No results found for job '{jobid}'."}, 404
+        return send_file(BytesIO(gif), mimetype='image/gif', as_attachment=True, download_name=f'{jobid}.gif')
     elif plot_type in ["bar", "scatter"] and not flag:
-        logging.debug(f'Plot type was bar and animation was false')
+        logger.debug('Plot type was bar and animation was false')
         mem_zip = BytesIO()
-        logging.debug(f'mem_zip is of type: {type(mem_zip)}')
+        logger.debug('mem_zip is of type: %s', type(mem_zip))
 
         # Creating a ZipFile in memory
         with zipfile.ZipFile(mem_zip, 'w') as zipf:
-            logging.debug(f'Preparing zip file')
-            logging.debug(f'Keys for the {jobid} jobid are {resdb.hkeys(jobid)}')
-            logging.debug(f'Keys in results database are {resdb.keys()}')
+            logger.debug('Preparing zip file')
+            logger.debug('Keys for the %s jobid are %s', jobid, Lazy(resdb.hkeys, jobid))
+            logger.debug('Keys in results database are %s', Lazy(resdb.keys))
 
             # Loop through Redis keys to find image data
             for key in resdb.hkeys(jobid):
-                logging.debug(f'Found key: {key}')
-                if key.startswith(b'image_'):  # e.g., image_2020
-                    logging.debug(f"Key '{key}' starts with image_")
+                log_sampled(logger, logging.DEBUG, 'Found key: %s', key)
+                if key.startswith(f'{prefix}_'.encode()):  # e.g., image_2020
                     year = key.decode().split('_')[1]
                     data = resdb.hget(jobid, key)  # Get the binary data from Redis
                     # Writing the image data to the zip file
-                    zipf.writestr(f"{jobid}_{year}.png", data)
-                    logging.debug(f"Added {jobid}_{year}.png to zip")
+                    zipf.writestr(f"{jobid}_{year}.{extension}", data)
+                    log_sampled(logger, logging.DEBUG, "Added %s_%s.%s to zip", jobid, year, extension)
 
         # Seek to the beginning of the in-memory ZIP file before sending it
         mem_zip.seek(0)
@@ -623,10 +1022,26 @@ def download(jobid):
         return send_file(mem_zip, mimetype='application/zip', as_attachment=True, download_name=f'{jobid}_images.zip')
 
     else: 
-        path = f'/app/{jobid}.png'
-        with open(path, 'wb') as f:
-            f.write(resdb.hget(jobid, 'image'))   # 'resdb' is a client to the results db
-        return send_file(path, mimetype='image/png', as_attachment=True)
+        image = resdb.hget(jobid, prefix)   # 'resdb' is a client to the results db
+        if image is None:
+            return {"error": f"No results found for job '{jobid}'."}, 404
+        return send_file(BytesIO(image), mimetype=mimetype, as_attachment=True, download_name=f'{jobid}.{extension}')
+
+def download_export(jobid):
+    """Stream the chunks of an export job in order, without holding the whole file in memory."""
+    files = resdb.hget(jobid, "files")
+    if files is None:
+        return {"error": f"No results found for job '{jobid}'."}, 404
+    files = json.loads(files)
+
+    def chunks():
+        for index in range(files["chunks"]):
+            yield resdb.hget(jobid, export.chunk_field(index)) or b""
+
+    headers = {"Content-Disposition": f"attachment; filename={jobid}.{files['format']}",
+               "Content-Length": str(sum(files["sizes"].values()))}
+    return Response(chunks(), mimetype=export.MIMETYPES[files["format"]], headers=headers)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # development server only, production runs through serve.py
+    app.run(debug=string_to_bool(os.environ.get("FLASK_DEBUG", "false")), host='0.0.0.0', port=5000)
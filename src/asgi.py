@@ -0,0 +1,122 @@
+"""
+ASGI entry point for the API.
+
+The range read routes are served natively with an asyncio Redis client, so a slow Redis
+call only suspends that request instead of blocking a worker thread. Every other route
+is passed through to the Flask app.
+
+    uvicorn asgi:app            # or: SERVER_MODE=asgi python serve.py
+"""
+import json
+import re
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+import api
+import compress
+import dataset
+import query
+import storage
+
+flask_app = WsgiToAsgi(api.app)
+
+async def get_year(years: str, params: dict, accept_encoding=None) -> tuple:
+    """
+    Async version of `api.get_year`. Whole years in a coding the client accepts are returned
+    as (compressed payload, status, coding), see `api.packed_response`.
+    """
+    names = params.get("names", [""])[0]
+    regions = names.split(",") if names else []
+    fields = params.get("fields", [""])[0].split(",")
+    try:
+        start_year, end_year = api.parse_era(years)
+    except ValueError:
+        return {"error": "Invalid era format. Use YYYY-YYYY."}, 404
+
+    rd = storage.get_async_client("data")
+    try:
+        plan = await query.aplan(rd, start_year, end_year, regions, fields, variant=params.get("variant", [None])[0])
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    coding = compress.negotiate(accept_encoding, compress.PACKED)
+    if coding and not regions and not plan.fields and not plan.empty and len(plan.fetch) == len(plan.year_keys):
+        packed = await dataset.apacked_years(rd, plan.fetch, plan.version, coding, plan.partition)
+        if packed is not None:
+            return compress.join(packed, coding), 200, coding
+    return api.select_years(plan.year_keys, await query.aexecute(rd, plan), plan.regions), 200
+
+async def get_region_eras(region: str, eras: str, params: dict, accept_encoding=None) -> tuple:
+    """Async version of `api.get_region_eras`."""
+    try:
+        start_year, end_year = api.parse_era(eras)
+    except ValueError:
+        return {"error": "Invalid era format. Use YYYY-YYYY."}, 404
+
+    try:
+        rd = storage.get_async_client("data")
+        plan = await query.aplan(rd, start_year, end_year, [region], params.get("fields", [""])[0].split(","),
+                                 variant=params.get("variant", [None])[0])
+        if not plan.version:
+            return api.empty_database_error(region)
+        years_data = await query.aexecute(rd, plan)
+        return api.select_region_eras(plan.regions[0], start_year, end_year, plan.year_keys, years_data)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        api.logger.error("Raised exception '%s'", e)
+        return {"error": f"Raised exception '{e}'"}, 500
+
+# (route template, pattern, handler); patterns capture the handler's positional arguments
+ROUTES = [
+    ("/years/<years>/regions", re.compile(r"^/years/([^/]+)/regions/?$"), get_year),
+    ("/regions/<region>/<eras>", re.compile(r"^/regions/([^/]+)/([^/]+)/?$"), get_region_eras),
+]
+
+async def _send_json(send, body, status, accept_encoding=None, coding=None):
+    """Send `body` as json compressed as the client accepts, or as is if it is already compressed in `coding`."""
+    if coding is None:
+        payload = (json.dumps(body, sort_keys=True, separators=(",", ":")) + "\n").encode("utf-8")
+        if len(payload) >= compress.MIN_BYTES:
+            coding = compress.negotiate(accept_encoding)
+            payload = compress.compress(payload, coding) if coding else payload
+    else:
+        payload = body
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode()),
+               (b"vary", b"Accept-Encoding")]
+    if coding:
+        headers.append((b"content-encoding", coding.encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": payload})
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await storage.close_async_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    """Serve the async routes and hand everything else to Flask."""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+
+    if scope["type"] == "http" and scope["method"] == "GET":
+        for template, pattern, handler in ROUTES:
+            match = pattern.match(scope["path"])
+            if match is None:
+                continue
+            start = time.perf_counter()
+            params = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            accept_encoding = dict(scope.get("headers", [])).get(b"accept-encoding", b"").decode("latin-1")
+            body, status, *coding = await handler(*match.groups(), params, accept_encoding)
+            await _send_json(send, body, status, accept_encoding, *coding)
+            api.request_latency.observe(time.perf_counter() - start, route=template, method="GET", status=status)
+            return
+
+    await flask_app(scope, receive, send)
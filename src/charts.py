@@ -0,0 +1,130 @@
+"""
+Synchronous rendering of small charts for the /charts route.
+
+A chart spec (plot type, year range, locations, indicators, animate) whose output is a
+single still image and whose estimated cost, frames x locations, is at most CHART_SYNC_MAX_COST
+is rendered inline by the API process with the worker's plotting code, once the client is
+admitted for that cost (see admission.py); cached charts are served without. Rendered charts
+are cached in the results database under chart:<digest of spec and dataset version> for
+CHART_CACHE_TTL seconds, so a reload of the dataset never serves a stale chart. Other
+specs, animated ones included, are queued as a regular job.
+"""
+import glob
+import hashlib
+import json
+import os
+import threading
+
+import dataset
+import locations
+import metrics
+from jobs import OUTPUT_FORMATS, estimate_cost, string_to_bool
+from log_config import get_logger
+from storage import LazyClient
+
+logger = get_logger(__name__)
+
+resdb = LazyClient("results")
+
+KEY_PREFIX = "chart:"
+PLOT_TYPES = ("line", "bar", "scatter")
+SYNC_MAX_COST = int(os.environ.get("CHART_SYNC_MAX_COST", 60))
+CACHE_TTL = int(os.environ.get("CHART_CACHE_TTL", 86400))
+
+_render_lock = threading.Lock() # matplotlib is not thread safe, render one chart at a time per process
+
+chart_requests = metrics.counter("wpp_chart_requests_total", "Chart requests by how they were served.",
+                                 ("plot_type", "outcome"))
+
+def parse_spec(plot_type, start_year, end_year, args) -> dict:
+    """Build a chart spec from the route and its query arguments; raises ValueError if unusable."""
+    if plot_type not in PLOT_TYPES:
+        raise ValueError(f"Invalid plot type. Choose one of {', '.join(PLOT_TYPES)}.")
+    names = args.get("names", "")
+    regions = sorted(set(locations.resolve(list(filter(None, names.split(",")))))) or ["World"]
+    spec = {"plot_type": plot_type, "start": start_year, "end": end_year, "locations": regions,
+            "query1": args.get("query1") or None, "query2": args.get("query2") or None,
+            "animate": string_to_bool(args.get("animate", "false")) and plot_type != "line",
+            "format": args.get("format", "png"), "dpi": args.get("dpi") or None}
+    variant = dataset.partition(args.get("variant")) # raises ValueError for unknown variants
+    if variant:
+        spec["variant"] = variant # only then, so charts of the default variant keep their cache keys
+    if plot_type == "scatter" and not spec["query2"]:
+        raise ValueError("Scatter plots need both query1 and query2.")
+    if spec["format"] not in OUTPUT_FORMATS:
+        raise ValueError(f"Format must be one of {', '.join(OUTPUT_FORMATS)}.")
+    if spec["dpi"] is not None:
+        spec["dpi"] = int(spec["dpi"]) if spec["dpi"].isdigit() else 0
+        if not 10 <= spec["dpi"] <= 600:
+            raise ValueError("Dpi must be a number from 10 to 600.")
+    return spec
+
+def output_field(spec):
+    """Return the results field of the single image the spec renders to, None if it renders several."""
+    if spec["animate"]:
+        return "gif"
+    if spec["plot_type"] == "line":
+        return "image"
+    if spec["start"] == spec["end"]:
+        return f"image_{spec['start']}"
+    return None
+
+def cost(spec) -> int:
+    """Estimated render cost: frames times locations."""
+    return estimate_cost(spec["plot_type"], spec["start"], spec["end"], len(spec["locations"]))
+
+def renders_inline(spec) -> bool:
+    return not spec["animate"] and output_field(spec) is not None and cost(spec) <= SYNC_MAX_COST
+
+def cache_key(spec, version) -> str:
+    digest = hashlib.sha256(json.dumps([spec, version], sort_keys=True).encode('utf-8')).hexdigest()
+    return f"{KEY_PREFIX}{digest[:32]}"
+
+def job_spec(spec) -> dict:
+    """The /jobs body that renders the same chart."""
+    job = {"start": str(spec["start"]), "end": str(spec["end"]), "location": ",".join(spec["locations"]),
+           "plot_type": spec["plot_type"], "query1": spec["query1"], "query2": spec["query2"],
+           "animate": str(spec["animate"]).lower(), "format": spec["format"], "dpi": spec["dpi"],
+           "variant": spec.get("variant")}
+    return {k: v for k, v in job.items() if v is not None}
+
+def cached_chart(spec) -> tuple:
+    """Return (image bytes or None on a cache miss, cache key, dataset version) of a chart."""
+    version = dataset.get_version()
+    key = cache_key(spec, version)
+    image = resdb.hget(key, output_field(spec))
+    if image is not None:
+        chart_requests.inc(plot_type=spec["plot_type"], outcome="cached")
+    return image, key, version
+
+def render_chart(spec, key, version):
+    """Render a chart missing from the cache and return its image, or None if there is no data for it."""
+    field = output_field(spec)
+    with _render_lock:
+        image = resdb.hget(key, field) # rendered by another request while this one waited
+        if image is None:
+            image = _render(spec, version, key, field)
+            chart_requests.inc(plot_type=spec["plot_type"], outcome="rendered")
+    return image
+
+def preload():
+    """Import the plotting modules now, e.g. in the server master process before it forks."""
+    import frames
+    import matplotlib.animation
+    import worker
+
+def _render(spec, version, key, field):
+    """Render a chart into its cache key; called holding _render_lock."""
+    import worker # matplotlib is only loaded by processes that actually render charts
+
+    job_data = {"start": spec["start"], "end": spec["end"], "location": ",".join(spec["locations"]),
+                "variant": spec.get("variant")}
+    try:
+        new_data = worker.manipulate_data(job_data, version)
+        worker.plot_data(new_data, key, spec["start"], spec["end"], spec["plot_type"], list(spec["locations"]),
+                         spec["query1"], spec["query2"], spec["animate"], worker.render_options(spec))
+        return resdb.hget(key, field)
+    finally:
+        resdb.expire(key, CACHE_TTL) # also what a failed render wrote, which retention leaves alone
+        for path in glob.glob(f"{glob.escape(key)}*.png") + glob.glob(f"{glob.escape(key)}.gif"):
+            os.remove(path)
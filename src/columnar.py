@@ -0,0 +1,145 @@
+"""
+Memory-mapped columnar copy of the dataset, shared through the page cache by every process on a node.
+
+When COLUMNAR_DIR is set (e.g. cache/columnar on the cache volume), every load also writes
+the default partition of the dataset (see dataset.py; other variants are always read from
+Redis) to a directory named after the content of the loaded version, rows sorted by year:
+    meta.json       row count, the [start, stop) rows of every year and the json columns
+    table.arrow     Arrow IPC file with one column per field (Location, Time, every indicator)
+
+Columns whose values are all strings, as loaded from the source files, are utf-8 string
+columns; any other column holds the json of each value. A field a row lacks is null.
+
+Readers memory-map the file without copying it, so a year is a slice of rows, a region
+filter is a vectorized comparison over the Location column of that slice, and dictionaries
+are only built for the rows kept. Only the pages a query touches are read, once per node.
+Processes that find no file for the current version read from Redis instead.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+DIRECTORY = os.environ.get("COLUMNAR_DIR", "")
+TABLE_FILE = "table.arrow"
+
+_lock = threading.Lock()
+_tables = {} # directory name -> open ColumnarFile
+
+def manifest_digest(manifest: dict) -> str:
+    """Name of the file of a dataset version, from its year -> blob hash manifest."""
+    return hashlib.sha256(json.dumps(sorted(manifest.items())).encode('utf-8')).hexdigest()[:32]
+
+class ColumnarFile:
+    """Read-only view of one directory written by `write`."""
+
+    def __init__(self, path):
+        import pyarrow as pa # only processes that use a columnar file pay for loading pyarrow
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.years = {year: tuple(bounds) for year, bounds in meta["years"].items()}
+        self.json_columns = set(meta["json_columns"])
+        self.table = pa.ipc.open_file(pa.memory_map(os.path.join(path, TABLE_FILE))).read_all()
+
+    def read(self, year: str, regions=None):
+        """Return the rows of `year` as dictionaries, only those of `regions` if given, or None."""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        bounds = self.years.get(year)
+        if bounds is None:
+            return None
+        start, stop = bounds
+        rows = self.table.slice(start, stop - start)
+        if regions and "Location" not in self.json_columns:
+            if "Location" not in rows.column_names:
+                return []
+            rows = rows.filter(pc.is_in(rows["Location"], value_set=pa.array(list(regions), pa.string())))
+        names = rows.column_names
+        columns = [rows.column(name).to_pylist() for name in names]
+        result = [{name: value for name, value in zip(names, values) if value is not None} for values in zip(*columns)]
+        for row in result if self.json_columns else ():
+            for name in self.json_columns.intersection(row):
+                row[name] = json.loads(row[name])
+        return result
+
+def open_version(manifest: dict):
+    """Return the columnar file of a dataset version, or None if this node has none."""
+    if not DIRECTORY or not manifest:
+        return None
+    name = manifest_digest(manifest)
+    table = _tables.get(name)
+    if table is None:
+        path = os.path.join(DIRECTORY, name)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            return None
+        with _lock:
+            table = _tables.setdefault(name, ColumnarFile(path))
+    return table
+
+def _columns(rows) -> tuple:
+    """The columns of `rows` by field, in order of first appearance, and the fields stored as json."""
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    columns, json_columns = {}, []
+    for name in names:
+        values = [row.get(name) for row in rows]
+        if any(name in row and not isinstance(row[name], str) for row in rows): # e.g. numbers or explicit nulls
+            values = [None if name not in row else json.dumps(row[name]) for row in rows]
+            json_columns.append(name)
+        columns[name] = values
+    return columns, json_columns
+
+def write(data: dict, manifest: dict, keep: int = 2):
+    """
+    Write the decoded dataset (year -> rows) of the version described by `manifest`, then
+    delete all but the `keep` most recent files. Does nothing if the file already exists.
+    """
+    if not DIRECTORY or not data:
+        return None
+    name = manifest_digest(manifest)
+    path = os.path.join(DIRECTORY, name)
+    if os.path.exists(path):
+        return path
+
+    import pyarrow as pa
+    years = sorted(data, key=int)
+    bounds = {}
+    rows = []
+    for year in years:
+        bounds[str(year)] = [len(rows), len(rows) + len(data[year])]
+        rows.extend(data[year])
+    columns, json_columns = _columns(rows)
+    table = pa.table({name: pa.array(values, pa.string()) for name, values in columns.items()})
+
+    os.makedirs(DIRECTORY, exist_ok=True)
+    staging = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(staging, exist_ok=True)
+    try:
+        with pa.OSFile(os.path.join(staging, TABLE_FILE), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        with open(os.path.join(staging, "meta.json"), "w") as f:
+            json.dump({"rows": len(rows), "years": bounds, "json_columns": json_columns}, f)
+        os.rename(staging, path) # readers only ever see a complete directory
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        if not os.path.exists(path):
+            raise
+    logger.info("Wrote columnar dataset %s (%d rows, %d columns)", path, len(rows), len(columns))
+    _prune(keep)
+    return path
+
+def _prune(keep):
+    """Delete all but the `keep` most recently written files; mapped pages stay valid until unmapped."""
+    entries = [os.path.join(DIRECTORY, entry) for entry in os.listdir(DIRECTORY) if ".tmp-" not in entry]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for path in entries[max(keep, 1):]:
+        shutil.rmtree(path, ignore_errors=True)
+        with _lock:
+            _tables.pop(os.path.basename(path), None)
+        logger.debug("Deleted columnar dataset %s", path)
@@ -0,0 +1,144 @@
+"""
+Content negotiation and compression of API responses.
+
+`negotiate` picks the coding of a response from the client's Accept-Encoding among the
+codings this process supports: zstd and br when the zstandard and brotli packages are
+installed, gzip always. The API compresses responses of COMPRESS_MIN_BYTES or more whose
+type is worth compressing.
+
+Year payloads are also compressed once when they are stored (see `dataset.packed_years`),
+in the codings of PACKED, so a read of whole years is answered by joining the stored
+payloads with a few tiny ones for the brackets and commas, without compressing anything
+per request. zstd payloads are frames, which decode as one stream when concatenated. Some
+gzip clients only decode the first member of a gzip stream, so gzip payloads are stored as
+raw deflate streams ended with a sync flush, followed by the CRC-32 and length of their
+data; `join` puts them under a single gzip header and trailer. Brotli streams cannot be
+concatenated, so brotli is only used per request.
+"""
+import functools
+import gzip
+import os
+import struct
+import zlib
+
+MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+LEVELS = {"gzip": 6, "br": 5, "zstd": 10} # per request; stored payloads are compressed harder
+PACKED_LEVELS = {"gzip": 9, "zstd": 12}
+MIMETYPES = ("application/json", "text/csv", "text/plain", "text/html", "image/svg+xml")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CODINGS = tuple(coding for coding, module in (("zstd", zstandard), ("br", brotli), ("gzip", gzip)) if module)
+PACKED = tuple(coding for coding in CODINGS if coding in PACKED_LEVELS)
+PACKED_FORMATS = {"gzip": "deflate", "zstd": "zstd"} # name of the stored payloads of each coding, in their keys
+
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff" # no flags, no mtime, unknown OS
+DEFLATE_END = b"\x03\x00" # an empty final block
+CRC_POLY = 0xEDB88320
+
+def negotiate(accept_encoding, codings=CODINGS):
+    """
+    Return the coding of `codings` the client accepts with the highest quality, preferring
+    the earlier of `codings` between equals, or None if it accepts none of them.
+    """
+    from werkzeug.http import parse_accept_header # only the api negotiates, workers import this module through dataset
+    accepted = {value.lower(): quality for value, quality in parse_accept_header(accept_encoding or "")}
+    best, best_quality = None, 0
+    for coding in codings:
+        quality = accepted.get(coding, accepted.get("*", 0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+def compress(data: bytes, coding, level=None) -> bytes:
+    if coding == "gzip":
+        return gzip.compress(data, compresslevel=level or LEVELS["gzip"], mtime=0)
+    if coding == "zstd":
+        return zstandard.ZstdCompressor(level=level or LEVELS["zstd"]).compress(data)
+    if coding == "br":
+        return brotli.compress(data, quality=level or LEVELS["br"])
+    raise ValueError(f"Unsupported coding {coding}.")
+
+def _deflate(data: bytes, level) -> bytes:
+    """A raw deflate stream of `data` that more streams may follow, then its CRC-32 and length."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    stream = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return stream + struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+
+def _packed(data: bytes, coding, level=None) -> bytes:
+    if coding == "gzip":
+        return _deflate(data, level or LEVELS["gzip"])
+    return compress(data, coding, level)
+
+def pack(blob: str) -> dict:
+    """The rows of a year's json list without its brackets, packed in every coding of PACKED."""
+    inner = blob.strip()[1:-1].strip().encode('utf-8')
+    return {coding: _packed(inner, coding, PACKED_LEVELS[coding]) if inner else b"" for coding in PACKED}
+
+@functools.lru_cache(maxsize=None)
+def _literal(text, coding) -> bytes:
+    return _packed(text.encode('utf-8'), coding)
+
+def _multiply(a, b) -> int:
+    """Product of two polynomials modulo the CRC-32 polynomial, in its bit-reversed form."""
+    product, bit = 0, 1 << 31
+    while a:
+        if a & bit:
+            product ^= b
+            a ^= bit
+        bit >>= 1
+        b = (b >> 1) ^ CRC_POLY if b & 1 else b >> 1
+    return product
+
+_POWERS = [1 << 30] # x^(2^k) modulo the polynomial, which repeat from k = 32 on
+for _ in range(31):
+    _POWERS.append(_multiply(_POWERS[-1], _POWERS[-1]))
+
+@functools.lru_cache(maxsize=4096)
+def _shift(length) -> int:
+    """x^(8 * length) modulo the polynomial: multiplying a CRC by it appends `length` zero bytes."""
+    power, k = 1 << 31, 3
+    while length:
+        if length & 1:
+            power = _multiply(_POWERS[k & 31], power)
+        length >>= 1
+        k += 1
+    return power
+
+def _gzip(packed) -> bytes:
+    """One gzip member of the data of `packed` deflate payloads, in order."""
+    streams, crc, size = [GZIP_HEADER], 0, 0
+    for payload in packed:
+        part_crc, part_size = struct.unpack("<II", payload[-8:])
+        crc = _multiply(_shift(part_size), crc) ^ part_crc # the CRC-32 of both parts
+        size += part_size
+        streams.append(payload[:-8])
+    return b"".join(streams + [DEFLATE_END, struct.pack("<II", crc, size & 0xFFFFFFFF)])
+
+def join(packed, coding, nested=False) -> bytes:
+    """
+    Join the packed payloads of several years into the compressed json of one list of
+    their rows, or with `nested` of one list per year, as /data returns them.
+    """
+    if nested:
+        parts = []
+        for index, payload in enumerate(packed):
+            parts += [_literal("[[" if index == 0 else "],[", coding), payload]
+        parts.append(_literal("]]" if parts else "[]", coding))
+    else:
+        parts = [_literal("[", coding)]
+        for payload in (payload for payload in packed if payload): # years without rows add nothing
+            if len(parts) > 1:
+                parts.append(_literal(",", coding))
+            parts.append(payload)
+        parts.append(_literal("]", coding))
+    if coding == "gzip":
+        return _gzip(part for part in parts if part)
+    return b"".join(parts)
@@ -0,0 +1,547 @@
+"""
+Versioned storage of the WPP dataset in the data database.
+
+Every load writes a new dataset version and then switches readers to it with one atomic
+pointer flip, so a load or a delete never exposes a partially written dataset:
+    blob:<sha256>            json list of the rows of one year, stored once per content
+    packed:<format>:<sha256> the rows of a blob compressed for responses (deflate or zstd), see compress.py
+    manifest:<version>       hash of year -> sha256 of its blob, never modified once written
+    manifest:<version>:<partition>  the same for every other partition of the version
+    partitions:<version>     hash of partition -> json of its release, variant and years
+    locations:<version>      json list of the locations of a version with their ISO codes and LocID
+    Dataset-Version          version readers use, 0 or missing when the dataset is empty
+    Dataset-Version-Counter  last version number handed out
+    Dataset-Versions         sorted set of version -> creation time
+    Dataset-Pins             hash of "<version>:<owner>" -> time, versions in use by jobs
+    Source-Fingerprint       fingerprint of the source files of the current version
+    Last-Modified            year of the last load
+
+A version holds one partition per (release, variant) of the source files, named
+"<release>:<variant>" (WPP2024:Medium, WPP2024:High, ...). Reads without a variant use the
+default partition, stored under the plain manifest:<version> as before partitions existed,
+so they cost the same whatever else is loaded; `partition` maps a variant argument to the
+partition it selects. A load only writes blobs for years whose content changed. Old versions are kept while
+they are among the last DATASET_RETAIN versions or pinned by an in-flight job
+(pins older than DATASET_PIN_TTL seconds are considered abandoned), then garbage
+collected together with the blobs no kept version references.
+
+When COLUMNAR_DIR is set, reads are served from the memory-mapped file of the version
+(see columnar.py), written by the load or, on other nodes, from Redis on first use.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import redis
+
+import columnar
+import compress
+from log_config import get_logger
+from storage import LazyClient
+
+logger = get_logger(__name__)
+
+rd = LazyClient("data")
+
+BLOB_PREFIX = "blob:"
+PACKED_PREFIX = "packed:"
+MANIFEST_PREFIX = "manifest:"
+LOCATIONS_PREFIX = "locations:"
+PARTITIONS_PREFIX = "partitions:"
+VERSION_KEY = "Dataset-Version"
+COUNTER_KEY = "Dataset-Version-Counter"
+VERSIONS_KEY = "Dataset-Versions"
+PINS_KEY = "Dataset-Pins"
+LOCK_KEY = "Dataset-Lock"
+LAST_MODIFIED = "Last-Modified"
+FINGERPRINT_KEY = "Source-Fingerprint"
+LEGACY_HASHES_KEY = "Year-Hashes" # years were stored under bare year keys before versioning
+
+RETAIN = int(os.environ.get("DATASET_RETAIN", 2))
+PIN_TTL = int(os.environ.get("DATASET_PIN_TTL", 3600))
+LOCK_TIMEOUT = int(os.environ.get("DATASET_LOCK_TIMEOUT", 600))
+
+LOCATION_FIELDS = ("Location", "ISO3_code", "ISO2_code", "LocID") # identifiers of a location, see locations.py
+
+_manifests = {} # version, or (version, partition), -> {year: sha256}, safe to cache since manifests never change
+_partitions = {} # version -> {partition: description}, see `get_partitions`
+_materializing = set() # versions whose columnar file this process started writing
+
+@contextmanager
+def _locked():
+    """Hold the dataset lock, so loads and garbage collections never interleave."""
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not rd.set(LOCK_KEY, token, nx=True, ex=LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for the dataset lock")
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        with rd.pipeline() as pipe:
+            try:
+                pipe.watch(LOCK_KEY)
+                if pipe.get(LOCK_KEY) == token.encode('utf-8'):
+                    pipe.multi()
+                    pipe.delete(LOCK_KEY)
+                    pipe.execute()
+            except redis.WatchError:
+                pass # the lock expired and was taken by someone else
+
+def file_fingerprint(path) -> dict:
+    """Fingerprint a local source file by content hash, size and modification time."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    stat = os.stat(path)
+    return {"sha256": digest.hexdigest(), "size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+def http_fingerprint(headers) -> dict:
+    """Fingerprint a remote source file from the headers of a HEAD response."""
+    fingerprint = {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"),
+                   "size": headers.get("Content-Length")}
+    return fingerprint if fingerprint["etag"] or fingerprint["last_modified"] else None
+
+def stored_fingerprint():
+    """Return the fingerprint of the source the current version was loaded from, if any."""
+    raw = rd.get(FINGERPRINT_KEY)
+    return json.loads(raw) if raw else None
+
+def get_version() -> int:
+    """Return the current dataset version, 0 if the dataset is empty."""
+    return int(rd.get(VERSION_KEY) or 0)
+
+def _decode_manifest(raw) -> dict:
+    return {k.decode('utf-8'): v.decode('utf-8') for k, v in raw.items()}
+
+def _manifest_key(version, partition=None) -> str:
+    return f"{MANIFEST_PREFIX}{version}" if partition is None else f"{MANIFEST_PREFIX}{version}:{partition}"
+
+def _cache_key(version, partition=None):
+    return version if partition is None else (version, partition)
+
+def get_manifest(version: int, partition=None) -> dict:
+    """Return the year -> blob hash mapping of a dataset version (of its default partition unless one is given)."""
+    if not version:
+        return {}
+    manifest = _manifests.get(_cache_key(version, partition))
+    if manifest is None:
+        manifest = _decode_manifest(rd.hgetall(_manifest_key(version, partition)))
+        if manifest:
+            _manifests[_cache_key(version, partition)] = manifest
+    return manifest
+
+def list_years(version=None, partition=None) -> list:
+    """Return the sorted year keys of a dataset version (the current one by default)."""
+    return sorted(get_manifest(get_version() if version is None else version, partition))
+
+def _decode_partitions(raw) -> dict:
+    return {name.decode('utf-8'): json.loads(value) for name, value in raw.items()}
+
+def get_partitions(version=None) -> dict:
+    """
+    Return the partitions of a dataset version (the current one by default) by name, each
+    with its release, variant, first and last year and whether it is the default. Empty for
+    versions loaded without partition names.
+    """
+    version = get_version() if version is None else int(version)
+    if not version:
+        return {}
+    if version not in _partitions:
+        _partitions[version] = _decode_partitions(rd.hgetall(f"{PARTITIONS_PREFIX}{version}"))
+    return _partitions[version]
+
+async def aget_partitions(client, version) -> dict:
+    """Async version of `get_partitions` for an asyncio Redis client."""
+    version = int(version)
+    if not version:
+        return {}
+    if version not in _partitions:
+        _partitions[version] = _decode_partitions(await client.hgetall(f"{PARTITIONS_PREFIX}{version}"))
+    return _partitions[version]
+
+def variant_key(variant: str) -> str:
+    """A release or variant name as ingest stores it (see api.decode_data), lowercased for comparisons."""
+    return re.sub(r"[,\s]+", "_", variant.strip()).lower()
+
+def select_partition(partitions: dict, variant):
+    """
+    Return the partition of `partitions` a variant argument selects, None for the default
+    one. A variant is a partition name (WPP2022:High) or the variant alone (High), which
+    prefers the release of the default partition. Raises ValueError for unknown variants.
+    """
+    if not variant:
+        return None
+    wanted = variant_key(variant)
+    default = next((info for info in partitions.values() if info.get("default")), {})
+    matches = sorted((info.get("release") != default.get("release"), name) for name, info in partitions.items()
+                     if wanted in (variant_key(name), variant_key(info["variant"])))
+    if not matches:
+        known = ", ".join(sorted(partitions)) or "none"
+        raise ValueError(f"Unknown variant '{variant}', the dataset has: {known}. See /variants.")
+    name = matches[0][1]
+    return None if partitions[name].get("default") else name
+
+def partition(variant=None, version=None):
+    """Return the partition a variant argument selects in a dataset version, see `select_partition`."""
+    return select_partition(get_partitions(version), variant) if variant else None
+
+async def apartition(client, variant, version):
+    """Async version of `partition` for an asyncio Redis client."""
+    return select_partition(await aget_partitions(client, version), variant) if variant else None
+
+def _blob_keys(manifest, year_keys):
+    return [f"{BLOB_PREFIX}{manifest[year]}" if year in manifest else None for year in year_keys]
+
+def _fill(blob_keys, values):
+    """Spread the values fetched for the existing blob keys back over every requested year."""
+    values = iter(values)
+    return [next(values) if key else None for key in blob_keys]
+
+def get_years(year_keys, version=None, partition=None, _retry=True) -> list:
+    """
+    Return the raw json of each year in year_keys from one dataset version (the current one
+    by default) and partition, None for years it does not contain. All years are fetched
+    with one MGET.
+    """
+    version = get_version() if version is None else int(version)
+    manifest = get_manifest(version, partition)
+    blob_keys = _blob_keys(manifest, year_keys)
+    existing = [key for key in blob_keys if key]
+    values = rd.mget(existing) if existing else []
+    if _retry and None in values and _manifests.pop(_cache_key(version, partition), None) is not None:
+        # the cached manifest outlived its blobs (the database was flushed), read it again
+        _partitions.pop(version, None)
+        return get_years(year_keys, version, partition, _retry=False)
+    return _fill(blob_keys, values)
+
+def _packed_keys(manifest, year_keys, coding):
+    return [f"{PACKED_PREFIX}{compress.PACKED_FORMATS[coding]}:{manifest[year]}" for year in year_keys]
+
+def _pack_missing(manifest, year_keys, coding, values, blobs) -> dict:
+    """Compress the blobs of the years whose packed payload is missing; return them by packed key."""
+    missing = {}
+    for year, value, blob in zip(year_keys, values, blobs):
+        if value is None and blob is not None:
+            missing[f"{PACKED_PREFIX}{compress.PACKED_FORMATS[coding]}:{manifest[year]}"] = compress.pack(blob.decode('utf-8'))[coding]
+    return missing
+
+def packed_years(year_keys, version, coding, partition=None) -> list:
+    """
+    Return the payload of each year in year_keys (all held by the dataset version and
+    partition) compressed in `coding`, see `compress.join`. Payloads stored before a year was
+    packed are packed and stored on first use. None if a year's blob is gone.
+    """
+    manifest = get_manifest(version, partition)
+    keys = _packed_keys(manifest, year_keys, coding)
+    values = rd.mget(keys)
+    if None in values:
+        blobs = rd.mget(_blob_keys(manifest, year_keys))
+        missing = _pack_missing(manifest, year_keys, coding, values, blobs)
+        if missing:
+            rd.mset(missing)
+        values = [value if value is not None else missing.get(key) for key, value in zip(keys, values)]
+    return None if None in values else values
+
+async def apacked_years(client, year_keys, version, coding, partition=None) -> list:
+    """Async version of `packed_years` for an asyncio Redis client."""
+    manifest = await aget_manifest(client, version, partition)
+    keys = _packed_keys(manifest, year_keys, coding)
+    values = await client.mget(keys)
+    if None in values:
+        blobs = await client.mget(_blob_keys(manifest, year_keys))
+        missing = _pack_missing(manifest, year_keys, coding, values, blobs)
+        if missing:
+            await client.mset(missing)
+        values = [value if value is not None else missing.get(key) for key, value in zip(keys, values)]
+    return None if None in values else values
+
+async def aget_manifest(client, version: int, partition=None) -> dict:
+    """Async version of `get_manifest` for an asyncio Redis client."""
+    if not version:
+        return {}
+    manifest = _manifests.get(_cache_key(version, partition))
+    if manifest is None:
+        manifest = _decode_manifest(await client.hgetall(_manifest_key(version, partition)))
+        if manifest:
+            _manifests[_cache_key(version, partition)] = manifest
+    return manifest
+
+async def aget_years(client, year_keys, version=None, partition=None, _retry=True) -> list:
+    """Async version of `get_years` for an asyncio Redis client."""
+    if version is None:
+        version = int(await client.get(VERSION_KEY) or 0)
+    version = int(version)
+    manifest = await aget_manifest(client, version, partition)
+    blob_keys = _blob_keys(manifest, year_keys)
+    existing = [key for key in blob_keys if key]
+    values = await client.mget(existing) if existing else []
+    if _retry and None in values and _manifests.pop(_cache_key(version, partition), None) is not None:
+        _partitions.pop(version, None)
+        return await aget_years(client, year_keys, version, partition, _retry=False)
+    return _fill(blob_keys, values)
+
+def _materialize(version, manifest):
+    """Write the columnar file of a version loaded by another node, from Redis."""
+    try:
+        years = sorted(manifest)
+        data = {year: json.loads(raw) for year, raw in zip(years, get_years(years, version)) if raw is not None}
+        if len(data) == len(years):
+            columnar.write(data, manifest, keep=RETAIN)
+    except Exception as e:
+        logger.warning("Could not write the columnar file of version %s: %s", version, e)
+
+def _open_columnar(version):
+    """Return the columnar file of a version, starting to write it in the background if missing."""
+    manifest = get_manifest(version)
+    table = columnar.open_version(manifest)
+    if table is None and columnar.DIRECTORY and manifest and version not in _materializing:
+        _materializing.add(version)
+        threading.Thread(target=_materialize, args=(version, manifest), daemon=True).start()
+    return table
+
+def read_years(year_keys, version=None, regions=None, partition=None) -> list:
+    """
+    Return the decoded rows of each year in year_keys from one dataset version and partition,
+    None for years it does not contain. Reads of the default partition use the memory-mapped
+    columnar file when this node has one, in which case only the rows of `regions` are
+    returned if given; callers still filter.
+    """
+    version = get_version() if version is None else int(version)
+    table = _open_columnar(version) if partition is None else None
+    if table is not None:
+        return [table.read(year, regions) for year in year_keys]
+    return [json.loads(raw) if raw is not None else None for raw in get_years(year_keys, version, partition)]
+
+def encode_locations(years_data) -> str:
+    """
+    Serialize the identifiers (LOCATION_FIELDS) of every location in the rows of the given
+    years, as stored under locations:<version>, sorted by Location.
+    """
+    locations = {}
+    for year_data in years_data:
+        for row in year_data or []:
+            if row.get("Location") and row["Location"] not in locations:
+                locations[row["Location"]] = {field: row[field] for field in LOCATION_FIELDS if row.get(field)}
+    return json.dumps([locations[name] for name in sorted(locations)])
+
+def location_table(version=None) -> list:
+    """
+    Return the locations of a dataset version (the current one by default) as dictionaries
+    of their identifiers. Versions loaded before the table was stored have it built from
+    their rows and stored on first use.
+    """
+    version = get_version() if version is None else int(version)
+    if not version:
+        return []
+    raw = rd.get(f"{LOCATIONS_PREFIX}{version}")
+    if raw is None:
+        years = list_years(version)
+        raw = encode_locations(read_years(years, version))
+        if years:
+            rd.set(f"{LOCATIONS_PREFIX}{version}", raw)
+    return json.loads(raw)
+
+def list_locations(version=None) -> list:
+    """Return the sorted locations of a dataset version (the current one by default)."""
+    return [entry["Location"] for entry in location_table(version)]
+
+async def aread_years(client, year_keys, version=None, regions=None, partition=None) -> list:
+    """Async version of `read_years` for an asyncio Redis client."""
+    if version is None:
+        version = int(await client.get(VERSION_KEY) or 0)
+    version = int(version)
+    table = _open_columnar(version) if partition is None and version in _manifests else None
+    if table is not None:
+        return [table.read(year, regions) for year in year_keys]
+    raws = await aget_years(client, year_keys, version, partition)
+    return [json.loads(raw) if raw is not None else None for raw in raws]
+
+async def alocation_table(client, version) -> list:
+    """Async version of `location_table` for an asyncio Redis client."""
+    if not version:
+        return []
+    raw = await client.get(f"{LOCATIONS_PREFIX}{version}")
+    if raw is None:
+        years = sorted(await aget_manifest(client, version))
+        raw = encode_locations(await aread_years(client, years, version))
+        if years:
+            await client.set(f"{LOCATIONS_PREFIX}{version}", raw)
+    return json.loads(raw)
+
+def encode_years(data: dict) -> dict:
+    """Serialize every year of the decoded dataset to the json stored in Redis."""
+    return {str(year): json.dumps(entries) for year, entries in data.items()}
+
+def year_hash(blob: str) -> str:
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+def _flip(version, fingerprint=None):
+    """Point readers at `version` in one transaction."""
+    pipe = rd.pipeline(transaction=True)
+    pipe.set(VERSION_KEY, version)
+    if version:
+        pipe.zadd(VERSIONS_KEY, {version: time.time()})
+    if fingerprint:
+        pipe.set(FINGERPRINT_KEY, json.dumps(fingerprint))
+    else:
+        pipe.delete(FINGERPRINT_KEY)
+    pipe.set(LAST_MODIFIED, datetime.now().year)
+    pipe.execute()
+
+def describe_partition(name, manifest, default=False) -> dict:
+    """The entry of a partition in partitions:<version>."""
+    release, _, variant = name.rpartition(":")
+    years = sorted(manifest, key=int)
+    return {"release": release, "variant": variant, "years": [years[0], years[-1]] if years else None,
+            "default": default}
+
+def apply_update(data: dict, fingerprint=None, partitions=None, default=None) -> dict:
+    """
+    Store the decoded dataset as a new version and switch readers to it. `data` is the
+    default partition, named `default` if given, and `partitions` the others by name, each
+    {year: rows}. Only blobs of years whose content changed are written. Returns a summary
+    of the changes over every partition.
+    """
+    partitions = {None: data, **{name: rows for name, rows in (partitions or {}).items() if name != default}}
+    blobs = {name: encode_years(rows) for name, rows in partitions.items()}
+    manifests = {name: {year: year_hash(blob) for year, blob in years.items()} for name, years in blobs.items()}
+    new_manifest = manifests[None]
+    catalog = {name: describe_partition(name, manifest) for name, manifest in manifests.items() if name is not None}
+    if default is not None and new_manifest:
+        catalog[default] = describe_partition(default, new_manifest, default=True)
+
+    with _locked():
+        current = get_version()
+        changed, removed = {}, 0
+        for name, manifest in manifests.items():
+            old_manifest = get_manifest(current, name)
+            changed[name] = [year for year, digest in manifest.items() if old_manifest.get(year) != digest]
+            removed += sum(1 for year in old_manifest if year not in manifest)
+
+        version = current
+        old_catalog = _decode_partitions(rd.hgetall(f"{PARTITIONS_PREFIX}{current}")) if current else {}
+        if any(changed.values()) or removed or not current or catalog != old_catalog:
+            version = rd.incr(COUNTER_KEY)
+            # nothing references the new blobs and manifests until the flip, so they need no transaction
+            pipe = rd.pipeline(transaction=False)
+            written = set()
+            for name, years in changed.items():
+                for year in years:
+                    digest = manifests[name][year]
+                    if digest in written:
+                        continue # partitions share the years whose rows are the same
+                    written.add(digest)
+                    pipe.set(f"{BLOB_PREFIX}{digest}", blobs[name][year])
+                    for coding, payload in compress.pack(blobs[name][year]).items():
+                        pipe.set(f"{PACKED_PREFIX}{compress.PACKED_FORMATS[coding]}:{digest}", payload)
+            for name, manifest in manifests.items():
+                if manifest:
+                    pipe.hset(_manifest_key(version, name), mapping=manifest)
+                    _manifests[_cache_key(version, name)] = manifest
+            if new_manifest:
+                pipe.set(f"{LOCATIONS_PREFIX}{version}", encode_locations(data.values()))
+            if catalog:
+                pipe.hset(f"{PARTITIONS_PREFIX}{version}", mapping={name: json.dumps(info) for name, info in catalog.items()})
+            pipe.execute()
+            _partitions[version] = catalog
+        _flip(version if new_manifest else 0, fingerprint)
+        _collect_garbage(RETAIN)
+
+    columnar.write(data, new_manifest, keep=RETAIN)
+    total = sum(len(manifest) for manifest in manifests.values())
+    summary = {"changed": sum(len(years) for years in changed.values()), "removed": removed,
+               "unchanged": total - sum(len(years) for years in changed.values()), "version": version}
+    logger.info("Dataset update applied: %s", summary)
+    return summary
+
+def clear() -> dict:
+    """Switch readers to an empty dataset and delete every version no job is still reading."""
+    with _locked():
+        _flip(0)
+        return _collect_garbage(0)
+
+def pin(owner: str) -> int:
+    """Keep the current version from being garbage collected while `owner` reads it."""
+    version = get_version()
+    if version:
+        rd.hset(PINS_KEY, f"{version}:{owner}", time.time())
+    return version
+
+def unpin(version: int, owner: str):
+    """Release a version pinned with `pin`."""
+    if version:
+        rd.hdel(PINS_KEY, f"{version}:{owner}")
+
+def _pinned_versions() -> set:
+    """Return the versions pinned by live owners, dropping pins older than PIN_TTL."""
+    pinned = set()
+    stale = []
+    now = time.time()
+    for field, pinned_at in rd.hgetall(PINS_KEY).items():
+        if now - float(pinned_at) > PIN_TTL:
+            stale.append(field)
+        else:
+            pinned.add(int(field.decode('utf-8').split(':', 1)[0]))
+    if stale:
+        rd.hdel(PINS_KEY, *stale)
+    return pinned
+
+def collect_garbage(retain=RETAIN) -> dict:
+    """Delete versions other than the current one, the last `retain` and pinned ones."""
+    with _locked():
+        return _collect_garbage(retain)
+
+def _partition_names(version) -> list:
+    """None for the default partition, then the name of every other partition of a version, read without the cache."""
+    catalog = _decode_partitions(rd.hgetall(f"{PARTITIONS_PREFIX}{version}"))
+    return [None, *(name for name, info in catalog.items() if not info.get("default"))]
+
+def _collect_garbage(retain) -> dict:
+    current = get_version()
+    versions = [int(v) for v in rd.zrange(VERSIONS_KEY, 0, -1)]
+    keep = set(versions[-retain:]) if retain > 0 else set()
+    keep |= _pinned_versions()
+    if current:
+        keep.add(current)
+    dropped = [v for v in versions if v not in keep]
+
+    names = {version: _partition_names(version) for version in keep | set(dropped)}
+    referenced = set() # read without the cache, which may predate a flush of the database
+    for version in keep:
+        for name in names[version]:
+            referenced.update(_decode_manifest(rd.hgetall(_manifest_key(version, name))).values())
+    unused_blobs = [key for key in rd.scan_iter(match=f"{BLOB_PREFIX}*", count=1000)
+                    if key.decode('utf-8')[len(BLOB_PREFIX):] not in referenced]
+    unused_packed = [key for key in rd.scan_iter(match=f"{PACKED_PREFIX}*", count=1000)
+                     if key.decode('utf-8').rsplit(":", 1)[1] not in referenced]
+    legacy = [key for key in rd.scan_iter(count=1000) if key.decode('utf-8').isdigit()]
+    if rd.exists(LEGACY_HASHES_KEY):
+        legacy.append(LEGACY_HASHES_KEY)
+
+    pipe = rd.pipeline(transaction=False)
+    for version in dropped:
+        pipe.unlink(*(_manifest_key(version, name) for name in names[version]),
+                    f"{LOCATIONS_PREFIX}{version}", f"{PARTITIONS_PREFIX}{version}")
+        for name in names[version]:
+            _manifests.pop(_cache_key(version, name), None)
+        _partitions.pop(version, None)
+    if dropped:
+        pipe.zrem(VERSIONS_KEY, *dropped)
+    unused = unused_blobs + unused_packed + legacy
+    for start in range(0, len(unused), 500):
+        pipe.unlink(*unused[start:start + 500])
+    pipe.execute()
+
+    summary = {"versions": len(dropped), "blobs": len(unused_blobs), "legacy_keys": len(legacy)}
+    if dropped or unused_blobs or legacy:
+        logger.info("Dataset garbage collected: %s", summary)
+    return summary
@@ -0,0 +1,119 @@
+"""
+Tabular exports for export jobs.
+
+An export job reads a year, location and indicator slice through the query layer and
+writes it as csv, parquet or arrow (IPC stream) without rendering anything. The file is
+encoded in chunks of EXPORT_CHUNK_ROWS rows, each stored in the job's results hash as
+export_<n> as soon as it is encoded, and `/download/<jobid>` streams the chunks back in
+order. Parquet and arrow need pyarrow, which is only imported by workers that write them.
+"""
+import csv
+import io
+import os
+
+from query import KEY_FIELDS
+
+FORMATS = ("csv", "parquet", "arrow")
+MIMETYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet",
+             "arrow": "application/vnd.apache.arrow.stream"}
+FIELD_PREFIX = "export_"
+CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 5000))
+
+def chunk_field(index: int) -> str:
+    return f"{FIELD_PREFIX}{index}"
+
+def columns(rows, fields=None) -> list:
+    """Location, Time and the requested fields, otherwise every field of the rows in order of first appearance."""
+    if fields:
+        return list(dict.fromkeys([*KEY_FIELDS, *fields]))
+    return list(dict.fromkeys(field for row in rows for field in row))
+
+def encode(rows, fmt, names, chunk_rows=CHUNK_ROWS):
+    """Yield the file of `rows` in format `fmt` as consecutive chunks of bytes."""
+    if fmt == "csv":
+        return _csv_chunks(rows, names, chunk_rows)
+    if fmt in ("parquet", "arrow"):
+        return _arrow_chunks(rows, fmt, names, chunk_rows)
+    raise ValueError(f"Format must be one of {', '.join(FORMATS)}.")
+
+def _csv_chunks(rows, names, chunk_rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=names, extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    for start in range(0, len(rows), chunk_rows):
+        writer.writerows(rows[start:start + chunk_rows])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def _is_number(value) -> bool:
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def _schema(pa, rows, names):
+    """Indicator columns whose values all parse as numbers become float64, the rest strings."""
+    fields = []
+    for name in names:
+        values = [row.get(name) for row in rows if row.get(name) not in (None, "")]
+        numeric = name not in KEY_FIELDS and bool(values) and all(_is_number(value) for value in values)
+        fields.append(pa.field(name, pa.float64() if numeric else pa.string()))
+    return pa.schema(fields)
+
+def _column(field, rows):
+    values = [row.get(field.name) for row in rows]
+    if field.type == "double":
+        return [float(value) if value not in (None, "") else None for value in values]
+    return [None if value is None else str(value) for value in values]
+
+class _Sink:
+    """Write-only file object that hands out what was written since it was last drained."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def _arrow_chunks(rows, fmt, names, chunk_rows):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError(f"Exporting {fmt} needs pyarrow, which is not installed.")
+    schema = _schema(pa, rows, names)
+    sink = _Sink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    for start in range(0, len(rows), chunk_rows):
+        batch = rows[start:start + chunk_rows]
+        writer.write_batch(pa.record_batch([_column(field, batch) for field in schema], schema=schema))
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.drain()
@@ -0,0 +1,92 @@
+"""
+Cache of rendered plot frames, shared by every job.
+
+The static frames of bar and scatter jobs are stored in the results database under
+frame:<digest> of everything the frame shows (see `frames.FrameRenderer.state`: plot type,
+indicators, locations, axis limits, the year and its values) and of the output options,
+so a job showing frames an earlier job rendered, with the same axis limits, copies them
+instead of rendering them. The digest covers the values rather than the dataset version or variant,
+so frames stay valid across reloads that do not change them.
+
+The cache is bounded by FRAME_CACHE_BYTES (256 MiB, 0 turns it off). Its bookkeeping keys
+share the frame: prefix: frame:lru, a sorted set of frame key -> last use, frame:sizes, a
+hash of frame key -> bytes, and frame:bytes, their total. Once the total is over the
+bound, the least recently used frames are evicted.
+"""
+import hashlib
+import json
+import os
+import time
+
+import metrics
+from log_config import get_logger
+from storage import LazyClient
+
+resdb = LazyClient("results")
+
+logger = get_logger(__name__)
+
+KEY_PREFIX = "frame:"
+LRU_KEY = f"{KEY_PREFIX}lru"
+SIZES_KEY = f"{KEY_PREFIX}sizes"
+BYTES_KEY = f"{KEY_PREFIX}bytes"
+MAX_BYTES = int(os.environ.get("FRAME_CACHE_BYTES", 256 * 1024 * 1024))
+EVICT_BATCH = 100
+
+lookups = metrics.counter("wpp_frame_cache_total", "Static frames looked up in the frame cache.", ("outcome",))
+evicted = metrics.counter("wpp_frame_cache_evicted_total", "Frames evicted from the frame cache.")
+
+def key(state, options) -> str:
+    """The key of the frame showing `state`, rendered with the output `options` (a json list)."""
+    digest = hashlib.sha256(json.dumps([state, options]).encode('utf-8')).hexdigest()
+    return f"{KEY_PREFIX}{digest[:32]}"
+
+def get(frame_key):
+    """Return the files of a cached frame by name (image, thumb), or None; marks it as used."""
+    if not MAX_BYTES:
+        return None
+    pipe = resdb.pipeline(transaction=False)
+    pipe.hgetall(frame_key)
+    pipe.zadd(LRU_KEY, {frame_key: time.time()}, xx=True)
+    files = pipe.execute()[0]
+    lookups.inc(outcome="hit" if files else "miss")
+    return {name.decode('utf-8'): value for name, value in files.items()} if files else None
+
+def put(frame_key, files: dict):
+    """Cache the files of a frame by name, then evict the least recently used frames if over MAX_BYTES."""
+    size = sum(len(value) for value in files.values())
+    if not MAX_BYTES or size > MAX_BYTES:
+        return
+    pipe = resdb.pipeline(transaction=False)
+    pipe.hset(frame_key, mapping=files)
+    pipe.zadd(LRU_KEY, {frame_key: time.time()})
+    pipe.hset(SIZES_KEY, frame_key, size)
+    if pipe.execute()[2]: # a new frame, not one another worker cached meanwhile
+        total = resdb.incrby(BYTES_KEY, size)
+        if total > MAX_BYTES:
+            evict(total - MAX_BYTES)
+
+def evict(excess) -> int:
+    """Remove the least recently used frames until `excess` bytes are freed; return the bytes freed."""
+    freed = 0
+    while freed < excess:
+        popped = resdb.zpopmin(LRU_KEY, EVICT_BATCH) # each worker pops different frames
+        if not popped:
+            break
+        keys = [frame_key for frame_key, _ in popped]
+        sizes = [int(size or 0) for size in resdb.hmget(SIZES_KEY, keys)]
+        count = 0
+        while count < len(keys) and freed < excess:
+            freed += sizes[count]
+            count += 1
+        pipe = resdb.pipeline(transaction=False)
+        pipe.unlink(*keys[:count])
+        pipe.hdel(SIZES_KEY, *keys[:count])
+        pipe.decrby(BYTES_KEY, sum(sizes[:count]))
+        if count < len(keys): # popped past what had to go, put the rest back as they were
+            pipe.zadd(LRU_KEY, dict(popped[count:]))
+        pipe.execute()
+        evicted.inc(count)
+    if freed:
+        logger.info("Evicted %s bytes of frames from the frame cache.", freed)
+    return freed
@@ -0,0 +1,182 @@
+"""
+Frame renderers for the plots of a job.
+
+A renderer builds the figure of a job once: axes, limits, colors, legend, gridlines and
+every artist. `draw(year)` then only updates the artists whose data change between years
+(bar heights and labels, scatter points and the regression line), so the frames of a job
+share one figure instead of constructing and tearing down a figure per year. Figures are
+created without pyplot, so nothing is registered globally and nothing needs closing.
+"""
+import functools
+import io
+
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+import numpy as np
+
+@functools.lru_cache(maxsize=64)
+def palette(name, count):
+    """The `count` colors of colormap `name` resampled to `count` entries, as RGBA tuples."""
+    cmap = matplotlib.colormaps.get_cmap(name).resampled(max(count, 1))
+    return tuple(cmap(i) for i in range(count))
+
+def fit_line(x, y):
+    """Least squares line through the points: (slope, intercept, R²)."""
+    x_mean, y_mean = x.mean(), y.mean()
+    spread = ((x - x_mean) ** 2).sum()
+    slope = ((x - x_mean) * (y - y_mean)).sum() / spread if spread else 0.0
+    intercept = y_mean - slope * x_mean
+    total = ((y - y_mean) ** 2).sum()
+    residual = ((y - (slope * x + intercept)) ** 2).sum()
+    return slope, intercept, 1 - residual / total if total else 1.0
+
+class FrameRenderer:
+    """Base class: one figure and axes of `figsize` inches per job."""
+    figsize = (10, 6)
+
+    def __init__(self, data, years, locations, query1, query2=None):
+        self.data = data
+        self.years = years
+        self.locations = locations
+        self.query1 = query1
+        self.query2 = query2
+        self.fig = Figure(figsize=self.figsize)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+
+    def value(self, year, location, query):
+        """Return the value of `query` for a location and year as a float, None if missing."""
+        try:
+            return float(self.data[year][location][0][query])
+        except (KeyError, IndexError, ValueError, TypeError):
+            return None
+
+    def draw(self, year):
+        """Update the figure to show `year`."""
+        raise NotImplementedError
+
+    def state(self, year) -> list:
+        """
+        Everything the frame of `year` shows, as a json-able list: two frames with the same
+        state render to the same image, whichever job, dataset version or variant they are of.
+        """
+        values = [[self.value(year, location, query) for location in self.locations]
+                  for query in (self.query1, self.query2) if query]
+        return [type(self).__name__, matplotlib.__version__, year, self.query1, self.query2, list(self.locations),
+                list(self.ax.get_xlim()), list(self.ax.get_ylim()), values]
+
+class LineFrames(FrameRenderer):
+    """One line per location over every year; a single frame."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        years_int = [int(year) for year in self.years]
+        for location in self.locations:
+            values = [self.value(year, location, self.query1) for year in self.years]
+            if any(value is not None for value in values):
+                self.ax.plot(years_int, [np.nan if value is None else value for value in values], label=location)
+        self.ax.set_xlabel("Year")
+        self.ax.set_ylabel(f'{self.query1}')
+        self.ax.set_title(f"{self.query1} vs Year by Location")
+        self.ax.legend(loc='upper left', bbox_to_anchor=(1.02, 1), borderaxespad=0)
+        self.ax.grid(True)
+
+    def draw(self, year):
+        pass
+
+class BarFrames(FrameRenderer):
+    """One bar per location, one frame per year, on a y axis shared by every year."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.heights = {year: [self.value(year, location, self.query1) or 0 for location in self.locations]
+                        for year in self.years}
+        top = max((max(row) for row in self.heights.values()), default=0)
+        colors = [matplotlib.colors.to_hex(color) for color in palette('Pastel1', len(self.locations))]
+
+        self.bars = self.ax.bar(self.locations, self.heights[self.years[0]], color=colors)
+        self.ax.set_ylim(0, top * 1.1 or 1)
+        self.ax.set_ylabel(f"{self.query1}")
+        self.title = self.ax.set_title("")
+        self.texts = [self.ax.text(bar.get_x() + bar.get_width()/2, 0, "", ha='center', va='bottom', fontsize=9)
+                      for bar in self.bars]
+        self.fig.tight_layout()
+
+    def draw(self, year):
+        self.title.set_text(f"{self.query1} in {year}")
+        for bar, height, text in zip(self.bars, self.heights[year], self.texts):
+            bar.set_height(height)
+            text.set_y(height)
+            text.set_text(f"{height:,}")
+
+class ScatterFrames(FrameRenderer):
+    """query1 against query2 for every location, one frame per year, with a regression line."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        points = [(self.value(year, location, self.query1), self.value(year, location, self.query2))
+                  for year in self.years for location in self.locations]
+        points = [(x, y) for x, y in points if x is not None and y is not None]
+        if not points:
+            raise ValueError(f"No values of {self.query1} and {self.query2} to plot.")
+        xs, ys = zip(*points)
+        x_pad = (max(xs) - min(xs)) * 0.1
+        y_pad = (max(ys) - min(ys)) * 0.1
+        self.x_lim = (min(xs) - x_pad, max(xs) + x_pad)
+        self.y_lim = (min(ys) - y_pad, max(ys) + y_pad)
+
+        unique_locations = sorted({loc for year in self.years for loc in self.data.get(year, {})})
+        self.colors = dict(zip(unique_locations, palette('plasma', len(unique_locations))))
+
+        self.fig.subplots_adjust(right=0.75)
+        self.ax.set_xlabel(f"{self.query1}")
+        self.ax.set_ylabel(f"{self.query2}")
+        self.ax.grid(True)
+        self.ax.set_xlim(self.x_lim)
+        self.ax.set_ylim(self.y_lim)
+        self.title = self.ax.set_title("")
+        self.points = self.ax.scatter([], [], alpha=1)
+        self.fit, = self.ax.plot([], [], color='red', lw=2)
+        handles = [Line2D([0], [0], color='red', lw=2, label="Regression Line")]
+        handles += [Line2D([0], [0], marker='o', linestyle='', color=self.colors[loc], label=loc, markersize=7)
+                    for loc in unique_locations]
+        self.legend = self.ax.legend(handles=handles, loc='upper right', bbox_to_anchor=(1.3, 1), borderaxespad=0)
+        self.legend.get_frame().set_facecolor('none')
+        self.legend.get_frame().set_edgecolor('none')
+        self.x_fit = np.linspace(self.x_lim[0], self.x_lim[1], 100)
+
+    def draw(self, year):
+        self.title.set_text(f"{self.query1} vs {self.query2} in {year}")
+        points = [(self.value(year, loc, self.query1), self.value(year, loc, self.query2), loc) for loc in self.locations]
+        points = [point for point in points if point[0] is not None and point[1] is not None]
+        self.points.set_offsets(np.array([(x, y) for x, y, _ in points]).reshape(-1, 2))
+        self.points.set_facecolor([self.colors[loc] for _, _, loc in points])
+
+        fitted = len(points) > 1
+        if fitted:
+            slope, intercept, r_squared = fit_line(np.array([x for x, _, _ in points]), np.array([y for _, y, _ in points]))
+            self.fit.set_data(self.x_fit, slope * self.x_fit + intercept)
+            self.legend.get_texts()[0].set_text(f"Regression Line (R²={r_squared:.2f})")
+        self.fit.set_visible(fitted)
+        self.legend.set_visible(fitted)
+
+    def state(self, year) -> list:
+        # the legend lists every location of the data, not only the plotted ones
+        return super().state(year) + [list(self.colors)]
+
+RENDERERS = {"line": LineFrames, "bar": BarFrames, "scatter": ScatterFrames}
+
+def warm_up():
+    """
+    Render a throwaway frame of every plot type, so the fonts, the Agg backend and the code
+    paths of the renderers are loaded before the first job instead of during it.
+    """
+    locations = ["A", "B"]
+    data = {"2000": {loc: [{"Location": loc, "Time": "2000", "TFR": str(i + 1), "TPopulation1Jan": str(i + 2)}]
+                     for i, loc in enumerate(locations)}}
+    for renderer in RENDERERS.values():
+        frame = renderer(data, ["2000"], locations, "TFR", "TPopulation1Jan")
+        frame.draw("2000")
+        frame.fig.savefig(io.BytesIO(), format="png", bbox_inches="tight")
@@ -1,27 +1,61 @@
 import json
+import time
 import uuid
-import redis
 import os 
-from hotqueue import HotQueue 
-import logging 
+import metrics
+from log_config import get_logger
+from storage import LazyClient
 
-_redis_host = os.environ.get("REDIS_HOST") 
-_redis_port=6379 
+rd = LazyClient("data")
+q = LazyClient("queue")
+jdb = LazyClient("jobs")
+resdb = LazyClient("results") # database for storing results 
 
-rd = redis.Redis(host=_redis_host, port=_redis_port, db=0)
-q = HotQueue("queue", host=_redis_host, port=_redis_port, db=1)
-jdb = redis.Redis(host=_redis_host, port=_redis_port, db=2) 
-resdb = redis.Redis(host=_redis_host, port=_redis_port, db=3) # database for storing results 
+GROUP_PREFIX = "group:" # job groups share the jobs database but are not jobs themselves
+# sorted sets of job id -> submission time, kept in the jobs database for paginated listings
+INDEX_PREFIX = "index:"
+SUBMITTED_INDEX = f"{INDEX_PREFIX}submitted" # every job
+INDEXED_FIELDS = ("status", "plot_type") # one sorted set per value, e.g. index:status:complete
+LIST_SCAN_FACTOR = 10 # a page of a filtered listing examines at most this many ids per requested id
+# seconds finished jobs and their results are kept, by status, 0 keeps them
+RETENTION = {"complete": int(os.environ.get("RETENTION_COMPLETE", 7 * 86400)),
+             "error": int(os.environ.get("RETENTION_ERROR", 86400)),
+             "cancelled": int(os.environ.get("RETENTION_CANCELLED", 86400))}
+RETENTION_LARGE_BYTES = int(os.environ.get("RETENTION_LARGE_BYTES", 50 * 2**20))
+RETENTION_LARGE = int(os.environ.get("RETENTION_LARGE", 86400)) # cap for results over RETENTION_LARGE_BYTES, 0 none
+OUTPUT_FORMATS = ("png", "svg")
+EXPORT_FORMATS = ("csv", "parquet", "arrow") # formats of export jobs, which write a table instead of plotting
+RENDER_PROFILES = ("quality", "fast")
+# kept in the queue database next to the queue itself, for autoscalers
+QUEUED_KEY = "Queue-Submitted" # sorted set of queued job id -> submission time
+COSTS_KEY = "Queue-Costs" # hash of queued job id -> estimated cost
+BACKLOG_KEY = "Queue-Backlog-Cost" # running total of COSTS_KEY
+BATCH_JOBS_KEY = "Queue-Batch-Jobs" # set of the queued job ids submitted in a batch (POST /jobs/batch)
+BATCH_BACKLOG_KEY = "Queue-Batch-Backlog-Cost" # running total of the costs of BATCH_JOBS_KEY
+CANCELLED_KEY = "Queue-Cancelled" # set of cancelled job ids a worker may have taken off the queue
+RUNNING_KEY = "Queue-Running" # sorted set of job id -> lease deadline of the jobs workers are running
+RUNNING_LEASE = int(os.environ.get("JOB_RUNNING_LEASE", 3600)) # seconds a job counts as running at most, if its worker died
+FINISHED = ("complete", "error", "cancelled")
 
-log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-numeric_level = getattr(logging, log_level, logging.INFO)
+logger = get_logger(__name__)
 
-logging.basicConfig(
-    level=numeric_level,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+class JobCancelled(Exception):
+    """Raised in a worker when the job it is running was cancelled."""
 
-logging.info("Logging level set to %s", log_level) 
+class JobFinished(Exception):
+    """Raised when changing the status of a job that already finished; `status` is the one it ended with."""
+
+    def __init__(self, jid, status):
+        super().__init__(f"Job ID '{jid}' is already {status}.")
+        self.status = status
+
+metrics.gauge("wpp_queue_depth", "Number of jobs waiting in the queue.").set_function(lambda: len(q))
+metrics.gauge("wpp_queue_oldest_job_age_seconds", "Time the oldest queued job has been waiting.").set_function(
+    lambda: queue_stats()["oldest_age_seconds"])
+metrics.gauge("wpp_queue_backlog_cost", "Estimated cost of the queued jobs, in frames times locations.").set_function(
+    lambda: queue_stats()["backlog_cost"])
+metrics.gauge("wpp_queue_running", "Number of jobs workers are running.").set_function(
+    lambda: queue_stats()["running"])
 
 def string_to_bool(string):
     if string: 
@@ -30,10 +64,10 @@ def string_to_bool(string):
         elif string.lower() == "false":
             return False
         else:
-            logging.warning("Invalid boolean string, defaulting to false.")
+            logger.warning("Invalid boolean string, defaulting to false.")
             return False
     else:
-        logging.warning("Empty string provided, defaulting to false.")
+        logger.warning("Empty string provided, defaulting to false.")
         return False
 
 def _generate_jid() -> str:
@@ -41,99 +75,500 @@ def _generate_jid() -> str:
     Generate a pseudo-random identifier for a job.
     """
     jid = str(uuid.uuid4())
-    logging.debug(f"Generated job ID: {jid}")
+    logger.debug("Generated job ID: %s", jid)
     return jid
 
-def _instantiate_job(jid, status, data_dict):
+def _instantiate_job(jid, status, data_dict, group=None):
     """
     Create the job object description as a python dictionary.
     """
     job = {'id': jid, 'status': status, 'start': data_dict.get('start'), 'end': data_dict.get('end'), 
            'plot_type': data_dict.get('plot_type'), 'location': data_dict.get('location'), 
-           'query1': data_dict.get('query1'), 'query2': data_dict.get('query2'), 'animate': data_dict.get('animate')}
+           'query1': data_dict.get('query1'), 'query2': data_dict.get('query2'), 'animate': data_dict.get('animate'),
+           'format': data_dict.get('format'), 'dpi': data_dict.get('dpi'), 'thumbnail': data_dict.get('thumbnail'),
+           'profile': data_dict.get('profile'), 'fields': data_dict.get('fields'), 'variant': data_dict.get('variant'),
+           'group': group,
+           'submitted_at': round(time.time(), 3)}
     job = {k: v for k, v in job.items() if v is not None} 
-    logging.debug(f"Instantiated job: {job}")
+    logger.debug("Instantiated job: %s", job)
     return job 
 
-def _save_job(jid, job_dict):
-    """Save a job object in the Redis database."""
+def _index_key(field, value) -> str:
+    return f"{INDEX_PREFIX}{field}:{value}"
+
+def _index_values(job_dict) -> dict:
+    return {"status": job_dict.get('status'), "plot_type": job_dict.get('plot_type') or "line"}
+
+def _index_job(pipe, job_dict, old_status=None):
+    """Add the writes that file a job under its submission time, status and plot type to `pipe`."""
+    jid, score = job_dict['id'], job_dict.get('submitted_at', 0)
+    pipe.zadd(SUBMITTED_INDEX, {jid: score})
+    if old_status is not None and old_status != job_dict.get('status'):
+        pipe.zrem(_index_key("status", old_status), jid)
+    for field, value in _index_values(job_dict).items():
+        pipe.zadd(_index_key(field, value), {jid: score})
+
+def _save_job(jid, job_dict, old_status=None):
+    """Save a job object and its index entries in the Redis database."""
     try:
-        jdb.set(jid, json.dumps(job_dict))
-        logging.info(f"Saved job {jid} to Redis.")
+        pipe = jdb.pipeline(transaction=False)
+        pipe.set(jid, json.dumps(job_dict), keepttl=True)
+        _index_job(pipe, job_dict, old_status)
+        pipe.execute()
+        logger.info("Saved job %s to Redis.", jid)
     except Exception as e:
-        logging.error(f"Failed to save job {jid} to Redis: {e}")
+        logger.error("Failed to save job %s to Redis: %s", jid, e)
+
+def estimate_cost(plot_type, start, end, locations) -> int:
+    """Estimated work of a job: frames rendered times locations plotted."""
+    frames = 1 if plot_type in (None, "line", "export") else int(end) - int(start) + 1
+    return max(frames, 1) * max(locations, 1)
+
+def job_cost(job_dict) -> int:
+    """Estimated work of a job from its spec, see `estimate_cost`."""
+    location = job_dict.get('location')
+    try:
+        return estimate_cost(job_dict.get('plot_type'), job_dict['start'], job_dict['end'],
+                             len(location.split(",")) if location else 1)
+    except (KeyError, TypeError, ValueError):
+        return 1
+
+def _queue_redis():
+    """The Redis client of the queue database, which the HotQueue keeps to itself."""
+    return q._HotQueue__redis
+
+def _track_queued(job_dicts):
+    """Record the submission time and cost of jobs before they are queued."""
+    costs = {job['id']: job_cost(job) for job in job_dicts}
+    batch = [job['id'] for job in job_dicts if job.get('group')]
+    pipe = _queue_redis().pipeline(transaction=False)
+    pipe.zadd(QUEUED_KEY, {job['id']: job['submitted_at'] for job in job_dicts})
+    pipe.hset(COSTS_KEY, mapping=costs)
+    pipe.incrby(BACKLOG_KEY, sum(costs.values()))
+    if batch:
+        pipe.sadd(BATCH_JOBS_KEY, *batch)
+        pipe.incrby(BATCH_BACKLOG_KEY, sum(costs[jid] for jid in batch))
+    pipe.execute()
+
+def _untrack_queued(pipe, jid):
+    """
+    Add the commands forgetting the submission time and cost of a job to `pipe`, last; pass
+    their results to `_settle_backlog`.
+    """
+    pipe.zrem(QUEUED_KEY, jid)
+    pipe.hget(COSTS_KEY, jid)
+    pipe.hdel(COSTS_KEY, jid)
+    pipe.srem(BATCH_JOBS_KEY, jid)
+
+def _settle_backlog(results):
+    """Take the cost of a job off the backlog totals, if it was this caller's HDEL that removed it."""
+    _, cost, removed, batch = results
+    if removed and cost is not None:
+        pipe = _queue_redis().pipeline(transaction=False)
+        pipe.decrby(BACKLOG_KEY, int(cost))
+        if batch:
+            pipe.decrby(BATCH_BACKLOG_KEY, int(cost))
+        pipe.execute()
+
+def job_started(jid):
+    """Count a job as running instead of queued, once a worker has taken it off the queue."""
+    now = time.time()
+    pipe = _queue_redis().pipeline(transaction=False)
+    pipe.zremrangebyscore(RUNNING_KEY, 0, now) # jobs of workers that died
+    pipe.zadd(RUNNING_KEY, {jid: now + RUNNING_LEASE})
+    _untrack_queued(pipe, jid)
+    _settle_backlog(pipe.execute()[2:])
+
+def job_finished(jid):
+    """Stop counting a job as running, once its worker finished, cancelled or requeued it."""
+    _queue_redis().zrem(RUNNING_KEY, jid)
+
+def requeue_job(jid):
+    """Put a job a worker started back in the queue, e.g. when the worker is stopped before finishing it."""
+    try:
+        update_job_status(jid, "submitted")
+    except JobFinished: # cancelled meanwhile
+        return
+    _queue_job(get_job_by_id(jid))
 
-def _queue_job(jid):
+def is_cancelled(jid) -> bool:
+    return bool(_queue_redis().sismember(CANCELLED_KEY, jid))
+
+def check_cancelled(jid):
+    """Raise JobCancelled if job `jid` was cancelled; called by workers between frames."""
+    if is_cancelled(jid):
+        raise JobCancelled(jid)
+
+def clear_cancelled(jid):
+    """Forget that a job was cancelled, once no worker is running it."""
+    _queue_redis().srem(CANCELLED_KEY, jid)
+
+def cancel_job(jid) -> dict:
+    """
+    Cancel a job that has not finished. A queued job is taken off the queue; otherwise it is
+    flagged so the worker running it stops before its next frame. Return the cancelled job,
+    or an error dictionary if the job does not exist or already finished.
+    """
+    job_dict = get_job_by_id(jid)
+    if "error" in job_dict:
+        return job_dict
+    try:
+        update_job_status(jid, "cancelled") # first, so a worker finishing it meanwhile cannot overwrite it
+    except JobFinished as e:
+        return {"error": str(e)}
+    entry = q.serializer.dumps(jid) if q.serializer is not None else jid # as HotQueue.put stores it
+    pipe = _queue_redis().pipeline(transaction=False)
+    pipe.lrem(q.key, 0, entry)
+    _untrack_queued(pipe, jid)
+    dequeued, *untracked = pipe.execute()
+    _settle_backlog(untracked)
+    if dequeued:
+        apply_retention(jid, "cancelled")
+    else:
+        _queue_redis().sadd(CANCELLED_KEY, jid)
+    logger.info("Cancelled job %s%s.", jid, " before it started" if dequeued else "")
+    return get_job_by_id(jid)
+
+def queue_stats() -> dict:
+    """
+    Return the queue depth, the age of the oldest queued job, the estimated cost of the
+    backlog and the number of jobs workers are running.
+    """
+    pipe = _queue_redis().pipeline(transaction=False)
+    pipe.llen(q.key)
+    pipe.zrange(QUEUED_KEY, 0, 0, withscores=True)
+    pipe.get(BACKLOG_KEY)
+    pipe.get(BATCH_BACKLOG_KEY)
+    pipe.zcount(RUNNING_KEY, time.time(), "+inf")
+    depth, oldest, backlog, batch_backlog, running = pipe.execute()
+    age = max(time.time() - oldest[0][1], 0) if oldest else 0
+    if backlog is None: # queued before the total was kept
+        backlog, batch_backlog = reconcile_backlog()
+    backlog = max(int(backlog), 0)
+    batch_backlog = min(max(int(batch_backlog or 0), 0), backlog)
+    return {"depth": depth, "oldest_age_seconds": round(age, 3), "backlog_cost": backlog,
+            "batch_backlog_cost": batch_backlog, "running": running}
+
+def reconcile_backlog() -> tuple:
+    """
+    Recompute the backlog totals from the costs of the queued jobs, correcting any drift (a
+    process that died between forgetting a job and settling its cost); return the total and
+    the part of it submitted in batches.
+    """
+    def transaction(pipe):
+        costs = pipe.hgetall(COSTS_KEY)
+        batch = pipe.smembers(BATCH_JOBS_KEY)
+        total = sum(int(cost) for cost in costs.values())
+        batch_total = sum(int(costs[jid]) for jid in batch if jid in costs)
+        pipe.multi()
+        pipe.set(BACKLOG_KEY, total)
+        pipe.set(BATCH_BACKLOG_KEY, batch_total)
+        if batch - costs.keys(): # batch jobs no longer queued
+            pipe.srem(BATCH_JOBS_KEY, *(batch - costs.keys()))
+        return total, batch_total
+
+    return _queue_redis().transaction(transaction, COSTS_KEY, BACKLOG_KEY, BATCH_JOBS_KEY, BATCH_BACKLOG_KEY,
+                                      value_from_callable=True)
+
+def _queue_job(job_dict):
     """Add a job to the redis queue."""
+    jid = job_dict['id']
     try:
+        _track_queued([job_dict])
         q.put(jid)
-        logging.info(f"Queued job {jid}.")
+        logger.info("Queued job %s.", jid)
     except Exception as e:
-        logging.error(f"Failed to queue job {jid}: {e}")
+        logger.error("Failed to queue job %s: %s", jid, e)
 
 def add_job(data_dict, status="submitted") -> dict:
     """Add a job to the redis queue."""
-    logging.info(f"Adding new job.")
+    logger.info("Adding new job.")
     jid = _generate_jid()
     job_dict = _instantiate_job(jid, status, data_dict) 
     _save_job(jid, job_dict)
-    _queue_job(jid)
+    _queue_job(job_dict)
     return job_dict
 
+def validate_job_spec(data_dict):
+    """Return an error message if a job spec is unusable, otherwise None."""
+    if not isinstance(data_dict, dict):
+        return "Job spec must be a json dictionary."
+    if not data_dict.get("start") or not data_dict.get("end"):
+        return "Please provide both start and end dates."
+    try:
+        int(data_dict["start"])
+        int(data_dict["end"])
+    except (TypeError, ValueError):
+        return "Start and end dates must be years."
+    if data_dict.get("plot_type") == "export":
+        if data_dict.get("format", "csv") not in EXPORT_FORMATS:
+            return f"Export format must be one of {', '.join(EXPORT_FORMATS)}."
+        if not isinstance(data_dict.get("fields", ""), str):
+            return "Fields must be a comma separated string."
+    elif data_dict.get("format", "png") not in OUTPUT_FORMATS:
+        return f"Format must be one of {', '.join(OUTPUT_FORMATS)}."
+    if data_dict.get("profile", "quality") not in RENDER_PROFILES:
+        return f"Profile must be one of {', '.join(RENDER_PROFILES)}."
+    if data_dict.get("dpi") is not None:
+        try:
+            if not 10 <= int(data_dict["dpi"]) <= 600:
+                raise ValueError
+        except (TypeError, ValueError):
+            return "Dpi must be a number from 10 to 600."
+    return None
+
+def _group_spec(gid, jids, specs):
+    """
+    Create the group description covering the union of years and locations of its jobs,
+    so a worker can fetch the data slice once for the whole group. The slice is of the
+    variant of the jobs if they share one, of the default otherwise.
+    """
+    years = [int(spec['start']) for spec in specs] + [int(spec['end']) for spec in specs]
+    locations = set()
+    for spec in specs:
+        location = spec.get('location')
+        locations.update(location.split(",") if location else ['World'])
+    group = {'id': gid, 'jobs': jids, 'start': str(min(years)), 'end': str(max(years)),
+             'location': ",".join(sorted(locations))}
+    variants = {spec.get('variant') or None for spec in specs}
+    if len(variants) == 1 and None not in variants:
+        group['variant'] = variants.pop()
+    return group
+
+def add_jobs(specs, status="submitted") -> dict:
+    """
+    Add a batch of jobs to the redis queue as a single group. All job records and the
+    group record are written in one pipeline and all job ids are queued in one push.
+    """
+    logger.info("Adding batch of %s jobs.", len(specs))
+    gid = _generate_jid()
+    job_dicts = [_instantiate_job(_generate_jid(), status, spec, group=gid) for spec in specs]
+    jids = [job['id'] for job in job_dicts]
+    group = _group_spec(gid, jids, specs)
+
+    pipe = jdb.pipeline(transaction=False)
+    for job in job_dicts:
+        pipe.set(job['id'], json.dumps(job))
+        _index_job(pipe, job)
+    pipe.set(f'{GROUP_PREFIX}{gid}', json.dumps(group))
+    pipe.execute()
+    logger.info("Saved %s jobs of group %s to Redis.", len(jids), gid)
+
+    try:
+        _track_queued(job_dicts)
+        q.put(*jids)
+        logger.info("Queued %s jobs of group %s.", len(jids), gid)
+    except Exception as e:
+        logger.error("Failed to queue jobs of group %s: %s", gid, e)
+    return {'group': group, 'jobs': job_dicts}
+
+def get_group(gid) -> dict:
+    """Return the group dictionary given gid, without job statuses."""
+    group_data = jdb.get(f'{GROUP_PREFIX}{gid}')
+    if group_data is None:
+        logger.warning("Group ID '%s' not found in Redis.", gid)
+        return {"error": f"Group ID '{gid}' not found."}
+    return json.loads(group_data)
+
+def get_group_status(gid) -> dict:
+    """Return the group dictionary with the combined status of all of its jobs."""
+    group = get_group(gid)
+    if "error" in group:
+        return group
+    counts = {}
+    for job_data in jdb.mget(group['jobs']) if group['jobs'] else []:
+        status = json.loads(job_data)['status'] if job_data is not None else 'missing'
+        counts[status] = counts.get(status, 0) + 1
+
+    if counts.get('complete', 0) == len(group['jobs']):
+        combined = 'complete'
+    elif set(counts) == {'cancelled'}:
+        combined = 'cancelled'
+    elif not set(counts) - {'complete', 'error', 'cancelled', 'missing'}:
+        combined = 'error'
+    elif set(counts) == {'submitted'}:
+        combined = 'submitted'
+    else:
+        combined = 'in progress'
+    group['status'] = combined
+    group['counts'] = counts
+    return group
+
 def get_job_by_id(jid) -> dict:
     """Return job dictionary given jid"""
     try:
         job_data = jdb.get(jid)
         if job_data is None:
-            logging.warning(f"Job ID '{jid}' not found in Redis.")
+            logger.warning("Job ID '%s' not found in Redis.", jid)
             return {"error": f"Job ID '{jid}' not found."}
         job = json.loads(job_data)
-        logging.debug(f"Retrieved job {jid}: {job}")
+        logger.debug("Retrieved job %s: %s", jid, job)
         return job
     except Exception as e:
-        logging.error(f"Error retrieving job {jid}: {e}")
+        logger.error("Error retrieving job %s: %s", jid, e)
         return {"error": f"Job ID '{jid}' not found."}
 
 def update_job_status(jid, status):
-    """Update the status of job with job id `jid` to status `status`."""
-    logging.info(f"Updating status of job {jid} to '{status}'")
-    job_dict = get_job_by_id(jid)
-    if "error" not in job_dict:
-        job_dict['status'] = status
-        _save_job(jid, job_dict)
-        logging.debug(f"Job {jid} status updated to '{status}'")
-    else:
-        logging.error(f"Cannot update status. {job_dict['error']}")
-        raise Exception(f"Job ID '{jid}' not found.")
+    """
+    Update the status of job with job id `jid` to status `status`. The change is a compare-and-set,
+    retried if the job changed meanwhile, and a finished job keeps its status: JobFinished is
+    raised instead, e.g. when a worker completes a job just cancelled. The job keeps its TTL.
+    """
+    logger.info("Updating status of job %s to '%s'", jid, status)
+
+    def transaction(pipe):
+        job_data = pipe.get(jid)
+        if job_data is None:
+            logger.error("Cannot update status. Job ID '%s' not found.", jid)
+            raise Exception(f"Job ID '{jid}' not found.")
+        job_dict = json.loads(job_data)
+        if job_dict['status'] in FINISHED:
+            raise JobFinished(jid, job_dict['status'])
+        old_status, job_dict['status'] = job_dict['status'], status
+        pipe.multi()
+        pipe.set(jid, json.dumps(job_dict), keepttl=True)
+        _index_job(pipe, job_dict, old_status)
+
+    jdb.transaction(transaction, jid)
+    logger.debug("Job %s status updated to '%s'", jid, status)
 
 def get_all_jobs() -> list:
     """Returns all of the job ids including the in progress and completed jobs"""
     try:
         keys = jdb.keys()
         keys = [key.decode('utf-8') for key in keys]
-        logging.debug(f"Retrieved all job IDs: {keys}")
+        keys = [key for key in keys if not key.startswith((GROUP_PREFIX, INDEX_PREFIX))]
+        logger.debug("Retrieved all job IDs: %s", keys)
         return keys
     except Exception as e:
-        logging.error(f"Error fetching job keys: {e}")
+        logger.error("Error fetching job keys: %s", e)
         return []
 
+def delete_job(jid):
+    """Delete a job and its index entries."""
+    job_data = jdb.get(jid)
+    pipe = jdb.pipeline(transaction=False)
+    pipe.delete(jid)
+    pipe.zrem(SUBMITTED_INDEX, jid)
+    if job_data is not None:
+        for field, value in _index_values(json.loads(job_data)).items():
+            pipe.zrem(_index_key(field, value), jid)
+    pipe.execute()
+
+def rebuild_job_index():
+    """File every job of the jobs database in the indexes, e.g. jobs saved before they existed."""
+    skip = (GROUP_PREFIX.encode(), INDEX_PREFIX.encode())
+    jids = [key for key in jdb.scan_iter(count=1000) if not key.startswith(skip)]
+    for start in range(0, len(jids), 1000):
+        pipe = jdb.pipeline(transaction=False)
+        for job_data in jdb.mget(jids[start:start + 1000]):
+            if job_data is not None:
+                _index_job(pipe, json.loads(job_data))
+        pipe.execute()
+    logger.info("Indexed %s jobs.", len(jids))
+
+def _encode_cursor(score, jid) -> str:
+    return f"{score!r}:{jid}"
+
+def _decode_cursor(cursor) -> tuple:
+    score, _, jid = cursor.partition(":")
+    if not jid:
+        raise ValueError("Invalid cursor.")
+    return float(score), jid
+
+def _match_all(keys, jids) -> list:
+    """Whether each of `jids` is in every one of the index sorted sets `keys`."""
+    if not keys or not jids:
+        return [True] * len(jids)
+    pipe = jdb.pipeline(transaction=False)
+    for jid in jids:
+        for key in keys:
+            pipe.zscore(key, jid)
+    scores = pipe.execute()
+    return [all(score is not None for score in scores[i:i + len(keys)]) for i in range(0, len(scores), len(keys))]
+
+def list_jobs(cursor=None, limit=100, status=None, plot_type=None, since=None, until=None) -> tuple:
+    """
+    Return a page of up to `limit` job ids, newest first, and the cursor of the next page
+    (None after the last page). Only jobs with the given status and plot type submitted
+    between `since` and `until` (epoch seconds) are listed; the filters are answered from
+    the index sorted sets without reading any job. A filtered page stops early, with a
+    cursor, once it examined LIST_SCAN_FACTOR ids per requested id.
+    """
+    if not jdb.exists(SUBMITTED_INDEX):
+        rebuild_job_index()
+    filters = [_index_key(field, value) for field, value in (("status", status), ("plot_type", plot_type)) if value]
+    key, others = (filters[0], filters[1:]) if filters else (SUBMITTED_INDEX, [])
+    high = "+inf" if until is None else until
+    after = None
+    if cursor:
+        after = _decode_cursor(cursor)
+        high = after[0] if until is None else min(after[0], until)
+    low = "-inf" if since is None else since
+
+    jids, offset, budget = [], 0, limit * LIST_SCAN_FACTOR
+    while True:
+        batch = jdb.zrevrangebyscore(key, high, low, start=offset, num=limit, withscores=True)
+        offset += len(batch)
+        exhausted = len(batch) < limit
+        batch = [(jid.decode('utf-8'), score) for jid, score in batch]
+        if after is not None: # ids tied with the end of the previous page sort after it by id
+            batch = [(jid, score) for jid, score in batch if score < after[0] or jid < after[1]]
+        matches = _match_all(others, [jid for jid, _ in batch])
+        for (jid, score), match in zip(batch, matches):
+            budget -= 1
+            if match:
+                jids.append(jid)
+            if len(jids) == limit or budget == 0:
+                return jids, _encode_cursor(score, jid)
+        if exhausted:
+            return jids, None
+
+def retention(status, size=0) -> int:
+    """Seconds a job with `status` and a result of `size` bytes is kept once finished, 0 for ever."""
+    ttl = RETENTION.get(status, 0)
+    if RETENTION_LARGE and size > RETENTION_LARGE_BYTES:
+        ttl = min(ttl, RETENTION_LARGE) if ttl else RETENTION_LARGE
+    return ttl
+
+def result_size(jid) -> int:
+    """Bytes stored in the result hash of a job."""
+    fields = resdb.hkeys(jid)
+    if not fields:
+        return 0
+    pipe = resdb.pipeline(transaction=False)
+    for field in fields:
+        pipe.hstrlen(jid, field)
+    return sum(pipe.execute())
+
+def apply_retention(jid, status) -> int:
+    """Expire the record and result of a finished job after its retention; return the TTL set, 0 if none."""
+    ttl = retention(status, result_size(jid))
+    if ttl:
+        jdb.expire(jid, ttl)
+        resdb.expire(jid, ttl)
+        logger.debug("Job %s expires in %s seconds.", jid, ttl)
+    return ttl
+
 def get_results(jid) -> dict:
     """Returns results of job with job id `jid`."""
-    logging.info(f"Fetching results for job {jid}")
+    logger.info("Fetching results for job %s", jid)
     job_dict = get_job_by_id(jid)
     if "error" in job_dict:
-        logging.warning(f"Results request failed: {job_dict['error']}")
+        logger.warning("Results request failed: %s", job_dict['error'])
         return {"error": f"Job ID '{jid}' not found."}
 
     if job_dict['status'] == 'complete' or job_dict['status']=='error':
         try:
-            result = resdb.hget(jid,'data')
-            parsed_result = json.loads(result.decode('utf-8'))
-            logging.debug(f"Results for job {jid}: {parsed_result}")
+            result, files = resdb.hmget(jid, 'data', 'files')
+            parsed_result = json.loads(result.decode('utf-8')) if result is not None else None # exports store no data
+            logger.debug("Results for job %s: %s", jid, parsed_result)
+            if files is not None:
+                return {"job": job_dict, "result": parsed_result, "files": json.loads(files)}
             return {"job": job_dict, "result": parsed_result} 
         except Exception as e:
-            logging.error(f"Error decoding result for job {jid}: {e}")
+            logger.error("Error decoding result for job %s: %s", jid, e)
             return {"error": "Failed to retrieve job results."}
 
-    logging.info(f"Job {jid} not complete yet.")
+    logger.info("Job %s not complete yet.", jid)
     return {"Job is not done yet!": job_dict}
@@ -0,0 +1,155 @@
+"""
+Search index over the locations of a dataset version.
+
+Ingest rewrites spaces and commas in every value to underscores, so "Côte d'Ivoire" is
+stored as "Côte_d'Ivoire". Each process builds an index per dataset version from the small
+table of locations the load stores (see `dataset.location_table`), over the Location name,
+ISO3_code, ISO2_code and LocID of every location:
+    identifiers   normalized name and every code -> Location, for exact lookups
+    words         sorted (name from one of its words on, position) pairs; a prefix of any
+                  word of a name is a range of this list found by bisection, like a trie walk
+    trigrams      trigram -> positions of the names containing it, for misspelled queries
+
+Names are normalized by dropping accents, case and punctuation, so "cote d'ivoire",
+"COTE_D_IVOIRE", "CIV", "CI" and "384" all resolve to "Côte_d'Ivoire". The read routes and
+job specs accept any of these identifiers for a location (see `resolve`).
+"""
+import bisect
+import re
+import unicodedata
+from collections import Counter
+
+import dataset
+
+MIN_SIMILARITY = 0.5 # fuzzy matches hold at least this share of the query's trigrams
+MATCHES = ("exact", "prefix", "word", "fuzzy") # from the best kind of match to the worst
+
+_indexes = {} # dataset version -> (manifest it was built for, LocationIndex)
+
+def normalize(text: str) -> str:
+    """Lowercase `text` without accents, with every run of other characters than letters and digits as one space."""
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r"[\W_]+", " ", text.lower()).strip()
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class LocationIndex:
+    """Lookups and searches over a list of locations, as returned by `dataset.location_table`."""
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.locations = {entry["Location"] for entry in self.entries}
+        self.names = [normalize(entry["Location"]) for entry in self.entries]
+        self.identifiers = {}
+        for position, entry in enumerate(self.entries):
+            for field in dataset.LOCATION_FIELDS:
+                if entry.get(field):
+                    # names win over codes that normalize the same, and the first location over later ones
+                    self.identifiers.setdefault(normalize(entry[field]), position)
+        for position, name in enumerate(self.names):
+            self.identifiers[name] = position
+        self.words = sorted((name[match.start():], position) for position, name in enumerate(self.names)
+                            for match in re.finditer(r"\w+", name))
+        self.trigrams = {}
+        for position, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.trigrams.setdefault(gram, []).append(position)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def resolve(self, identifier):
+        """Return the Location a name, ISO code or LocID identifies, or None."""
+        if identifier in self.locations:
+            return identifier
+        position = self.identifiers.get(normalize(identifier))
+        return None if position is None else self.entries[position]["Location"]
+
+    def _prefixed(self, query):
+        """Positions of the names with a word starting with `query`, and of those whose first word does."""
+        start = bisect.bisect_left(self.words, (query,))
+        found, first = [], set()
+        for suffix, position in self.words[start:]:
+            if not suffix.startswith(query):
+                break
+            found.append(position)
+            if self.names[position].startswith(query):
+                first.add(position)
+        return found, first
+
+    def _similar(self, query):
+        """Positions of the names holding at least MIN_SIMILARITY of the trigrams of `query`, with that share."""
+        grams = trigrams(query)
+        shared = Counter(position for gram in grams for position in self.trigrams.get(gram, ()))
+        return {position: count / len(grams) for position, count in shared.items() if count / len(grams) >= MIN_SIMILARITY}
+
+    def search(self, text, limit=10) -> list:
+        """
+        Return up to `limit` locations matching `text`, best first: an exact name or code,
+        names starting with it, names with a word starting with it, then similar names.
+        Each is its entry with the kind of match under "match".
+        """
+        query = normalize(text)
+        if not query:
+            return []
+        ranked = {} # position -> (kind of match, -similarity, name)
+        exact = self.identifiers.get(query)
+        if exact is not None:
+            ranked[exact] = (0, 0, self.names[exact])
+        prefixed, first = self._prefixed(query)
+        for position in prefixed:
+            ranked.setdefault(position, (1 if position in first else 2, 0, self.names[position]))
+        if len(ranked) < limit:
+            for position, similarity in self._similar(query).items():
+                ranked.setdefault(position, (3, -similarity, self.names[position]))
+        best = sorted(ranked, key=ranked.get)[:limit]
+        return [{**self.entries[position], "match": MATCHES[ranked[position][0]]} for position in best]
+
+def _cached(version):
+    """The cached index of a version, unless the version's manifest changed since (the database was flushed)."""
+    manifest, index = _indexes.get(version, (None, None))
+    return index if manifest is not None and manifest is dataset._manifests.get(version) else None
+
+def _store(version, manifest, entries):
+    index = LocationIndex(entries)
+    if manifest:
+        _indexes.clear() # readers almost always use the current version, keep only the last one used
+        _indexes[version] = (manifest, index)
+    return index
+
+def index(version=None) -> LocationIndex:
+    """The location index of a dataset version (the current one by default)."""
+    version = dataset.get_version() if version is None else int(version)
+    cached = _cached(version)
+    if cached is not None:
+        return cached
+    return _store(version, dataset.get_manifest(version), dataset.location_table(version))
+
+async def aindex(client, version) -> LocationIndex:
+    """Async version of `index` for an asyncio Redis client."""
+    version = int(version)
+    cached = _cached(version)
+    if cached is not None:
+        return cached
+    manifest = await dataset.aget_manifest(client, version)
+    return _store(version, manifest, await dataset.alocation_table(client, version))
+
+def resolve(identifiers, version=None) -> list:
+    """
+    Return the Location of each identifier (a name in any spelling, an ISO code or a LocID)
+    in a dataset version; identifiers of no location are returned as given.
+    """
+    if not identifiers:
+        return []
+    found = index(version)
+    return [found.resolve(identifier) or identifier for identifier in identifiers]
+
+async def aresolve(client, identifiers, version) -> list:
+    """Async version of `resolve` for an asyncio Redis client."""
+    if not identifiers:
+        return []
+    found = await aindex(client, version)
+    return [found.resolve(identifier) or identifier for identifier in identifiers]
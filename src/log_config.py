@@ -0,0 +1,114 @@
+"""
+Logging setup shared by the api, jobs and worker modules.
+
+Levels are configured once from the environment:
+    LOG_LEVEL=INFO                      default level for every module
+    LOG_LEVELS=worker=DEBUG,api=WARNING per-module overrides
+    LOG_FORMAT=json                     one json object per line instead of plain text
+    LOG_SAMPLE_EVERY=100                keep 1 in N messages logged with `log_sampled`
+
+Messages should pass their values as arguments (`logger.debug("job %s", jid)`) so nothing
+is formatted when the level is disabled. Values that are expensive to compute, such as a
+Redis call, can be wrapped in `Lazy` so they are only computed if the message is emitted.
+"""
+import json
+import logging
+import os
+import sys
+
+_configured = False
+_sample_counts = {}
+SAMPLE_EVERY = max(int(os.getenv("LOG_SAMPLE_EVERY", 100)), 1)
+
+class Lazy:
+    """
+    Defer calling `function(*args)` until the log message is actually formatted.
+    The result is computed once even if several handlers format the message.
+    """
+    _unset = object()
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self._value = self._unset
+
+    def value(self):
+        if self._value is self._unset:
+            self._value = self.function(*self.args)
+        return self._value
+
+    def __str__(self):
+        return str(self.value())
+
+    def __repr__(self):
+        return repr(self.value())
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line json objects, including any `extra` fields."""
+
+    _reserved = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in self._reserved})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def _module_name(name):
+    """Name scripts run with `python worker.py` after their file instead of __main__."""
+    if name == "__main__":
+        return os.path.splitext(os.path.basename(sys.argv[0]))[0] or name
+    return name
+
+def _level(name, default=logging.INFO):
+    return getattr(logging, name.strip().upper(), default)
+
+def setup_logging():
+    """Configure the root handler and per-module levels from the environment, once per process."""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+    handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "").lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(_level(log_level))
+
+    for override in filter(None, os.getenv("LOG_LEVELS", "").split(",")):
+        module, _, level = override.partition("=")
+        logging.getLogger(module.strip()).setLevel(_level(level))
+    root.info("Logging level set to %s", log_level)
+
+def get_logger(name) -> logging.Logger:
+    """Return the logger for module `name`, configuring logging on first use."""
+    setup_logging()
+    return logging.getLogger(_module_name(name))
+
+def log_sampled(logger, level, msg, *args, every=None):
+    """
+    Log only one in `every` calls of this message, for per-row and per-frame messages.
+    Nothing is counted or formatted when the level is disabled.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    every = every or SAMPLE_EVERY
+    key = (logger.name, msg)
+    count = _sample_counts.get(key, 0)
+    _sample_counts[key] = count + 1
+    if count % every == 0:
+        if every > 1:
+            msg = msg + " (1 in %d logged)"
+            args = args + (every,)
+        logger.log(level, msg, *args)
@@ -0,0 +1,351 @@
+"""
+Prometheus-style metrics shared by the api, jobs and worker modules.
+
+Metrics live in a process-wide registry and are rendered in the Prometheus text
+exposition format, either by the api `/metrics` route or by the small http server
+the worker starts with `start_http_server`. Processes serving the same `/metrics`, like
+the gunicorn workers of serve.py, `share` their counters and histograms through a
+directory of snapshots, so any of them renders the sum over all of them.
+"""
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from log_config import get_logger
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# latency buckets in seconds, size buckets in bytes
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 5e7)
+SHARE_INTERVAL = 5 # seconds between the snapshots of a sharing process, so at most this stale in the others
+EXITED = "exited.json" # snapshot of the processes that exited, in the shared directory
+
+# name of the code path currently talking to Redis, e.g. the Flask endpoint or "worker"
+call_site = contextvars.ContextVar("call_site", default="other")
+
+logger = get_logger(__name__)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_shared_dir = None # directory of the snapshots of the processes this one shares its metrics with
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _copy(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self, values=None):
+        values = self._copy() if values is None else values
+        return [(self.name, key, (), value) for key, value in values.items()]
+
+    def render(self, shared=()):
+        """Render the metric, added to its values in the states of other processes if it adds up."""
+        values = None
+        if shared and hasattr(self, "_add"):
+            values = self._copy()
+            for state in shared:
+                self._add(values, state.get(self.name, {}))
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples(values):
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+    def _merge(self, values):
+        with self._lock:
+            self._add(self._values, values)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @staticmethod
+    def _add(values, other):
+        for key, amount in other.items():
+            values[key] = values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """Compute the value at scrape time; `function` returns a number or a {labels tuple: value} dict."""
+        self._function = function
+
+    def samples(self, values=None):
+        if self._function is None:
+            return super().samples(values)
+        try:
+            value = self._function()
+        except Exception as e:
+            logger.warning("Could not collect gauge %s: %s", self.name, e)
+            return []
+        if isinstance(value, dict):
+            return [(self.name, tuple(str(v) for v in key), (), val) for key, val in value.items()]
+        return [(self.name, (), (), value)]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _add(self, values, other):
+        for key, (counts, total) in other.items():
+            own, own_total = values.get(key, ([0] * len(self.buckets), 0.0))
+            values[key] = ([a + b for a, b in zip(own, counts)], own_total + total)
+
+    def _copy(self) -> dict:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the `with` block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self, values=None):
+        values = self._copy() if values is None else values
+        samples = []
+        for key, (counts, total) in values.items():
+            for bound, count in zip(self.buckets, counts):
+                samples.append((f"{self.name}_bucket", key, (("le", _format_value(bound)),), count))
+            samples.append((f"{self.name}_count", key, (), counts[-1]))
+            samples.append((f"{self.name}_sum", key, (), total))
+        return samples
+
+def _register(cls, name, documentation, labelnames=(), **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"Metric {name} is already registered with a different type or labels.")
+        return metric
+
+def counter(name, documentation, labelnames=()) -> Counter:
+    """Return the counter called `name`, creating it on first use."""
+    return _register(Counter, name, documentation, labelnames)
+
+def gauge(name, documentation, labelnames=()) -> Gauge:
+    """Return the gauge called `name`, creating it on first use."""
+    return _register(Gauge, name, documentation, labelnames)
+
+def histogram(name, documentation, labelnames=(), buckets=TIME_BUCKETS) -> Histogram:
+    """Return the histogram called `name`, creating it on first use."""
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text format, summed over the processes sharing them."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    shared = _read_shared()
+    return "\n".join(metric.render(shared) for metric in metrics) + "\n"
+
+def _summable():
+    with _registry_lock:
+        return [metric for metric in _registry.values() if isinstance(metric, (Counter, Histogram))]
+
+def _load(path) -> dict:
+    """A snapshot written by `snapshot`, as returned by `drain`; empty if it is gone."""
+    try:
+        with open(path) as f:
+            encoded = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: {tuple(key): value for key, value in values} for name, values in encoded.items()}
+
+def _dump(state, path):
+    encoded = {name: [[list(key), value] for key, value in values.items()] for name, values in state.items()}
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(encoded, f)
+    os.replace(f"{path}.tmp", path) # readers see the previous snapshot or this one, never a partial one
+
+def _read_shared() -> list:
+    if _shared_dir is None:
+        return []
+    own = os.path.join(_shared_dir, f"{os.getpid()}.json")
+    return [_load(path) for path in glob.glob(os.path.join(_shared_dir, "*.json")) if path != own]
+
+def snapshot(directory):
+    """Write the counters and histograms of this process to <directory>/<pid>.json, for the processes sharing them."""
+    _dump({metric.name: metric._copy() for metric in _summable()}, os.path.join(directory, f"{os.getpid()}.json"))
+
+def share(directory, interval=SHARE_INTERVAL):
+    """
+    Share the counters and histograms of this process with the other processes using
+    `directory`: `render` adds up their snapshots, and this process writes its own every
+    `interval` seconds from a daemon thread. Call `snapshot` once more before exiting.
+    """
+    global _shared_dir
+    _shared_dir = directory
+
+    def write():
+        while True:
+            time.sleep(interval)
+            try:
+                snapshot(directory)
+            except OSError as e:
+                logger.warning("Could not write the metrics snapshot: %s", e)
+
+    threading.Thread(target=write, name="metrics-snapshot", daemon=True).start()
+
+def archive(directory, pid):
+    """Fold the snapshot of process `pid`, which exited, into the one of every exited process, so its counts stay."""
+    path = os.path.join(directory, f"{pid}.json")
+    exited = _load(os.path.join(directory, EXITED))
+    for name, values in _load(path).items():
+        metric = _registry.get(name)
+        if metric is not None:
+            metric._add(exited.setdefault(name, {}), values)
+    _dump(exited, os.path.join(directory, EXITED))
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def drain() -> dict:
+    """
+    Return the values of every counter and histogram and reset them, so a child process can
+    hand what it recorded to its parent, which adds them to its own with `merge`.
+    """
+    state = {}
+    for metric in _summable():
+        with metric._lock:
+            if metric._values:
+                state[metric.name] = metric._values
+                metric._values = {}
+    return state
+
+def merge(state):
+    """Add the values returned by `drain` in another process to the metrics of this one."""
+    for name, values in state.items():
+        metric = _registry.get(name)
+        if metric is not None:
+            metric._merge(values)
+
+@contextmanager
+def site(name):
+    """Attribute the Redis calls made inside the `with` block to call site `name`."""
+    token = call_site.set(name)
+    try:
+        yield
+    finally:
+        call_site.reset(token)
+
+redis_commands = histogram("wpp_redis_command_seconds", "Latency of Redis commands by call site.",
+                           ("db", "command", "site"))
+
+def instrument_redis(client, db):
+    """
+    Wrap a redis client so every command (and pipeline) is counted and timed per call site.
+    Returns the same client for convenience.
+    """
+    execute_command = client.execute_command
+    make_pipeline = client.pipeline
+
+    def timed_execute_command(*args, **options):
+        start = time.perf_counter()
+        try:
+            return execute_command(*args, **options)
+        finally:
+            command = str(args[0]).upper() if args else "UNKNOWN"
+            redis_commands.observe(time.perf_counter() - start, db=db, command=command, site=call_site.get())
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def timed_execute(*exec_args, **exec_kwargs):
+            start = time.perf_counter()
+            try:
+                return execute(*exec_args, **exec_kwargs)
+            finally:
+                redis_commands.observe(time.perf_counter() - start, db=db, command="PIPELINE", site=call_site.get())
+
+        pipe.execute = timed_execute
+        return pipe
+
+    client.execute_command = timed_execute_command
+    client.pipeline = timed_pipeline
+    return client
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics server: " + format, *args)
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve `/metrics` from a daemon thread, for processes that are not Flask apps."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info("Serving metrics on port %s", port)
+    return server
@@ -0,0 +1,86 @@
+"""
+Query layer shared by the read routes.
+
+`plan` turns a request for a year range, a set of regions and a set of fields into the
+least work for one dataset version: the years of the range the version holds are looked
+up in its cached manifest, so years it lacks are never fetched and an empty range or an
+empty dataset costs no further round trip. `execute` then reads every remaining year at
+once, from the memory-mapped columnar file when the node has one, otherwise with a single
+MGET, and keeps only the requested regions and fields of each row. Regions may be given by
+any identifier of a location (see locations.py); plans hold their Location names. A
+variant selects the partition of the version to read (see dataset.py); reads without one
+never look up the version's partitions.
+"""
+import dataset
+import locations
+
+KEY_FIELDS = ("Location", "Time") # always kept so projected rows can still be told apart
+
+class Plan:
+    """The dataset version, partition, years and row shape of one read."""
+
+    def __init__(self, version, year_keys, manifest, regions=None, fields=None, partition=None):
+        self.version = version
+        self.partition = partition
+        self.year_keys = year_keys
+        self.fetch = [year for year in year_keys if year in manifest]
+        self.regions = list(regions or [])
+        fields = [field for field in fields or [] if field]
+        self.fields = list(dict.fromkeys([*KEY_FIELDS, *fields])) if fields else []
+
+    @property
+    def empty(self) -> bool:
+        return not self.fetch
+
+    def __repr__(self):
+        return (f"<Plan version={self.version} partition={self.partition} years={len(self.year_keys)} fetch={len(self.fetch)} "
+                f"regions={len(self.regions)} fields={len(self.fields)}>")
+
+def _year_keys(start_year, end_year, manifest):
+    if start_year is None:
+        return sorted(manifest, key=int)
+    return [str(year) for year in range(start_year, end_year + 1)]
+
+def plan(start_year=None, end_year=None, regions=None, fields=None, version=None, variant=None) -> Plan:
+    """
+    Plan a read of the years from start_year to end_year (every year of the version if
+    omitted), of the current dataset version unless one is given, and of its default
+    partition unless a variant is. Raises ValueError for variants the version lacks.
+    """
+    version = dataset.get_version() if version is None else int(version)
+    partition = dataset.partition(variant, version)
+    manifest = dataset.get_manifest(version, partition)
+    regions = locations.resolve(regions, version)
+    return Plan(version, _year_keys(start_year, end_year, manifest), manifest, regions, fields, partition)
+
+async def aplan(client, start_year=None, end_year=None, regions=None, fields=None, version=None, variant=None) -> Plan:
+    """Async version of `plan` for an asyncio Redis client."""
+    version = int(await client.get(dataset.VERSION_KEY) or 0) if version is None else int(version)
+    partition = await dataset.apartition(client, variant, version)
+    manifest = await dataset.aget_manifest(client, version, partition)
+    regions = await locations.aresolve(client, regions, version)
+    return Plan(version, _year_keys(start_year, end_year, manifest), manifest, regions, fields, partition)
+
+def _shape(plan, rows):
+    if plan.regions:
+        rows = [row for row in rows if row.get("Location") in plan.regions]
+    if plan.fields:
+        rows = [{field: row[field] for field in plan.fields if field in row} for row in rows]
+    return rows
+
+def _align(plan, years_data):
+    """Spread the rows read for plan.fetch over plan.year_keys, None for missing years."""
+    found = {year: _shape(plan, rows) for year, rows in zip(plan.fetch, years_data) if rows is not None}
+    return [found.get(year) for year in plan.year_keys]
+
+def execute(plan: Plan) -> list:
+    """Return the rows of each year of the plan, None for years the dataset version lacks."""
+    if plan.empty:
+        return [None] * len(plan.year_keys)
+    return _align(plan, dataset.read_years(plan.fetch, plan.version, plan.regions, plan.partition))
+
+async def aexecute(client, plan: Plan) -> list:
+    """Async version of `execute` for an asyncio Redis client."""
+    if plan.empty:
+        return [None] * len(plan.year_keys)
+    return _align(plan, await dataset.aread_years(client, plan.fetch, plan.version, plan.regions, plan.partition))
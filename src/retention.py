@@ -0,0 +1,129 @@
+"""
+Retention of job records and results.
+
+A finished job's record and result hash get a TTL when the worker finishes it (see
+`jobs.retention`), so Redis expires them itself. `compact` removes what TTLs do not
+cover: results of jobs that no longer exist (deleted, or expired before their result),
+index entries of expired jobs and groups none of whose jobs exist, and reports the bytes
+it reclaimed. It also recomputes the running backlog cost of the queue.
+
+Workers compact every COMPACT_INTERVAL seconds, one at a time; `python retention.py`
+compacts once, e.g. from a cron job.
+"""
+import json
+import os
+import threading
+
+import jobs
+import metrics
+from charts import KEY_PREFIX as CHART_PREFIX
+from framecache import KEY_PREFIX as FRAME_PREFIX
+from log_config import get_logger
+from storage import LazyClient
+
+jdb = LazyClient("jobs")
+resdb = LazyClient("results")
+
+logger = get_logger(__name__)
+
+COMPACT_INTERVAL = int(os.environ.get("COMPACT_INTERVAL", 900)) # seconds between compactions of a worker, 0 never
+LOCK_KEY = "Compact-Lock" # in the queue database, held by the worker compacting
+BATCH = 1000
+CACHE_PREFIXES = (CHART_PREFIX, FRAME_PREFIX) # keys of the results database that are caches, not job results
+
+reclaimed_bytes = metrics.counter("wpp_retention_reclaimed_bytes_total", "Bytes of results removed by compaction.")
+removed_keys = metrics.counter("wpp_retention_removed_total", "Keys and index entries removed by compaction.",
+                               ("kind",))
+
+def _batches(keys):
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _missing_jobs(jids) -> list:
+    pipe = jdb.pipeline(transaction=False)
+    for jid in jids:
+        pipe.exists(jid)
+    return [jid for jid, exists in zip(jids, pipe.execute()) if not exists]
+
+def compact_results() -> tuple:
+    """Unlink the result hashes of jobs that no longer exist; return (results, bytes) removed."""
+    count = size = 0
+    keys = (key for key in resdb.scan_iter(count=BATCH)
+            if not key.decode('utf-8').startswith(CACHE_PREFIXES))
+    for batch in _batches(keys):
+        orphans = _missing_jobs(batch)
+        if orphans:
+            size += sum(jobs.result_size(key) for key in orphans)
+            count += resdb.unlink(*orphans)
+    return count, size
+
+def compact_index() -> int:
+    """Remove the index entries of jobs that no longer exist; return how many jobs were removed."""
+    index_keys = list(jdb.scan_iter(match=f"{jobs.INDEX_PREFIX}*", count=BATCH))
+    count = 0
+    for batch in _batches(jid for jid, _ in jdb.zscan_iter(jobs.SUBMITTED_INDEX, count=BATCH)):
+        orphans = _missing_jobs(batch)
+        if orphans:
+            pipe = jdb.pipeline(transaction=False)
+            for key in index_keys:
+                pipe.zrem(key, *orphans)
+            pipe.execute()
+            count += len(orphans)
+    return count
+
+def compact_groups() -> int:
+    """Unlink the groups none of whose jobs exist; return how many were removed."""
+    count = 0
+    for batch in _batches(jdb.scan_iter(match=f"{jobs.GROUP_PREFIX}*", count=BATCH)):
+        empty = []
+        for key, group in zip(batch, jdb.mget(batch)):
+            jids = json.loads(group)['jobs'] if group is not None else []
+            if jids and not jdb.exists(*jids):
+                empty.append(key)
+        if empty:
+            count += jdb.unlink(*empty)
+    return count
+
+def compact() -> dict:
+    """Remove orphaned results, index entries and groups; return what was removed and the bytes reclaimed."""
+    results, size = compact_results()
+    stats = {"results": results, "index_entries": compact_index(), "groups": compact_groups(), "bytes": size}
+    for kind in ("results", "index_entries", "groups"):
+        removed_keys.inc(stats[kind], kind=kind)
+    reclaimed_bytes.inc(size)
+    jobs.reconcile_backlog() # a full pass over the queued costs, which the running total otherwise avoids
+    logger.info("Compaction removed %s results (%s bytes), %s index entries and %s groups.",
+                results, size, stats["index_entries"], stats["groups"])
+    return stats
+
+def unlink_all(client) -> int:
+    """Unlink every key of a database in batches; return how many were removed."""
+    return sum(client.unlink(*batch) for batch in _batches(client.scan_iter(count=BATCH)))
+
+def _compact_periodically(interval, stop):
+    queue_redis = jobs._queue_redis()
+    while not stop.wait(interval):
+        # held for most of the interval, so only one worker of a deployment compacts per interval
+        if not queue_redis.set(LOCK_KEY, "1", nx=True, ex=max(interval - 1, 1)):
+            continue
+        try:
+            compact()
+        except Exception as e:
+            logger.error("Compaction failed: %s", e)
+
+def start(interval=COMPACT_INTERVAL):
+    """Compact every `interval` seconds in a daemon thread; return an event that stops it, None if disabled."""
+    if not interval:
+        return None
+    stop = threading.Event()
+    threading.Thread(target=_compact_periodically, args=(interval, stop), daemon=True, name="compactor").start()
+    return stop
+
+if __name__ == '__main__':
+    print(compact())
@@ -0,0 +1,106 @@
+"""
+Production server for the API.
+
+Runs the app under gunicorn with several worker processes. The app is imported once in
+the master process before forking (preload), so the modules and any read-only data
+loaded at import time are shared copy-on-write by every worker.
+
+    python serve.py                    # WSGI: Flask app on threaded workers
+    SERVER_MODE=asgi python serve.py   # ASGI: async read routes on uvicorn workers
+
+Settings (environment):
+    SERVER_MODE=wsgi|asgi    which app and worker class to run (default wsgi)
+    WEB_BIND=0.0.0.0:5000    address to listen on
+    WEB_WORKERS              worker processes (default 2 x CPUs + 1, the CPUs of the container's quota)
+    WEB_THREADS=4            threads per worker in wsgi mode
+    WEB_TIMEOUT=120          seconds before a silent worker is restarted
+    WEB_MAX_REQUESTS=0       restart workers after this many requests (0 disables)
+    METRICS_DIR              directory the workers share their metrics through (default a new
+                             temporary one), so /metrics adds up every worker, see metrics.share
+"""
+import gc
+import math
+import os
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+import metrics
+
+def available_cpus() -> int:
+    """CPUs this process may use: its cgroup's CPU quota if it has one (in a container), else its CPU affinity."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f: # cgroup v2
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try: # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as g:
+                quota, period = f.read().strip(), g.read().strip()
+        except OSError:
+            quota, period = "max", "1"
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    if quota not in ("max", "-1"):
+        cpus = min(cpus, max(math.ceil(int(quota) / int(period)), 1))
+    return cpus
+
+def _post_fork(server, worker):
+    metrics.drain() # values the master recorded before forking are its own
+    metrics.share(os.environ["METRICS_DIR"])
+
+def _worker_exit(server, worker):
+    metrics.snapshot(os.environ["METRICS_DIR"])
+
+def _child_exit(server, worker):
+    metrics.archive(os.environ["METRICS_DIR"], worker.pid)
+
+def settings() -> dict:
+    """Gunicorn settings from the environment."""
+    mode = os.environ.get("SERVER_MODE", "wsgi").lower()
+    config = {
+        "bind": os.environ.get("WEB_BIND", "0.0.0.0:5000"),
+        "workers": int(os.environ.get("WEB_WORKERS", available_cpus() * 2 + 1)),
+        "timeout": int(os.environ.get("WEB_TIMEOUT", 120)),
+        "max_requests": int(os.environ.get("WEB_MAX_REQUESTS", 0)),
+        "max_requests_jitter": int(os.environ.get("WEB_MAX_REQUESTS", 0)) // 10,
+        "preload_app": True,
+        "accesslog": "-",
+        "post_fork": _post_fork,
+        "worker_exit": _worker_exit,
+        "child_exit": _child_exit,
+    }
+    if mode == "asgi":
+        config["worker_class"] = "uvicorn.workers.UvicornWorker"
+    else:
+        config["worker_class"] = "gthread"
+        config["threads"] = int(os.environ.get("WEB_THREADS", 4))
+    return config
+
+def load_app():
+    """Import the app in the master process, before the workers are forked."""
+    if os.environ.get("SERVER_MODE", "wsgi").lower() == "asgi":
+        from asgi import app
+    else:
+        from api import app
+    import charts
+    if charts.SYNC_MAX_COST > 0:
+        charts.preload()
+    # objects created so far are never freed, keep the collector from touching (and copying) their pages
+    gc.freeze()
+    return app
+
+class Server(BaseApplication):
+    def __init__(self, app, options):
+        self.application = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+if __name__ == '__main__':
+    os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp(prefix="wpp-metrics-"))
+    Server(load_app(), settings()).run()
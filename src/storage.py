@@ -0,0 +1,146 @@
+"""
+Redis clients shared by the api, jobs and worker modules.
+
+Every database gets one connection pool per process, created on first use so importing
+a module never opens a connection. Pools are configured from the environment:
+    REDIS_HOST, REDIS_PORT           server address (REDIS_SOCKET=/path uses a unix socket instead)
+    REDIS_PROTOCOL=3                 speak RESP3 instead of RESP2
+    REDIS_MAX_CONNECTIONS=50         connections per pool; callers wait for a free one
+    REDIS_POOL_TIMEOUT=5             seconds to wait for a free connection
+    REDIS_SOCKET_TIMEOUT=5           seconds before a command times out (the queue pool never
+                                     times out since workers block on it waiting for jobs)
+    REDIS_CONNECT_TIMEOUT=2          seconds before connecting times out
+    REDIS_RETRIES=3                  retries on connection errors and timeouts
+    REDIS_BACKOFF_BASE=0.05          first retry delay in seconds, doubled on every retry
+    REDIS_BACKOFF_CAP=2              longest retry delay in seconds
+    REDIS_HEALTH_CHECK_INTERVAL=30   seconds a connection may idle before it is pinged
+"""
+import os
+import threading
+
+import redis
+import redis.asyncio
+import redis.asyncio.retry
+from hotqueue import HotQueue
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+import metrics
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+DATABASES = {"data": 0, "queue": 1, "jobs": 2, "results": 3}
+QUEUE_NAME = "queue"
+
+_lock = threading.Lock()
+_pools = {}
+_clients = {}
+_async_clients = {}
+
+def _env_number(name, default, cast=float):
+    return cast(os.environ.get(name, default))
+
+def _connection_kwargs(name, retry_class=Retry):
+    """Connection settings shared by every pool, for database `name`."""
+    kwargs = {
+        "db": DATABASES[name],
+        "socket_timeout": None if name == "queue" else _env_number("REDIS_SOCKET_TIMEOUT", 5),
+        "socket_connect_timeout": _env_number("REDIS_CONNECT_TIMEOUT", 2),
+        "health_check_interval": _env_number("REDIS_HEALTH_CHECK_INTERVAL", 30, int),
+        "retry": retry_class(ExponentialBackoff(cap=_env_number("REDIS_BACKOFF_CAP", 2),
+                                          base=_env_number("REDIS_BACKOFF_BASE", 0.05)),
+                       _env_number("REDIS_RETRIES", 3, int)),
+        "retry_on_error": [redis.exceptions.ConnectionError, redis.exceptions.TimeoutError],
+        "protocol": _env_number("REDIS_PROTOCOL", 2, int),
+    }
+    socket_path = os.environ.get("REDIS_SOCKET")
+    if socket_path:
+        kwargs["connection_class"] = redis.UnixDomainSocketConnection
+        kwargs["path"] = socket_path
+    else:
+        kwargs["socket_keepalive"] = True
+        kwargs["host"] = os.environ.get("REDIS_HOST")
+        kwargs["port"] = _env_number("REDIS_PORT", 6379, int)
+    return kwargs
+
+def get_pool(name) -> redis.ConnectionPool:
+    """Return the connection pool of database `name` ("data", "queue", "jobs" or "results")."""
+    with _lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = redis.BlockingConnectionPool(
+                max_connections=_env_number("REDIS_MAX_CONNECTIONS", 50, int),
+                timeout=_env_number("REDIS_POOL_TIMEOUT", 5),
+                **_connection_kwargs(name))
+            logger.debug("Created connection pool for the %s database", name)
+        return pool
+
+def get_client(name):
+    """Return the shared client of database `name`; "queue" returns the HotQueue."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    if name == "queue":
+        client = HotQueue(QUEUE_NAME, connection_pool=get_pool(name))
+        metrics.instrument_redis(client._HotQueue__redis, name)
+    else:
+        client = metrics.instrument_redis(redis.Redis(connection_pool=get_pool(name)), name)
+    with _lock:
+        return _clients.setdefault(name, client)
+
+def get_async_client(name) -> redis.asyncio.Redis:
+    """
+    Return the shared asyncio client of database `name`, for the async read routes.
+    Its pool belongs to the event loop of the process that first uses it.
+    """
+    client = _async_clients.get(name)
+    if client is None:
+        kwargs = _connection_kwargs(name, retry_class=redis.asyncio.retry.Retry)
+        if "path" in kwargs:
+            kwargs["connection_class"] = redis.asyncio.UnixDomainSocketConnection
+        pool = redis.asyncio.BlockingConnectionPool(
+            max_connections=_env_number("REDIS_MAX_CONNECTIONS", 50, int),
+            timeout=_env_number("REDIS_POOL_TIMEOUT", 5),
+            **kwargs)
+        client = _async_clients.setdefault(name, redis.asyncio.Redis(connection_pool=pool))
+    return client
+
+async def close_async_clients():
+    """Close every asyncio client, when the event loop that owns them shuts down."""
+    clients = list(_async_clients.values())
+    _async_clients.clear()
+    for client in clients:
+        await client.aclose()
+
+def set_client(name, client):
+    """Replace the client of database `name` for every module, e.g. with fakeredis in tests."""
+    with _lock:
+        _clients[name] = client
+
+def reset():
+    """Forget every client and disconnect every pool."""
+    with _lock:
+        for pool in _pools.values():
+            pool.disconnect()
+        _pools.clear()
+        _clients.clear()
+        _async_clients.clear()
+
+class LazyClient:
+    """
+    Stand-in for a module level client that resolves the shared client on every use,
+    so modules can keep `rd.get(...)` style calls without connecting at import time.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_client(self._name), attribute)
+
+    def __len__(self):
+        return len(get_client(self._name))
+
+    def __repr__(self):
+        return f"<LazyClient {self._name}>"
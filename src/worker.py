@@ -1,51 +1,144 @@
-import redis 
 import os
 import logging 
-from hotqueue import HotQueue 
-from jobs import update_job_status, get_job_by_id, string_to_bool
-from api import get_year 
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import matplotlib.cm as cm
-import matplotlib.colors as mcolors
-import numpy as np
+from jobs import (FINISHED, JobCancelled, JobFinished, apply_retention, check_cancelled, clear_cancelled, update_job_status,
+                  get_job_by_id, get_group, job_finished, job_started, requeue_job, string_to_bool)
 from collections import defaultdict
 import json 
-from sklearn.linear_model import LinearRegression
+import multiprocessing
+import multiprocessing.connection
+import signal
+import threading
+import time
+from io import BytesIO
+import dataset
+import export
+import framecache
+import query
+import metrics
+import retention
+from log_config import get_logger, log_sampled
+from storage import LazyClient
 
-_redis_port=6379 
-_redis_host = os.environ.get("REDIS_HOST") # AI used to understand environment function 
+rd = LazyClient("data")
+q = LazyClient("queue")
+resdb = LazyClient("results")
 
-rd = redis.Redis(host=_redis_host, port=_redis_port, db=0)
-q = HotQueue("queue", host=_redis_host, port=_redis_port, db=1) 
-resdb = redis.Redis(host=_redis_host, port=_redis_port, db=3) 
+logger = get_logger(__name__)
 
-log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-numeric_level = getattr(logging, log_level, logging.INFO)
+THUMBNAIL_WIDTH = int(os.environ.get("THUMBNAIL_WIDTH", 320)) # pixels, before cropping
+IDLE_EXIT = int(os.environ.get("WORKER_IDLE_EXIT", 0)) # seconds without a job before the worker exits, 0 never
+RENDER_PROCESSES = int(os.environ.get("RENDER_PROCESSES", 0)) # pre-warmed processes running the jobs, 0 runs them here
+RENDER_RECYCLE = int(os.environ.get("RENDER_RECYCLE", 50)) # jobs a render process runs before it is replaced, 0 never
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100)) # 0 serves no metrics
+STOP_POLL = 1 # seconds a worker waits for a job before checking whether it was asked to stop
 
-logging.basicConfig(
-    level=numeric_level,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+_group_cache = {} # data slice of the most recent job group and dataset version, shared by all of its jobs
+_stopping = threading.Event() # set on SIGTERM, see `stop`
 
-logger = logging.getLogger(__name__)
-logger.info("Logging level set to %s", log_level)
+class WorkerStopping(Exception):
+    """Raised between the frames of a job once its worker was asked to stop, so the job is requeued."""
 
-def manipulate_data(job_data):
+job_wait = metrics.histogram("wpp_job_wait_seconds", "Time jobs spent queued before a worker picked them up.",
+                             ("plot_type",))
+job_run = metrics.histogram("wpp_job_run_seconds", "Time spent processing a job.", ("plot_type", "status"))
+frame_render = metrics.histogram("wpp_render_frame_seconds", "Time spent rendering one frame of a plot.",
+                                 ("plot_type", "animate"))
+result_bytes = metrics.histogram("wpp_result_bytes", "Size of each value stored in the results database.",
+                                 ("plot_type", "field"), buckets=metrics.SIZE_BUCKETS)
+processes_lost = metrics.counter("wpp_render_processes_lost_total", "Render processes that died while running a job.")
+
+def stop(signum=None, frame=None):
+    """
+    Ask the worker to stop, e.g. on SIGTERM when it is scaled down: it takes no new job and
+    the job it is running is requeued before its next frame, for another worker to finish.
+    """
+    _stopping.set()
+
+def between_frames(jobid):
+    """Raise JobCancelled or WorkerStopping if a job should not go on to its next frame or chunk."""
+    check_cancelled(jobid)
+    if _stopping.is_set():
+        raise WorkerStopping(jobid)
+
+def store_result(jobid, field, value, plot_type):
+    """Store one field of a job result and record its size."""
+    resdb.hset(jobid, field, value)
+    result_bytes.observe(len(value), plot_type=plot_type, field=field.split('_')[0])
+
+def render_options(job_dict=None) -> dict:
+    """
+    This function reads the output options of a job: the image format (png or svg), the dpi,
+    whether to also store thumbnails, and the render profile. The fast profile computes the
+    cropped layout of the first frame once and reuses it instead of a tight bbox pass per frame.
+    """
+    job_dict = job_dict or {}
+    return {"format": job_dict.get("format") or "png", "dpi": int(job_dict["dpi"]) if job_dict.get("dpi") else None,
+            "thumbnail": string_to_bool(job_dict.get("thumbnail") or "false"), "fast": job_dict.get("profile") == "fast",
+            "bbox": None, "sizes": {}}
+
+def crop_box(fig):
+    """The padded tight bounding box of a figure, which the fast profile crops every frame of a job to."""
+    return fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.1)
+
+def save_frame(fig, jobid, field, options, plot_type):
+    """
+    This function renders a figure in the job's output format and stores it under `field`
+    (image or image_<year>), plus a thumbnail png under thumb or thumb_<year> if requested.
+    It returns the files it rendered by name (image, thumb).
+    """
+    if options["fast"]:
+        if options["bbox"] is None:
+            options["bbox"] = crop_box(fig)
+        bbox = options["bbox"]
+    else:
+        bbox = 'tight'
+    buffer = BytesIO()
+    with frame_render.time(plot_type=plot_type, animate=False):
+        fig.savefig(buffer, format=options["format"], dpi=options["dpi"], bbox_inches=bbox)
+    files = {"image": buffer.getvalue()}
+
+    if options["thumbnail"]:
+        buffer = BytesIO()
+        fig.savefig(buffer, format="png", dpi=THUMBNAIL_WIDTH / fig.get_figwidth(), bbox_inches=bbox)
+        files["thumb"] = buffer.getvalue()
+    store_frame(jobid, field, files, options, plot_type)
+    return files
+
+def store_frame(jobid, field, files, options, plot_type):
+    """This function stores the files of a frame by name (image, thumb) under `field` and its thumbnail field."""
+    for name, value in files.items():
+        target = name + field[len("image"):]
+        store_result(jobid, target, value, plot_type)
+        options["sizes"][target] = len(value)
+
+def frame_options(options) -> list:
+    """
+    The output options a cached frame must have been rendered with to be reused, see framecache.py,
+    including the crop of the fast profile so a job never mixes frames cropped differently.
+    """
+    bbox = options["bbox"] and [round(bound, 3) for bound in options["bbox"].bounds]
+    return [options["format"], options["dpi"], options["thumbnail"] and THUMBNAIL_WIDTH, options["fast"], bbox]
+
+def read_rows(start, end, regions, fields=None, version=None, variant=None) -> list:
+    """Return the rows of the years from start to end of the given regions, through the query layer."""
+    start, end = sorted((int(start), int(end)))
+    plan = query.plan(start, end, regions, fields, version, variant)
+    return [row for year_rows in query.execute(plan) if year_rows for row in year_rows]
+
+def manipulate_data(job_data, version=None):
     """
     This function takes the job data and manipulates it to create a new data structure.
-    It organizes the data by year and location.
+    It organizes the data by year and location, read from the given dataset version.
     """
     start = job_data.get('start')
     end = job_data.get('end') 
     regions = job_data.get('location')
     if regions is None:
         regions = 'World'
-    raw_data = get_year(f'{start}-{end}', regions)
-    # raw_data = raw_data.json() 
+    raw_data = read_rows(start, end, regions.split(","), version=version, variant=job_data.get('variant'))
     new_data = defaultdict(lambda: defaultdict(list))
-    logging.debug(f"Type of raw_data: {type(raw_data)}")
-    logging.debug(f'Parameters: {start}-{end}, {regions}')
+    logger.debug("Type of raw_data: %s", type(raw_data))
+    logger.debug('Parameters: %s-%s, %s', start, end, regions)
     for entry in raw_data:
         if not entry["Time"]:
             continue
@@ -56,19 +149,85 @@ def manipulate_data(job_data):
         new_data[year][location].append(entry)
     return {year: dict(locations) for year, locations in new_data.items()}
 
-def plot_data(new_data, jobid, start_year, end_year, plot_type='line', Location=None, query1='TPopulation1Jan', query2=None, animate=False):
+def save_animation(ani, filename, num_frames, plot_type):
+    """Save an animation as a gif and record the average render time of its frames."""
+    start = time.perf_counter()
+    try:
+        ani.save(filename, writer='pillow', fps=3)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    per_frame = (time.perf_counter() - start) / max(num_frames, 1)
+    for _ in range(num_frames):
+        frame_render.observe(per_frame, plot_type=plot_type, animate=True)
+
+def slice_data(data, start, end, regions):
+    """
+    This function takes data organized by year and location and keeps only the
+    years from start to end and the given regions.
+    """
+    start, end = sorted((int(start), int(end)))
+    sliced = {}
+    for year, locations in data.items():
+        if not start <= int(year) <= end:
+            continue
+        kept = {loc: entries for loc, entries in locations.items() if loc in regions}
+        if kept:
+            sliced[year] = kept
+    return sliced
+
+def group_data(group_id, version=None, variant=None):
+    """
+    This function fetches the data for the union of years and locations of a job group
+    once, and reuses it for every following job of the same group and dataset version.
+    Returns None for jobs of another variant than the group's data.
+    """
+    key = (group_id, version)
+    if key not in _group_cache:
+        group = get_group(group_id)
+        if "error" in group:
+            return None
+        _group_cache.clear()
+        _group_cache[key] = (group.get('variant'), manipulate_data(group, version))
+        logger.debug("Fetched shared data for group %s", group_id)
+    group_variant, data = _group_cache[key]
+    return data if group_variant == (variant or None) else None
+
+def export_data(job_dict, jobid, regions, version=None):
+    """
+    This function writes the year, location and field slice of an export job as a csv, parquet
+    or arrow file, stored chunk by chunk under export_<n>, without plotting anything.
+    """
+    fmt = job_dict.get("format") or "csv"
+    fields = [field for field in (job_dict.get("fields") or "").split(",") if field]
+    rows = read_rows(job_dict["start"], job_dict["end"], regions, fields, version, job_dict.get("variant"))
+    names = export.columns(rows, fields)
+    sizes = {}
+    for index, chunk in enumerate(export.encode(rows, fmt, names)):
+        between_frames(jobid)
+        field = export.chunk_field(index)
+        store_result(jobid, field, chunk, "export")
+        sizes[field] = len(chunk)
+    files = {"format": fmt, "rows": len(rows), "columns": names, "chunks": len(sizes), "sizes": sizes}
+    store_result(jobid, "files", json.dumps(files), "export")
+
+def plot_data(new_data, jobid, start_year, end_year, plot_type='line', Location=None, query1='TPopulation1Jan', query2=None, animate=False, options=None):
     """
     This function takes the data and creates a plot based on the specified parameters.
+    The figure is built once per job by a frame renderer (see frames.py) that only redraws
+    the data of each year. Output formats are set by `options`, see `render_options`.
     """
+    options = options or render_options()
     if query1 is None:
         query1 = 'TPopulation1Jan'
     
-    if query2 is not None and query1 is 'TPopulation1Jan':
+    if query2 is not None and query1 == 'TPopulation1Jan' and plot_type != "scatter": # a scatter plots both
         query1 = query2
         query2 = None
     
-    logging.debug(f'query1 is of type: {type(query1)}')
-    logging.debug(f'query1 has data: {query1}')
+    logger.debug('query1 is of type: %s', type(query1))
+    logger.debug('query1 has data: %s', query1)
 
     if Location is None:
         Location = ['World']
@@ -77,288 +236,334 @@ def plot_data(new_data, jobid, start_year, end_year, plot_type='line', Location=
     if plot_type is None:
         plot_type = 'line'
     
-    animate = animate or False
-    
+    import frames # matplotlib is only loaded by workers that render, not by export jobs
+    if plot_type not in frames.RENDERERS:
+        raise ValueError("Invalid plot type. Choose 'line', 'bar', or 'scatter'.")
+    animate = bool(animate) and plot_type != "line" # a line plot already shows every year in one image
 
     Time_range = [str(year) for year in range(start_year, end_year + 1)]
-    logging.debug(f'Time_range is of type: {type(Time_range)}')
-    logging.debug(f'Time_range has data: {Time_range}')
-    years_int = [int(y) for y in Time_range]
-    num_locations = len(Location) if Location else 0
-    
+    logger.debug('Time_range has data: %s', Time_range)
     if Location and len(Location) > 1: Location.sort()
-    logging.debug(f'Location is of type: {type(Location)}')
-    logging.debug(f'Location has data: {Location}')
+    logger.debug('Location has data: %s', Location)
+
+    def draw(year):
+        between_frames(jobid) # a cancelled job stops before its next frame
+        renderer.draw(year)
+
+    renderer = frames.RENDERERS[plot_type](new_data, Time_range, Location, query1, query2)
     if plot_type == "line":
-        plt.figure(figsize=(10, 6))
-        for loc in Location:
-            values = []
-            logging.debug("starting for loop for locations")
-            for year in Time_range:
-                try:
-                    entry = new_data[year][loc][0]
-                    val = float(entry[query1])
-                except (KeyError, IndexError, ValueError):
-                    val = None
-                values.append(val)
-                
-            if any(val is not None for val in values):
-                plt.plot(years_int, values, label=loc)
-        
-        plt.xlabel("Year")
-        plt.ylabel(f'{query1}')
-        plt.title(f"{query1} vs Year by Location")
-        plt.legend(loc='upper left', bbox_to_anchor=(1.02, 1), borderaxespad=0)
-        plt.grid(True)
-        plt.savefig(f'{jobid}.png', bbox_inches='tight')
-    
-    elif plot_type == "bar":
-        val_over_time = []
-        for year in Time_range:
-            year_values = []
-            for loc in Location:
-                try:
-                    val = float(new_data[year][loc][0][query1])
-                except (KeyError, IndexError, ValueError):
-                    val = None
-                year_values.append(val)
-            val_over_time.append(year_values)
-                    
-        cmap = plt.colormaps.get_cmap('Pastel1').resampled(num_locations)
-        colors = [mcolors.to_hex(cmap(i)) for i in range(num_locations)]
-                
-        if animate ==True:
-            fig, ax = plt.subplots(figsize=(10, 6))
-            bars = ax.bar(Location, val_over_time[0], color=colors)
-            ax.set_ylim(0, max(max(row) for row in val_over_time) * 1.1)
-            ax.set_ylabel(f"{query1}")
-            title = ax.set_title(f"{query1} in {years_int[0]}")
-            texts = [ax.text(bar.get_x() + bar.get_width()/2, bar.get_height(), f"{(bar.get_height()):,}", 
-                 ha='center', va='bottom', fontsize=9) for bar in bars]
-            
-            def update(frame):
-                year = years_int[frame]
-                title.set_text(f"{query1} in {year}")
-                for bar, height, text in zip(bars, val_over_time[frame], texts):
-                    bar.set_height(height)
-                    text.set_y(height)
-                    text.set_text(f"{(height):,}")
-                    
-            ani = animation.FuncAnimation(fig, update, frames=len(years_int), repeat=True, interval=1000)
-            ani.save(f'{jobid}.gif', writer='pillow', fps=3)
-            
-            
-        
-        elif animate == False:
-            for i, year in enumerate(Time_range):
-                fig, ax = plt.subplots(figsize=(10, 6))
-                bars = ax.bar(Location, val_over_time[i], color=colors)
-                ax.set_ylim(0, max(max(row) for row in val_over_time) * 1.1)
-                ax.set_ylabel(f"{query1}")
-                title = ax.set_title(f"{query1} in {year}")
-                
-                for bar in bars:
-                    height = bar.get_height()
-                    ax.text(bar.get_x() + bar.get_width()/2, height, f"{(height):,}", 
-                            ha='center', va='bottom', fontsize=9)
-                plt.tight_layout()
-                plt.savefig(f'{jobid}_{year}.png', bbox_inches='tight')
-                plt.close(fig)
-            
-            
-    elif plot_type == "scatter":
-        fig, ax = plt.subplots(figsize=(10, 6))
-        fig.subplots_adjust(right=0.75)
-        sc = ax.scatter([], [], alpha=1)
-        reg_line, = ax.plot([], [], color='red', lw=2, label='Regression Line')
-        title = ax.set_title("")
-        xlabel = ax.set_xlabel(f"{query1}")
-        ylabel = ax.set_ylabel(f"{query2}")
-        
-        x_vals_all, y_vals_all = [], []
+        between_frames(jobid)
+        save_frame(renderer.fig, jobid, "image", options, plot_type)
+    elif animate:
+        import matplotlib.animation as animation
+        ani = animation.FuncAnimation(renderer.fig, lambda frame: draw(Time_range[frame]),
+                                      frames=len(Time_range), repeat=True, interval=1000)
+        save_animation(ani, f'{jobid}.gif', len(Time_range), plot_type)
+    else:
+        if options["fast"] and options["bbox"] is None: # crop to the first frame, whether or not it is cached
+            renderer.draw(Time_range[0])
+            options["bbox"] = crop_box(renderer.fig)
         for year in Time_range:
-            for loc in Location:
-                try:
-                    entry = new_data[year][loc][0]
-                    x_vals_all.append(float(entry[query1]))
-                    y_vals_all.append(float(entry[query2]))
-                except (KeyError, IndexError, ValueError):
-                    continue
-        x_min, x_max = min(x_vals_all), max(x_vals_all)
-        y_min, y_max = min(y_vals_all), max(y_vals_all)
-        x_pad = (x_max - x_min) * 0.1
-        y_pad = (y_max - y_min) * 0.1
-        x_lim = (x_min - x_pad, x_max + x_pad)
-        y_lim = (y_min - y_pad, y_max + y_pad)
-        
-        unique_locations = sorted({loc for year in Time_range for loc in new_data[year].keys()})
-        num_locations = len(unique_locations)
-        cmap = plt.colormaps.get_cmap('plasma').resampled(num_locations)
-        loc_to_color = {loc: cmap(i) for i, loc in enumerate(unique_locations)}
-        
-        def plot_for_year(year):
-            ax.clear()
-            ax.set_xlabel(f"{query1}")
-            ax.set_ylabel(f"{query2}")
-            ax.set_title(f"{query1} vs {query2} in {year}")
-            ax.grid(True)
-            ax.set_xlim(x_lim)
-            ax.set_ylim(y_lim)
-            
-            x_vals, y_vals, labels = [], [], []
-            for loc in Location:
-                try:
-                    entry = new_data[year][loc][0]
-                    x = float(entry[query1])
-                    y = float(entry[query2])
-                    x_vals.append(x)
-                    y_vals.append(y)
-                    labels.append(loc)
-                except (KeyError, IndexError, ValueError):
-                    continue
-                
-            colors = [loc_to_color[loc] for loc in labels]
-            ax.scatter(x_vals, y_vals, c=colors, alpha=1)
-        
-            if len(x_vals) > 1:
-                X = np.array(x_vals).reshape(-1, 1)
-                y = np.array(y_vals)
-                model = LinearRegression().fit(X, y)
-                r_squared = model.score(X, y)
-                x_fit = np.linspace(x_lim[0], x_lim[1], 100).reshape(-1, 1)
-                y_fit = model.predict(x_fit)
-                reg_label = f"Regression Line (R²={r_squared:.2f})"
-                ax.plot(x_fit, y_fit, color='red', lw=2, label=reg_label)
-                location_handles = [plt.Line2D([0], [0], marker='o', linestyle='', color=loc_to_color[loc],
-                                               label=loc, markersize=7) for loc in unique_locations]
-
-                regression_handle = plt.Line2D([0], [0], color='red', lw=2, label=reg_label)
-                all_handles = [regression_handle] + location_handles
-                legend = ax.legend(handles=all_handles, loc='upper right', bbox_to_anchor=(1.4, 1), borderaxespad=0)
-                legend.get_frame().set_facecolor('none')
-                legend.get_frame().set_edgecolor('none')
-        
-        if animate == True:
-            def update(frame):
-                year = Time_range[frame]
-                plot_for_year(year)
-                
-            ani = animation.FuncAnimation(fig, update, frames=len(Time_range), repeat=True, interval=1000)
-            ani.save(f'{jobid}.gif', writer='pillow', fps=3)
-            
-        else:
-            for year in Time_range:
-                fig, ax = plt.subplots(figsize=(10, 6))  # Move inside loop
-                def plot_for_year_dynamic(ax, year):
-                    ax.set_xlabel(f"{query1}")
-                    ax.set_ylabel(f"{query2}")
-                    ax.set_title(f"{query1} vs {query2} in {year}")
-                    ax.grid(True)
-                    ax.set_xlim(x_lim)
-                    ax.set_ylim(y_lim)
-        
-                    x_vals, y_vals, labels = [], [], []
-                    for loc in Location:
-                        try:
-                            entry = new_data[year][loc][0]
-                            x = float(entry[query1])
-                            y = float(entry[query2])
-                            x_vals.append(x)
-                            y_vals.append(y)
-                            labels.append(loc)
-                        except (KeyError, IndexError, ValueError):
-                            continue
-                        
-                    colors = [loc_to_color[loc] for loc in labels]
-                    ax.scatter(x_vals, y_vals, c=colors, alpha=1)
-        
-                    if len(x_vals) > 1:
-                        X = np.array(x_vals).reshape(-1, 1)
-                        y_arr = np.array(y_vals)
-                        model = LinearRegression().fit(X, y_arr)
-                        r_squared = model.score(X, y_arr)
-                        x_fit = np.linspace(x_lim[0], x_lim[1], 100).reshape(-1, 1)
-                        y_fit = model.predict(x_fit)
-                        reg_label = f"Regression Line (R²={r_squared:.2f})"
-                        ax.plot(x_fit, y_fit, color='red', lw=2, label=reg_label)
-        
-                        location_handles = [plt.Line2D([0], [0], marker='o', linestyle='', color=loc_to_color[loc],
-                                                       label=loc, markersize=7) for loc in unique_locations]
-                        regression_handle = plt.Line2D([0], [0], color='red', lw=2, label=reg_label)
-                        all_handles = [regression_handle] + location_handles
-                        legend = ax.legend(handles=all_handles, loc='upper right', bbox_to_anchor=(1.3, 1), borderaxespad=0)
-                        legend.get_frame().set_facecolor('none')
-                        legend.get_frame().set_edgecolor('none')
-                        for text in legend.get_texts():
-                            text.set_ha("right")
-        
-                plot_for_year_dynamic(ax, year)
-                plt.savefig(f'{jobid}_{year}.png', bbox_inches='tight')
-                plt.close(fig)
+            between_frames(jobid)
+            frame_key = framecache.key(renderer.state(year), frame_options(options))
+            cached = framecache.get(frame_key)
+            if cached:
+                store_frame(jobid, f"image_{year}", cached, options, plot_type)
+                continue
+            renderer.draw(year)
+            framecache.put(frame_key, save_frame(renderer.fig, jobid, f"image_{year}", options, plot_type))
 
-            
-    else:
-        raise ValueError("Invalid plot type. Choose 'line', 'bar', or 'scatter'.")
-    
-    logging.debug("starting to save results")
-    logging.debug(f'animate option is {animate}')
-    if animate == False:
-        if plot_type == "bar" or plot_type == "scatter":
-            for year in Time_range:
-                filename = f"{jobid}_{year}.png"
-                try:
-                    with open(filename, 'rb') as f:
-                        image_data = f.read()
-                    logging.debug("successfully opened image")
-                    resdb.hset(jobid, f'image_{year}', image_data)
-                    logging.debug(f"Saved image_{year} to Redis for job {jobid}")
-                    resdb.hset(jobid,"data",json.dumps(new_data))
-                except FileNotFoundError:
-                    logging.error(f"File {filename} not found.")
-        elif plot_type == "line":
-            filename = f"{jobid}.png"
-            try:
-                with open(filename, 'rb') as f:
-                    image_data = f.read()
-                logging.debug("successfully opened image")
-                resdb.hset(jobid, "image", image_data)
-                resdb.hset(jobid,"data",json.dumps(new_data))
-            except FileNotFoundError:
-                logging.error(f"File {filename} not found.")
-            
-    elif animate == True:
+    logger.debug("starting to save results")
+    logger.debug('animate option is %s', animate)
+    if animate == True:
         with open(f'{jobid}.gif', 'rb') as f:
             gif_data = f.read()
-        resdb.hset(jobid, "gif", gif_data)
-        logging.debug("successfully saved gif to Redis")
+        os.remove(f'{jobid}.gif')
+        store_result(jobid, "gif", gif_data, plot_type)
+        options["sizes"]["gif"] = len(gif_data)
+        logger.debug("successfully saved gif to Redis")
+    else:
+        store_result(jobid, "data", json.dumps(new_data), plot_type)
+    files = {"format": "gif" if animate else options["format"], "dpi": options["dpi"],
+             "profile": "fast" if options["fast"] else "quality", "sizes": options["sizes"]}
+    store_result(jobid, "files", json.dumps(files), plot_type)
         
 
-@q.worker
 def update(jobid: str): 
-    logging.info(f"Started processing job: {jobid}")
+    with metrics.site("worker"):
+        process_job(jobid)
+
+def warm_up():
+    """
+    This function loads matplotlib and renders a throwaway frame of every plot type, so the
+    first job of a process does not pay for the fonts, colormaps and backend.
+    """
+    import frames
+    import matplotlib.animation
+    start = time.perf_counter()
+    frames.warm_up()
+    logger.info("Warmed up rendering in %.2f seconds", time.perf_counter() - start)
+
+def _render_loop(conn, recycle, environ):
+    """
+    Body of a render process: warm up, then run the jobs `conn` sends one at a time and send
+    back the metrics of each, until it is sent None or has run `recycle` jobs (0 never).
+    """
+    os.environ.update(environ) # the pool's environment, not the one the fork server started with
+    signal.signal(signal.SIGTERM, stop)
+    warm_up()
+    done = 0
+    while not recycle or done < recycle:
+        jobid = conn.recv()
+        if jobid is None:
+            break
+        update(jobid)
+        conn.send(metrics.drain())
+        done += 1
+
+class _RenderProcess:
+    """A render process of a RenderPool, the pipe to it and the job it is running."""
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.jobid = None
+        self.done = 0
+
+class RenderPool:
+    """
+    Pre-warmed processes running the jobs of this worker, started from a fork server so none is
+    forked from a process already running threads; create the pool before starting any. A job
+    runs in a free process and its metrics are merged back into this one. A process is replaced
+    after `recycle` jobs to bound the memory matplotlib accumulates, and when it dies, e.g.
+    killed for running out of memory, after marking its job as failed.
+    """
+
+    def __init__(self, processes, recycle=0):
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload(["worker", "frames", "matplotlib.animation"])
+        self._recycle = recycle
+        self._idle = [self._start() for _ in range(processes)]
+        self._busy = []
+
+    def _start(self):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_render_loop, args=(child_conn, self._recycle, dict(os.environ)),
+                                        daemon=True)
+        process.start()
+        child_conn.close()
+        return _RenderProcess(process, conn)
+
+    def _dispatch(self, jobid):
+        render = self._idle.pop()
+        try:
+            render.conn.send(jobid)
+        except OSError: # died while idle, the job never reached it
+            logger.error("Render process %s exited with code %s while idle.", render.process.pid,
+                         render.process.exitcode)
+            q.put(jobid)
+            self._idle.append(self._start())
+            return
+        render.jobid = jobid
+        self._busy.append(render)
+
+    def _collect(self, timeout):
+        """Wait up to `timeout` seconds for running jobs to finish, or their processes to die."""
+        waiting = [render.conn for render in self._busy] + [render.process.sentinel for render in self._busy]
+        ready = set(multiprocessing.connection.wait(waiting, timeout))
+        for render in [render for render in self._busy if {render.conn, render.process.sentinel} & ready]:
+            self._busy.remove(render)
+            try:
+                metrics.merge(render.conn.recv())
+            except EOFError: # died before sending the metrics of its job
+                self._lost(render)
+                continue
+            render.done += 1
+            if self._recycle and render.done >= self._recycle:
+                render.process.join()
+                render = self._start()
+            self._idle.append(render)
+
+    def _lost(self, render):
+        render.process.join()
+        logger.error("Render process %s exited with code %s while running job %s.", render.process.pid,
+                     render.process.exitcode, render.jobid)
+        processes_lost.inc()
+        fail_job(render.jobid)
+        self._idle.append(self._start())
+
+    def run(self, timeout=0):
+        """
+        Take a job off the queue whenever a process is free, until the worker is stopped or
+        no job arrived for `timeout` seconds (0 never), then wait for the running jobs. A
+        stopped worker passes SIGTERM on to its processes, which requeue their jobs.
+        """
+        idle_since = time.monotonic()
+        try:
+            while not _stopping.is_set():
+                self._collect(0 if self._idle else STOP_POLL)
+                if not self._idle:
+                    continue
+                jobid = q.get(block=True, timeout=STOP_POLL)
+                if jobid is None:
+                    if timeout and time.monotonic() - idle_since >= timeout:
+                        break
+                    continue
+                idle_since = time.monotonic()
+                self._dispatch(jobid)
+            if _stopping.is_set():
+                for render in self._busy:
+                    render.process.terminate() # SIGTERM, handled by `stop` as in this process
+            while self._busy:
+                self._collect(STOP_POLL)
+        finally:
+            for render in self._idle:
+                try:
+                    render.conn.send(None)
+                except OSError:
+                    pass
+            for render in self._busy:
+                render.process.terminate()
+            for render in self._idle + self._busy:
+                render.process.join()
+
+def serve(handle, idle_exit=0):
+    """
+    Pass queued jobs to `handle` one at a time, until the worker is stopped or, with
+    `idle_exit`, no job arrived for that many seconds.
+    """
+    idle_since = time.monotonic()
+    while not _stopping.is_set():
+        jobid = q.get(block=True, timeout=STOP_POLL)
+        if jobid is not None:
+            handle(jobid)
+            idle_since = time.monotonic()
+        elif idle_exit and time.monotonic() - idle_since >= idle_exit:
+            return
+
+def run():
+    """
+    This function processes jobs as they are queued, in RENDER_PROCESSES pre-warmed processes
+    if set. With WORKER_IDLE_EXIT set it returns once no job arrived for that many seconds, so
+    an autoscaler can scale the workers to zero. Meanwhile the databases are compacted every
+    COMPACT_INTERVAL seconds and metrics are served on METRICS_PORT. On SIGTERM it stops taking
+    jobs and requeues the running ones.
+    """
+    signal.signal(signal.SIGTERM, stop)
+    pool = RenderPool(RENDER_PROCESSES, RENDER_RECYCLE) if RENDER_PROCESSES else None # before any thread starts
+    if pool is None:
+        warm_up()
+    retention.start()
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+    if pool is not None:
+        pool.run(IDLE_EXIT)
+    else:
+        serve(update, IDLE_EXIT)
+    if _stopping.is_set():
+        logger.info("Stopped on request.")
+    elif IDLE_EXIT:
+        logger.info("No job for %s seconds, exiting.", IDLE_EXIT)
+
+def set_final_status(jobid, status) -> str:
+    """
+    Set the status of a finished job, which may have been deleted or finished otherwise (e.g.
+    cancelled) meanwhile; return the status it ended with.
+    """
     try:
+        update_job_status(jobid, status)
+    except JobFinished as e:
+        logger.info("Job %s is already %s, left it so.", jobid, e.status)
+        return e.status
+    except Exception as e:
+        logger.error("Failed to set status of job %s to '%s': %s", jobid, status, e)
+    return status
+
+def fail_job(jobid):
+    """
+    Mark as failed a job whose render process died while running it, doing what its
+    `process_job` could not. The dataset version it pinned is released after PIN_TTL.
+    """
+    status = set_final_status(jobid, 'error')
+    try:
+        job_finished(jobid)
+        clear_cancelled(jobid)
+        apply_retention(jobid, status)
+    except Exception as e:
+        logger.error("Failed to set the retention of job %s: %s", jobid, e)
+
+def process_job(jobid: str):
+    """
+    This function processes one job from the queue and records its wait and run times.
+    """
+    logger.info("Started processing job: %s", jobid)
+    start = time.perf_counter()
+    plot_type = 'unknown'
+    status = 'error'
+    # keep the dataset version this job reads from being garbage collected by a reload
+    version = dataset.pin(jobid)
+    try:
+        job_started(jobid)
+        between_frames(jobid) # cancelled after a worker took it off the queue, or the worker is stopping
         update_job_status(jobid, 'in progress')
 
         # WORK STARTING  
         job_dict = get_job_by_id(jobid)
-        logging.debug(f'job_dict is of type: {type(job_dict)}')
-        logging.debug(f'job_dict has data: {job_dict}')
+        logger.debug('job_dict is of type: %s', type(job_dict))
+        logger.debug('job_dict has data: %s', job_dict)
         if "error" in job_dict:
             raise Exception(f"Error retrieving job {jobid}: {job_dict['error']}")
+        plot_type = job_dict.get("plot_type") or 'line'
+        if job_dict.get("submitted_at"):
+            job_wait.observe(max(time.time() - float(job_dict["submitted_at"]), 0), plot_type=plot_type)
         
-        new_data = manipulate_data(job_dict) 
-        logging.debug(f'new_data is of type: {type(new_data)}')
-        logging.debug(f'new_data dictionaries: {new_data.keys()}')
-
         region_names = job_dict.get("location")
         regions = region_names.split(",") if region_names else ['World']
 
-        plot_data(new_data, jobid, int(job_dict["start"]), int(job_dict["end"]), job_dict.get("plot_type"), 
-                  regions, job_dict.get("query1"), job_dict.get("query2"), string_to_bool(job_dict.get("animate")))
+        if plot_type == "export":
+            export_data(job_dict, jobid, regions, version)
+        else:
+            shared_data = group_data(job_dict["group"], version, job_dict.get("variant")) if job_dict.get("group") else None
+            if shared_data is not None:
+                new_data = slice_data(shared_data, job_dict["start"], job_dict["end"], regions)
+            else:
+                new_data = manipulate_data(job_dict, version) 
+            logger.debug('new_data is of type: %s', type(new_data))
+            logger.debug('new_data dictionaries: %s', new_data.keys())
+
+            plot_data(new_data, jobid, int(job_dict["start"]), int(job_dict["end"]), job_dict.get("plot_type"), 
+                      regions, job_dict.get("query1"), job_dict.get("query2"), string_to_bool(job_dict.get("animate")),
+                      render_options(job_dict))
 
         update_job_status(jobid, 'complete') 
+        status = 'complete'
+    except JobCancelled:
+        status = 'cancelled'
+        resdb.delete(jobid) # frames rendered before the cancellation
+        logger.info("Job %s was cancelled, stopped processing it.", jobid)
+    except JobFinished as e: # cancelled before it was marked in progress or complete
+        status = e.status
+        if status == 'cancelled':
+            resdb.delete(jobid)
+        logger.info("Job %s is already %s, stopped processing it.", jobid, status)
+    except WorkerStopping:
+        status = 'requeued'
+        resdb.delete(jobid)
+        requeue_job(jobid)
+        logger.info("Worker is stopping, requeued job %s.", jobid)
     except Exception as e:
-        update_job_status(jobid, 'error')  # If something goes wrong, mark job as error.
-        logging.error(f"Error processing job {jobid}: {e}") 
+        logger.error("Error processing job %s: %s", jobid, e) 
+        status = set_final_status(jobid, 'error')  # If something goes wrong, mark job as error.
+    finally:
+        dataset.unpin(version, jobid)
+        try:
+            job_finished(jobid)
+            clear_cancelled(jobid)
+            if status in FINISHED:
+                apply_retention(jobid, status)
+        except Exception as e:
+            logger.error("Failed to set the retention of job %s: %s", jobid, e)
+        job_run.observe(time.perf_counter() - start, plot_type=plot_type, status=status)
 
-update() 
+if __name__ == '__main__':
+    run()
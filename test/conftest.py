@@ -0,0 +1,66 @@
+"""
+Fixtures shared by the test modules.
+
+A module whose every test runs against the databases declares
+    pytestmark = pytest.mark.usefixtures("redis_server")
+"""
+import socket
+import threading
+
+import fakeredis
+import pytest
+import redis
+from fakeredis import TcpFakeServer
+from hotqueue import HotQueue
+
+import admission
+import columnar
+import dataset
+import locations
+import storage
+import worker
+
+def reset_state():
+    """Forget the clients, and what the modules cached of the databases, of an earlier test."""
+    storage.reset()
+    dataset._manifests.clear()
+    dataset._partitions.clear()
+    dataset._materializing.clear()
+    columnar._tables.clear()
+    locations._indexes.clear()
+    admission._catalogs.clear()
+    worker._group_cache.clear()
+    worker._stopping.clear()
+
+def use_databases(pool):
+    """Point every database of `storage` at the server of `pool(db)`, the queue behind a HotQueue."""
+    for name, db in storage.DATABASES.items():
+        connection_pool = pool(db)
+        storage.set_client(name, HotQueue(storage.QUEUE_NAME, connection_pool=connection_pool) if name == "queue"
+                           else redis.Redis(connection_pool=connection_pool))
+
+@pytest.fixture
+def redis_server():
+    """A fresh fake redis server holding every database, and empty caches."""
+    reset_state()
+    server = fakeredis.FakeServer()
+    use_databases(lambda db: fakeredis.FakeRedis(server=server, db=db).connection_pool)
+    yield server
+    reset_state()
+
+@pytest.fixture
+def tcp_redis_server(monkeypatch):
+    """As `redis_server`, listening on a port other processes reach through REDIS_HOST and REDIS_PORT."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("REDIS_HOST", "127.0.0.1")
+    monkeypatch.setenv("REDIS_PORT", str(port))
+    reset_state()
+    use_databases(lambda db: redis.ConnectionPool(port=port, db=db))
+    yield server
+    reset_state()
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,107 @@
+import pytest
+import admission
+import dataset
+import jobs
+import storage
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+def load(years=(2000, 2001, 2002), locations=("World", "Chile")):
+    dataset.apply_update({str(year): [{"Location": loc, "Time": str(year), "TFR": "2", "LEx": "70"} for loc in locations]
+                          for year in years})
+
+def test_check_spec():
+    assert "POST /data" in admission.check_spec({"start": "2000", "end": "2001"})
+    load()
+    assert admission.check_spec({"start": "2000", "end": "2002", "location": "Chile,World", "query1": "TFR"}) is None
+    assert admission.check_spec({"start": "2000", "end": "2003"}) == "Years must be from 2000 to 2002."
+    assert admission.check_spec({"start": "2002", "end": "2000"}) == "Start must not be after end."
+    assert "Atlantis" in admission.check_spec({"start": "2000", "end": "2001", "location": "Chile,Atlantis"})
+    assert "GDP" in admission.check_spec({"start": "2000", "end": "2001", "query1": "TFR", "query2": "GDP"})
+    assert admission.check_spec({"start": "2000", "end": "2001", "plot_type": "export", "fields": "LEx,Time"}) is None
+
+def test_check_spec_variant():
+    rows = lambda year: [{"Location": "World", "Time": str(year), "TFR": "2"}]
+    dataset.apply_update({str(year): rows(year) for year in (2000, 2001)}, None,
+                         {"WPP2024:High": {str(year): rows(year) for year in (2000, 2001, 2002)}}, "WPP2024:Medium")
+    spec = {"start": "2000", "end": "2002", "variant": "high"}
+    assert admission.check_spec(spec) is None and spec["variant"] == "WPP2024:High"
+    spec = {"start": "2000", "end": "2001", "variant": "Medium"}
+    assert admission.check_spec(spec) is None and "variant" not in spec
+    assert admission.check_spec({"start": "2000", "end": "2002", "variant": "Medium"}) == "Years must be from 2000 to 2001."
+    assert "Unknown variant 'Low'" in admission.check_spec({"start": "2000", "end": "2001", "variant": "Low"})
+
+def test_catalog_follows_the_dataset_version():
+    load()
+    assert admission.catalog()["years"] == (2000, 2002)
+    load(years=(2000, 2001, 2002, 2003))
+    assert admission.catalog()["years"] == (2000, 2003)
+    assert admission.catalog()["indicators"] == {"TFR", "LEx"}
+
+def test_token_buckets(monkeypatch):
+    monkeypatch.setattr(admission, "RATE", 1.0)
+    monkeypatch.setattr(admission, "BURST", 2.0)
+    monkeypatch.setattr(admission, "COST_RATE", 10.0)
+    monkeypatch.setattr(admission, "COST_BURST", 100.0)
+    clock = [1000.0]
+    monkeypatch.setattr(admission.time, "time", lambda: clock[0])
+
+    assert admission.admit("a", 60) is None
+    reason, wait = admission.admit("a", 60) # the cost budget lacks 20
+    assert "slow down" in reason and wait == pytest.approx(2.0)
+    assert admission.admit("b", 60) is None # every client has its own buckets
+    clock[0] += 2
+    assert admission.admit("a", 60) is None
+    clock[0] += 0.5
+    assert admission.admit("a", 1) is None
+    assert admission.admit("a", 1)[1] == pytest.approx(0.5) # out of submissions
+    assert admission.check_cost(101) and admission.check_cost(100) is None
+
+def test_backlog_threshold(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_BACKLOG", 9)
+    jobs.add_job({"start": "2000", "end": "2004", "plot_type": "bar", "location": "Chile,World"})
+    assert admission.admit("a", 1) == ("The queue is too busy, try again later.", admission.RETRY_AFTER)
+    monkeypatch.setattr(admission, "MAX_BACKLOG", 0)
+    assert admission.admit("a", 1) is None
+
+def test_nightly_batch_is_admitted(monkeypatch):
+    import api
+    monkeypatch.setattr(api, "_batch_max", 5000)
+    locations = ["World", "Chile", "Peru", "Chad", "Mali"]
+    load(years=range(2000, 2010), locations=locations)
+    specs = [{"start": "2000", "end": "2009", "plot_type": "bar", "location": ",".join(locations[:1 + i % 5]),
+              "query1": "TFR"} for i in range(2000)] # ~2000 report jobs, costing 10 to 50 each
+    client = api.app.test_client()
+    response = client.post("/jobs/batch", json=specs)
+    assert response.status_code == 201 and len(response.get_json()["jobs"]) == 2000
+    assert jobs.queue_stats()["backlog_cost"] > admission.MAX_BACKLOG
+    # single submissions keep their own budget, and the backlog of the batch does not count against them
+    assert client.post("/jobs", json=specs[0]).status_code == 201
+    assert client.post("/jobs/batch", json=specs[:1]).status_code == 429 # another batch waits for it to drain
+    budget = storage.get_client("queue")._HotQueue__redis.hget(f"{admission.KEY_PREFIX}127.0.0.1", "batch_budget")
+    assert float(budget) == pytest.approx(admission.BATCH_COST_BURST - 60000, abs=100)
+    expensive = {**specs[0], "end": "2009", "location": ",".join(locations * 1000)}
+    response = client.post("/jobs/batch", json=[specs[0], expensive])
+    assert response.status_code == 400 and response.get_json()["invalid"][0]["index"] == 1
+
+def test_batch_budget(monkeypatch):
+    monkeypatch.setattr(admission, "COST_BURST", 100.0)
+    monkeypatch.setattr(admission, "BATCH_COST_BURST", 1000.0)
+    monkeypatch.setattr(admission, "BATCH_COST_RATE", 10.0)
+    assert admission.check_cost(1000, batch=True) is None and "per batch" in admission.check_cost(1001, batch=True)
+    assert admission.admit("a", 900, batch=True) is None
+    assert admission.admit("a", 100) is None # from the budget of single submissions
+    assert admission.admit("a", 200, batch=True)[1] == pytest.approx(10.0, abs=0.1)
+
+def test_forwarded_for_cannot_be_spoofed(monkeypatch):
+    import api
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    monkeypatch.setattr(admission, "BURST", 1.0)
+    monkeypatch.setattr(api.app, "wsgi_app", ProxyFix(api.app.wsgi_app, x_for=1)) # as behind the ingress
+    load()
+    client = api.app.test_client()
+    spec = {"start": "2000", "end": "2001"}
+    # the ingress appends the address it saw to whatever the client sent
+    assert client.post("/jobs", json=spec, headers={"X-Forwarded-For": "1.1.1.1, 10.0.0.9"}).status_code == 201
+    assert client.post("/jobs", json=spec, headers={"X-Forwarded-For": "2.2.2.2, 10.0.0.9"}).status_code == 429
+    assert client.post("/jobs", json=spec, headers={"X-Forwarded-For": "10.0.0.8"}).status_code == 201
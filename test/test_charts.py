@@ -0,0 +1,95 @@
+import pytest
+import charts
+import dataset
+import storage
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+def spec(plot_type="line", start=2000, end=2002, **args):
+    return charts.parse_spec(plot_type, start, end, args)
+
+def test_parse_spec():
+    assert spec(names="Peru,Chile,Peru")["locations"] == ["Chile", "Peru"]
+    assert spec()["locations"] == ["World"]
+    with pytest.raises(ValueError):
+        spec("pie")
+    with pytest.raises(ValueError):
+        spec("scatter", query1="TFR")
+    with pytest.raises(ValueError):
+        spec(format="jpg")
+    assert spec(dpi="50")["dpi"] == 50
+    with pytest.raises(ValueError):
+        spec(dpi="high")
+
+def test_only_small_single_image_specs_render_inline():
+    assert charts.output_field(spec()) == "image"
+    assert charts.output_field(spec("bar", 2001, 2001)) == "image_2001"
+    assert charts.output_field(spec("bar")) is None
+    assert charts.output_field(spec("bar", animate="true")) == "gif"
+    assert charts.output_field(spec(animate="true")) == "image"
+    assert charts.cost(spec(names="a,b")) == 2
+    assert charts.cost(spec("bar", animate="true", names="a,b")) == 6
+    assert charts.renders_inline(spec(names="a,b"))
+    assert not charts.renders_inline(spec("bar", 1950, 2100, animate="true"))
+    assert not charts.renders_inline(spec("bar", 2000, 2001, animate="true")) # gifs are always queued
+
+def test_cache_key_depends_on_spec_and_version():
+    assert charts.cache_key(spec(), 1) == charts.cache_key(spec(), 1)
+    assert charts.cache_key(spec(), 1) != charts.cache_key(spec(), 2)
+    assert charts.cache_key(spec(), 1) != charts.cache_key(spec(query1="TFR"), 1)
+
+def test_job_spec():
+    assert charts.job_spec(spec(names="Chile")) == {
+        "start": "2000", "end": "2002", "location": "Chile", "plot_type": "line", "animate": "false",
+        "format": "png"}
+
+def load(years=range(2000, 2003)):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": str(year)}]
+                          for year in years})
+
+def test_chart_renders_once(monkeypatch):
+    import worker
+    load()
+    image, key, version = charts.cached_chart(spec())
+    assert image is None
+    image = charts.render_chart(spec(), key, version)
+    assert image.startswith(b"\x89PNG")
+    assert charts.cached_chart(spec()) == (image, key, version)
+    assert storage.get_client("results").ttl(key) > 0
+    # a request that missed the cache while another rendered the chart finds it once it gets the lock
+    monkeypatch.setattr(worker, "plot_data", lambda *args: pytest.fail("rendered twice"))
+    assert charts.render_chart(spec(), key, version) == image
+
+def test_failed_render_expires(monkeypatch):
+    import worker
+    load()
+    def fail(new_data, key, *args):
+        storage.get_client("results").hset(key, "image_2000", b"partial")
+        raise RuntimeError("out of memory")
+    monkeypatch.setattr(worker, "plot_data", fail)
+    image, key, version = charts.cached_chart(spec())
+    with pytest.raises(RuntimeError):
+        charts.render_chart(spec(), key, version)
+    assert 0 < storage.get_client("results").ttl(key) <= charts.CACHE_TTL
+
+def test_inline_charts_are_admitted(monkeypatch):
+    import admission
+    import api
+    monkeypatch.setattr(admission, "BURST", 2.0)
+    monkeypatch.setattr(admission, "RATE", 0.001)
+    load()
+    client = api.app.test_client()
+    assert client.get("/charts/line/2000-2002").status_code == 200
+    assert client.get("/charts/line/2000-2002").status_code == 200 # cached, not charged
+    assert client.get("/charts/line/2000-2001").status_code == 200
+    response = client.get("/charts/line/2000-2002?query1=TFR") # another query string, another render
+    assert response.status_code == 429 and "Retry-After" in response.headers
+
+def test_get_chart_svg():
+    dataset.apply_update({"2000": [{"Location": "World", "Time": "2000", "TPopulation1Jan": "1"}]})
+    s = spec(start=2000, end=2000, format="svg")
+    image, key, version = charts.cached_chart(s)
+    image = charts.render_chart(s, key, version)
+    assert b"<svg" in image
+    files = storage.get_client("results").hget(key, "files")
+    assert b'"format": "svg"' in files
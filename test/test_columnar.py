@@ -0,0 +1,67 @@
+import json
+import pytest
+import columnar
+import dataset
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+def sample_data():
+    return {
+        str(year): [{"Location": location, "Time": str(year), "TPopulation1Jan": f"{year}.{i}", "Notes": ""}
+                    for i, location in enumerate(["World", "Côte_d'Ivoire", "Chile"])]
+        for year in range(2000, 2005)
+    }
+
+def test_write_and_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(columnar, "DIRECTORY", str(tmp_path))
+    data = sample_data()
+    manifest = {"2000": "a"}
+    path = columnar.write(data, manifest)
+    table = columnar.open_version(manifest)
+    assert table.path == path
+    assert table.read("2002") == data["2002"]
+    assert table.read("2002", ["Côte_d'Ivoire"]) == [data["2002"][1]]
+    assert table.read("2002", ["Atlantis"]) == []
+    assert table.read("1999") is None
+    assert columnar.open_version({"2000": "b"}) is None
+
+def test_fields_are_columns(tmp_path, monkeypatch):
+    import pyarrow as pa
+    monkeypatch.setattr(columnar, "DIRECTORY", str(tmp_path))
+    data = sample_data()
+    data["2005"] = [{"Location": "World", "Time": "2005", "TPopulation1Jan": 7.5, "LocID": None},
+                    {"Location": "Chile", "Time": "2005"}]
+    columnar.write(data, {"2000": "a"})
+    table = columnar.open_version({"2000": "a"})
+    assert table.table.column_names == ["Location", "Time", "TPopulation1Jan", "Notes", "LocID"]
+    assert table.table.schema.field("Location").type == pa.string()
+    assert table.json_columns == {"TPopulation1Jan", "LocID"} # not every value is a string
+    assert table.read("2005") == data["2005"]
+    assert table.read("2005", ["Chile"]) == [{"Location": "Chile", "Time": "2005"}]
+    assert table.read("2001") == data["2001"]
+
+def test_write_keeps_the_newest_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(columnar, "DIRECTORY", str(tmp_path))
+    for digest in "abc":
+        columnar.write(sample_data(), {"2000": digest}, keep=2)
+    assert len(list(tmp_path.iterdir())) == 2
+    assert columnar.open_version({"2000": "a"}) is None
+
+def test_dataset_reads_from_the_columnar_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(columnar, "DIRECTORY", str(tmp_path))
+    data = sample_data()
+    dataset.apply_update(data)
+    assert len(list(tmp_path.iterdir())) == 1
+    assert dataset.read_years(["2001", "2010"], regions=["Chile"]) == [[data["2001"][2]], None]
+
+    monkeypatch.setattr(columnar, "DIRECTORY", "")
+    assert dataset.read_years(["2001"]) == [json.loads(json.dumps(data["2001"]))]
+
+def test_other_nodes_write_the_file_from_redis(tmp_path, monkeypatch):
+    data = sample_data()
+    dataset.apply_update(data)
+    monkeypatch.setattr(columnar, "DIRECTORY", str(tmp_path))
+    version = dataset.get_version()
+    dataset._materialize(version, dataset.get_manifest(version))
+    assert columnar.open_version(dataset.get_manifest(version)).read("2003") == data["2003"]
+    assert dataset.list_locations() == ["Chile", "Côte_d'Ivoire", "World"]
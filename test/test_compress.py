@@ -0,0 +1,37 @@
+import gzip
+import json
+import zlib
+import pytest
+import compress
+
+def test_negotiate():
+    assert compress.negotiate("gzip, deflate", ("gzip",)) == "gzip"
+    assert compress.negotiate("*", ("zstd", "gzip")) == "zstd"
+    assert compress.negotiate("gzip;q=0.5, zstd", ("zstd", "gzip")) == "zstd"
+    assert compress.negotiate("gzip, zstd;q=0.2", ("zstd", "gzip")) == "gzip"
+    assert compress.negotiate("gzip;q=0, *", ("gzip",)) is None
+    assert compress.negotiate("identity", ("gzip",)) is None
+    assert compress.negotiate(None) is None
+
+def test_compress_round_trip():
+    data = b'{"Location": "World"}' * 100
+    assert gzip.decompress(compress.compress(data, "gzip")) == data
+    with pytest.raises(ValueError):
+        compress.compress(data, "lzma")
+
+@pytest.mark.parametrize("nested", [False, True])
+def test_joined_packs_decode_as_one_json_document(nested):
+    years = [[{"Location": "A", "Time": "2000"}, {"Location": "B", "Time": "2000"}], [], [{"Location": "A", "Time": "2002"}]]
+    packed = [compress.pack(json.dumps(rows))["gzip"] for rows in years]
+    decoded = json.loads(gzip.decompress(compress.join(packed, "gzip", nested)))
+    assert decoded == (years if nested else [row for rows in years for row in rows])
+    assert json.loads(gzip.decompress(compress.join([], "gzip", nested))) == []
+
+def test_joined_gzip_is_one_member():
+    years = [[{"Location": f"L{i}", "Time": str(year)} for i in range(50)] for year in range(1950, 1960)]
+    joined = compress.join([compress.pack(json.dumps(rows))["gzip"] for rows in years], "gzip")
+    decoder = zlib.decompressobj(wbits=31) # as clients that stop after the first member decode it
+    decoded = decoder.decompress(joined)
+    assert decoder.eof and decoder.unused_data == b""
+    assert json.loads(decoded) == [row for rows in years for row in rows]
+    assert gzip.decompress(joined) == decoded # checks the combined CRC-32 and length
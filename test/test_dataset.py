@@ -0,0 +1,136 @@
+import gzip
+import json
+import pytest
+import compress
+import dataset
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+def sample_data():
+    return {
+        "2000": [{"Location": "World", "Time": "2000", "TPopulation1Jan": "1"}],
+        "2001": [{"Location": "World", "Time": "2001", "TPopulation1Jan": "2"}],
+    }
+
+def test_first_update_writes_every_year():
+    summary = dataset.apply_update(sample_data(), {"sha256": "abc"})
+    assert summary == {"changed": 2, "removed": 0, "unchanged": 0, "version": 1}
+    assert dataset.list_years() == ["2000", "2001"]
+    assert json.loads(dataset.get_years(["2001"])[0])[0]["TPopulation1Jan"] == "2"
+    assert dataset.stored_fingerprint() == {"sha256": "abc"}
+
+def test_update_rewrites_only_changed_years():
+    dataset.apply_update(sample_data())
+    data = sample_data()
+    data["2001"][0]["TPopulation1Jan"] = "3"
+    del data["2000"]
+    data["2002"] = [{"Location": "World", "Time": "2002", "TPopulation1Jan": "4"}]
+
+    summary = dataset.apply_update(data)
+    assert summary == {"changed": 2, "removed": 1, "unchanged": 0, "version": 2}
+    assert dataset.list_years() == ["2001", "2002"]
+    assert dataset.get_years(["2000", "2001"])[0] is None
+    # the previous version is retained, unchanged blobs are shared
+    assert dataset.list_years(1) == ["2000", "2001"]
+    assert json.loads(dataset.get_years(["2001"], 1)[0])[0]["TPopulation1Jan"] == "2"
+
+def test_unchanged_update_keeps_version():
+    dataset.apply_update(sample_data())
+    summary = dataset.apply_update(sample_data())
+    assert summary == {"changed": 0, "removed": 0, "unchanged": 2, "version": 1}
+
+def test_readers_keep_their_version_during_a_reload():
+    dataset.apply_update(sample_data())
+    version = dataset.get_version()
+    data = sample_data()
+    data["2000"][0]["TPopulation1Jan"] = "5"
+    dataset.apply_update(data)
+    assert dataset.get_version() == version + 1
+    assert json.loads(dataset.get_years(["2000"], version)[0])[0]["TPopulation1Jan"] == "1"
+    assert json.loads(dataset.get_years(["2000"])[0])[0]["TPopulation1Jan"] == "5"
+
+def test_garbage_collection_keeps_pinned_versions():
+    dataset.apply_update(sample_data())
+    pinned = dataset.pin("job-1")
+    for value in ("5", "6", "7"):
+        data = sample_data()
+        data["2000"][0]["TPopulation1Jan"] = value
+        dataset.apply_update(data)
+
+    assert [int(v) for v in dataset.rd.zrange(dataset.VERSIONS_KEY, 0, -1)] == [1, 3, 4]
+    assert dataset.list_years(pinned) == ["2000", "2001"]
+    assert dataset.rd.exists(f"{dataset.MANIFEST_PREFIX}2") == 0
+
+    dataset.unpin(pinned, "job-1")
+    dataset.collect_garbage()
+    assert [int(v) for v in dataset.rd.zrange(dataset.VERSIONS_KEY, 0, -1)] == [3, 4]
+    # blobs of 2000 for versions 3 and 4 plus the shared blob of 2001
+    assert len(list(dataset.rd.scan_iter(match=f"{dataset.BLOB_PREFIX}*"))) == 3
+
+def test_clear_empties_the_dataset():
+    dataset.apply_update(sample_data())
+    dataset.rd.set("1999", "[]") # year stored before versioning
+    summary = dataset.clear()
+    assert summary == {"versions": 1, "blobs": 2, "legacy_keys": 1}
+    assert dataset.get_version() == 0
+    assert dataset.list_years() == []
+    assert dataset.get_years(["2000"]) == [None]
+
+def test_stale_manifest_cache_is_reread():
+    dataset.apply_update(sample_data())
+    dataset.list_years()
+    dataset.rd.flushdb()
+    data = sample_data()
+    del data["2001"]
+    data["2000"][0]["TPopulation1Jan"] = "9"
+    dataset.apply_update(data)
+    assert dataset.get_version() == 1
+    assert json.loads(dataset.get_years(["2000"])[0])[0]["TPopulation1Jan"] == "9"
+
+def test_file_fingerprint(tmp_path):
+    path = tmp_path / "data.csv.gz"
+    path.write_bytes(b"abc")
+    fingerprint = dataset.file_fingerprint(path)
+    assert fingerprint["size"] == 3
+    assert fingerprint["sha256"] == "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+    assert dataset.http_fingerprint({"ETag": '"x"'})["etag"] == '"x"'
+    assert dataset.http_fingerprint({}) is None
+
+def test_packed_years_are_stored_at_ingest_and_backfilled():
+    dataset.apply_update(sample_data())
+    packed = dataset.packed_years(["2000", "2001"], 1, "gzip")
+    assert json.loads(gzip.decompress(compress.join(packed, "gzip"))) == sample_data()["2000"] + sample_data()["2001"]
+    for key in dataset.rd.scan_iter(match=f"{dataset.PACKED_PREFIX}*"):
+        dataset.rd.delete(key) # as if stored before years were packed
+    assert dataset.packed_years(["2000", "2001"], 1, "gzip") == packed
+    assert len(list(dataset.rd.scan_iter(match=f"{dataset.PACKED_PREFIX}*"))) == 2
+    dataset.clear()
+    assert not list(dataset.rd.scan_iter(match=f"{dataset.PACKED_PREFIX}*"))
+
+def high_variant():
+    data = sample_data()
+    data["2000"] = [{"Location": "World", "Time": "2000", "TPopulation1Jan": "9"}]
+    return {"WPP2024:High": data}
+
+def test_partitions_are_stored_next_to_the_default():
+    summary = dataset.apply_update(sample_data(), None, high_variant(), "WPP2024:Medium")
+    assert summary == {"changed": 4, "removed": 0, "unchanged": 0, "version": 1}
+    assert dataset.get_partitions() == {
+        "WPP2024:Medium": {"release": "WPP2024", "variant": "Medium", "years": ["2000", "2001"], "default": True},
+        "WPP2024:High": {"release": "WPP2024", "variant": "High", "years": ["2000", "2001"], "default": False}}
+    # 2001 has the same rows in both partitions and is stored once
+    assert len(list(dataset.rd.scan_iter(match=f"{dataset.BLOB_PREFIX}*"))) == 3
+    assert dataset.partition("high") == "WPP2024:High"
+    assert dataset.partition("Medium") is None and dataset.partition("WPP2024:Medium") is None
+    with pytest.raises(ValueError):
+        dataset.partition("Low")
+    assert json.loads(dataset.get_years(["2000"], partition="WPP2024:High")[0])[0]["TPopulation1Jan"] == "9"
+    assert dataset.read_years(["2000"])[0][0]["TPopulation1Jan"] == "1"
+    assert dataset.apply_update(sample_data(), None, high_variant(), "WPP2024:Medium")["version"] == 1
+
+    assert dataset.apply_update(sample_data(), None, {}, "WPP2024:Medium")["version"] == 2
+    assert list(dataset.get_partitions()) == ["WPP2024:Medium"]
+    dataset.collect_garbage(0)
+    assert not dataset.rd.exists(f"{dataset.MANIFEST_PREFIX}1:WPP2024:High")
+    assert not dataset.rd.exists(f"{dataset.PARTITIONS_PREFIX}1")
+    assert len(list(dataset.rd.scan_iter(match=f"{dataset.BLOB_PREFIX}*"))) == 2
@@ -0,0 +1,50 @@
+import io
+import json
+import pytest
+import dataset
+import export
+import jobs
+import storage
+
+ROWS = [{"Location": loc, "Time": str(year), "TFR": str(year - 1999), "Notes": ""}
+        for year in range(2000, 2004) for loc in ("Chile", "Peru")]
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+def test_columns():
+    assert export.columns(ROWS) == ["Location", "Time", "TFR", "Notes"]
+    assert export.columns(ROWS, ["TFR"]) == ["Location", "Time", "TFR"]
+
+def test_csv_chunks():
+    chunks = list(export.encode(ROWS, "csv", ["Location", "Time", "TFR"], chunk_rows=3))
+    assert len(chunks) == 3
+    lines = b"".join(chunks).decode().splitlines()
+    assert lines[0] == "Location,Time,TFR" and lines[1] == "Chile,2000,1" and len(lines) == 9
+    assert list(export.encode([], "csv", ["Location"])) == [b"Location\n"]
+    with pytest.raises(ValueError):
+        export.encode(ROWS, "xlsx", ["Location"])
+
+def test_parquet_and_arrow_chunks():
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    names = export.columns(ROWS)
+    table = pq.read_table(io.BytesIO(b"".join(export.encode(ROWS, "parquet", names, chunk_rows=3))))
+    assert table.num_rows == len(ROWS)
+    assert str(table.schema.field("TFR").type) == "double" and str(table.schema.field("Time").type) == "string"
+    assert table.column("Notes").null_count == 0
+    chunks = list(export.encode(ROWS, "arrow", names, chunk_rows=3))
+    assert len(chunks) > 1
+    assert pa.ipc.open_stream(b"".join(chunks)).read_all().column("TFR").to_pylist()[:2] == [1.0, 1.0]
+
+def test_export_job_skips_plotting():
+    import worker
+    dataset.apply_update({str(year): [row for row in ROWS if row["Time"] == str(year)] for year in range(2000, 2004)})
+    job = jobs.add_job({"start": "2001", "end": "2002", "plot_type": "export", "location": "Peru",
+                        "fields": "TFR"})
+    worker.process_job(job["id"])
+    assert jobs.get_job_by_id(job["id"])["status"] == "complete"
+    resdb = storage.get_client("results")
+    files = json.loads(resdb.hget(job["id"], "files"))
+    assert files["rows"] == 2 and files["columns"] == ["Location", "Time", "TFR"]
+    assert resdb.hget(job["id"], "export_0") == b"Location,Time,TFR\nPeru,2001,2\nPeru,2002,3\n"
+    assert resdb.hget(job["id"], "data") is None
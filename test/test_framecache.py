@@ -0,0 +1,75 @@
+import pytest
+from matplotlib.transforms import Bbox
+import dataset
+import framecache
+import jobs
+import storage
+import worker
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+def test_key_covers_state_and_options():
+    key = framecache.key(["BarFrames", "2000"], ["png", None, False, False])
+    assert key.startswith(framecache.KEY_PREFIX)
+    assert key == framecache.key(["BarFrames", "2000"], ["png", None, False, False])
+    assert key != framecache.key(["BarFrames", "2000"], ["svg", None, False, False])
+    assert key != framecache.key(["BarFrames", "2001"], ["png", None, False, False])
+
+def test_get_and_put():
+    assert framecache.get("frame:a") is None
+    framecache.put("frame:a", {"image": b"x" * 10, "thumb": b"y"})
+    framecache.put("frame:a", {"image": b"x" * 10, "thumb": b"y"}) # cached twice, counted once
+    assert framecache.get("frame:a") == {"image": b"x" * 10, "thumb": b"y"}
+    assert int(framecache.resdb.get(framecache.BYTES_KEY)) == 11
+
+def test_least_recently_used_frames_are_evicted(monkeypatch):
+    monkeypatch.setattr(framecache, "MAX_BYTES", 25)
+    for name in "abc":
+        framecache.put(f"frame:{name}", {"image": b"x" * 10})
+    # c pushed the cache over, a was the least recently used
+    assert framecache.get("frame:a") is None
+    assert framecache.get("frame:b") and framecache.get("frame:c")
+    framecache.get("frame:b")
+    framecache.put("frame:d", {"image": b"x" * 10})
+    assert framecache.get("frame:c") is None and framecache.get("frame:b")
+    assert int(framecache.resdb.get(framecache.BYTES_KEY)) == 20
+    assert framecache.resdb.zcard(framecache.LRU_KEY) == framecache.resdb.hlen(framecache.SIZES_KEY) == 2
+    framecache.put("frame:e", {"image": b"x" * 30}) # larger than the whole cache
+    assert framecache.get("frame:e") is None
+
+def test_jobs_reuse_frames(monkeypatch):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": "5"}]
+                          for year in range(2000, 2004)})
+    rendered = []
+    save_frame = worker.save_frame
+    def counted(fig, jobid, field, *args):
+        rendered.append(field)
+        return save_frame(fig, jobid, field, *args)
+    monkeypatch.setattr(worker, "save_frame", counted)
+    first = jobs.add_job({"start": "2000", "end": "2002", "plot_type": "bar", "thumbnail": "true"})["id"]
+    second = jobs.add_job({"start": "2001", "end": "2003", "plot_type": "bar", "thumbnail": "true"})["id"]
+    for jid in (first, second):
+        worker.process_job(jid)
+
+    assert rendered == ["image_2000", "image_2001", "image_2002", "image_2003"]
+    resdb = storage.get_client("results")
+    assert resdb.hget(second, "image_2001") == resdb.hget(first, "image_2001")
+    assert resdb.hget(second, "thumb_2002").startswith(b"\x89PNG")
+    assert jobs.get_job_by_id(second)["status"] == "complete"
+
+def test_fast_jobs_reuse_only_frames_of_the_same_crop(monkeypatch):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": "5"}]
+                          for year in range(2000, 2004)})
+    rendered = []
+    save_frame = worker.save_frame
+    def counted(fig, jobid, field, *args):
+        rendered.append(field)
+        return save_frame(fig, jobid, field, *args)
+    monkeypatch.setattr(worker, "save_frame", counted)
+    crops = iter([Bbox.from_bounds(0, 0, 10, 6), Bbox.from_bounds(0, 0, 10, 6), Bbox.from_bounds(0, 0, 9, 6)])
+    monkeypatch.setattr(worker, "crop_box", lambda fig: next(crops)) # one per job, taken before any lookup
+    for start, end in (("2000", "2002"), ("2001", "2003"), ("2001", "2003")):
+        worker.process_job(jobs.add_job({"start": start, "end": end, "plot_type": "bar", "profile": "fast"})["id"])
+
+    # the second job reuses the frames of the first, the third has another crop
+    assert rendered == ["image_2000", "image_2001", "image_2002", "image_2003", "image_2001", "image_2002", "image_2003"]
@@ -0,0 +1,61 @@
+import pytest
+import frames
+
+YEARS = ["2000", "2001", "2002"]
+
+def data(*locations):
+    return {year: {loc: [{"Location": loc, "Time": year, "TFR": str(i + int(year) - 1999),
+                          "TPopulation1Jan": str((i + 1) * int(year))}]
+                   for i, loc in enumerate(locations)} for year in YEARS}
+
+def test_bar_frames_reuse_one_figure():
+    renderer = frames.BarFrames(data("Chile", "Peru"), YEARS, ["Chile", "Peru"], "TFR")
+    bars = list(renderer.bars)
+    renderer.draw("2002")
+    assert list(renderer.bars) == bars
+    assert [bar.get_height() for bar in bars] == [3.0, 4.0]
+    assert renderer.title.get_text() == "TFR in 2002"
+    assert renderer.ax.get_ylim()[1] == pytest.approx(4.4)
+
+def test_bar_frames_missing_values():
+    renderer = frames.BarFrames(data("Chile"), YEARS, ["Chile", "Peru"], "TFR")
+    renderer.draw("2000")
+    assert [bar.get_height() for bar in renderer.bars] == [1.0, 0]
+
+def test_scatter_frames_update_points_and_fit():
+    renderer = frames.ScatterFrames(data("Chile", "Peru", "Chad"), YEARS, ["Chad", "Chile", "Peru"],
+                                    "TFR", "TPopulation1Jan")
+    renderer.draw("2001")
+    assert len(renderer.points.get_offsets()) == 3
+    assert renderer.fit.get_visible() and renderer.legend.get_visible()
+    assert renderer.legend.get_texts()[0].get_text().startswith("Regression Line (R²=")
+    renderer.draw("2000")
+    assert len(renderer.ax.collections) == 1 and len(renderer.ax.lines) == 1
+
+def test_scatter_frames_single_point_hides_fit():
+    renderer = frames.ScatterFrames(data("Chile"), YEARS, ["Chile"], "TFR", "TPopulation1Jan")
+    renderer.draw("2000")
+    assert not renderer.fit.get_visible()
+    with pytest.raises(ValueError):
+        frames.ScatterFrames({}, YEARS, ["Chile"], "TFR", "TPopulation1Jan")
+
+def test_line_frames():
+    renderer = frames.LineFrames(data("Chile", "Peru"), YEARS, ["Chile", "Peru", "Chad"], "TFR")
+    assert [line.get_label() for line in renderer.ax.lines] == ["Chile", "Peru"]
+
+def test_frame_state():
+    renderer = frames.BarFrames(data("Chile", "Peru"), YEARS, ["Chile", "Peru"], "TFR")
+    state = renderer.state("2001")
+    assert state == frames.BarFrames(data("Chile", "Peru"), YEARS, ["Chile", "Peru"], "TFR").state("2001")
+    assert state[-1] == [[2.0, 3.0]]
+    assert state != renderer.state("2000")
+    assert state != frames.BarFrames(data("Chile", "Peru"), YEARS[:2], ["Chile", "Peru"], "TFR").state("2001") # ylim
+    scatter = frames.ScatterFrames(data("Chile", "Peru"), YEARS, ["Chile"], "TFR", "TPopulation1Jan")
+    assert scatter.state("2000")[-1] == ["Chile", "Peru"]
+
+def test_palette_is_cached():
+    assert frames.palette("plasma", 3) is frames.palette("plasma", 3)
+    assert len(frames.palette("Pastel1", 4)) == 4
+
+def test_warm_up():
+    frames.warm_up()
@@ -1,6 +1,9 @@
 import fakeredis
+import pytest
 import json
+from hotqueue import HotQueue
 import jobs
+from storage import LazyClient
 
 def setup_module(module):
     """Setup fake Redis connections for all Redis instances in jobs.py"""
@@ -14,6 +17,10 @@ def setup_module(module):
     jobs.q = fake_q
     jobs.resdb = fake_resdb
 
+def teardown_module(module):
+    """Give jobs.py its shared clients back for the other test modules"""
+    jobs.rd, jobs.jdb, jobs.q, jobs.resdb = (LazyClient(name) for name in ("data", "jobs", "queue", "results"))
+
 def test_string_to_bool():
     assert jobs.string_to_bool("true") is True
     assert jobs.string_to_bool("TrUe") is True
@@ -93,3 +100,169 @@ def test_get_results_complete():
     result = jobs.get_results(jid)
     assert result["result"]["value"] == 42
 
+
+def test_validate_job_spec():
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010"}) is None
+    assert jobs.validate_job_spec({"start": "2000"}) is not None
+    assert jobs.validate_job_spec({"start": "abc", "end": "2010"}) is not None
+    assert jobs.validate_job_spec(["2000", "2010"]) is not None
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010", "format": "svg", "dpi": "72", "profile": "fast"}) is None
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010", "format": "jpg"}) is not None
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010", "dpi": "5000"}) is not None
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010", "profile": "slow"}) is not None
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010", "plot_type": "export", "format": "parquet"}) is None
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010", "plot_type": "export", "format": "png"}) is not None
+    assert jobs.validate_job_spec({"start": "2000", "end": "2010", "plot_type": "export", "fields": ["TFR"]}) is not None
+
+def test_get_results_without_data():
+    job = jobs.add_job({"start": "2000", "end": "2001", "plot_type": "export"})
+    jobs.update_job_status(job['id'], "complete")
+    jobs.resdb.hset(job['id'], "files", json.dumps({"format": "csv", "chunks": 1}))
+    result = jobs.get_results(job['id'])
+    assert result["result"] is None and result["files"]["chunks"] == 1
+
+def test_add_jobs_batch():
+    specs = [
+        {"start": "2000", "end": "2005", "location": "Mexico"},
+        {"start": "1990", "end": "2001", "location": "Asia,Mexico"},
+        {"start": "2010", "end": "2012"},
+    ]
+    batch = jobs.add_jobs(specs)
+    group = batch["group"]
+    jids = [job["id"] for job in batch["jobs"]]
+
+    assert group["jobs"] == jids
+    assert group["start"] == "1990"
+    assert group["end"] == "2012"
+    assert group["location"] == "Asia,Mexico,World"
+    for jid in jids:
+        assert jobs.get_job_by_id(jid)["group"] == group["id"]
+        assert jid in jobs.get_all_jobs()
+    assert jobs.jdb.get(f"{jobs.GROUP_PREFIX}{group['id']}") is not None
+    assert f"{jobs.GROUP_PREFIX}{group['id']}" not in jobs.get_all_jobs()
+    assert "variant" not in group
+
+def test_add_jobs_batch_of_a_variant():
+    spec = {"start": "2000", "end": "2005", "variant": "WPP2024:High"}
+    batch = jobs.add_jobs([spec, spec])
+    assert batch["group"]["variant"] == "WPP2024:High"
+    assert jobs.get_job_by_id(batch["jobs"][0]["id"])["variant"] == "WPP2024:High"
+    assert "variant" not in jobs.add_jobs([spec, {"start": "2000", "end": "2005"}])["group"]
+
+def test_get_group_status():
+    batch = jobs.add_jobs([{"start": "2000", "end": "2001"}, {"start": "2002", "end": "2003"}])
+    gid = batch["group"]["id"]
+    jid1, jid2 = batch["group"]["jobs"]
+
+    assert jobs.get_group_status(gid)["status"] == "submitted"
+    jobs.update_job_status(jid1, "complete")
+    status = jobs.get_group_status(gid)
+    assert status["status"] == "in progress"
+    assert status["counts"] == {"complete": 1, "submitted": 1}
+    jobs.update_job_status(jid2, "complete")
+    assert jobs.get_group_status(gid)["status"] == "complete"
+    assert "error" in jobs.get_group_status("missing-group")
+
+def test_queue_stats(monkeypatch):
+    monkeypatch.setattr(jobs, "q", HotQueue("queue", connection_pool=fakeredis.FakeRedis().connection_pool))
+    assert jobs.queue_stats() == {"depth": 0, "oldest_age_seconds": 0, "backlog_cost": 0, "batch_backlog_cost": 0,
+                                 "running": 0}
+    line = jobs.add_job({"start": "2000", "end": "2009", "location": "Chile,Peru"})
+    jobs.add_jobs([{"start": "2000", "end": "2009", "plot_type": "bar", "location": "Chile"}] * 2)
+    stats = jobs.queue_stats()
+    assert stats["depth"] == 3 and stats["backlog_cost"] == 2 + 10 + 10 and stats["oldest_age_seconds"] >= 0
+    jobs.job_started(line["id"])
+    jobs.job_started(line["id"]) # forgotten once, counted off once
+    assert jobs.queue_stats()["backlog_cost"] == 20
+    assert jobs.queue_stats()["running"] == 1 # in flight, so autoscalers keep its worker
+    jobs.job_finished(line["id"])
+    assert jobs.queue_stats()["running"] == 0
+    redis = jobs._queue_redis()
+    assert redis.get(jobs.BACKLOG_KEY) == b"20" # a running total, not a sum over the queued jobs
+    assert jobs.queue_stats()["batch_backlog_cost"] == 20 # both left are of the batch
+    redis.set(jobs.BACKLOG_KEY, 35) # drifted
+    redis.set(jobs.BATCH_BACKLOG_KEY, 3)
+    assert jobs.reconcile_backlog() == (20, 20)
+    redis.delete(jobs.BACKLOG_KEY) # queued before the total was kept
+    assert jobs.queue_stats()["backlog_cost"] == 20
+    batch_job = jobs.q.get()
+    jobs.job_started(jobs.q.get() if batch_job == line["id"] else batch_job)
+    assert jobs.queue_stats()["backlog_cost"] == jobs.queue_stats()["batch_backlog_cost"] == 10
+
+def test_job_cost():
+    assert jobs.job_cost({"start": "2000", "end": "2004", "plot_type": "scatter", "location": "a,b"}) == 10
+    assert jobs.job_cost({"start": "2000", "end": "2004", "plot_type": "export"}) == 1
+    assert jobs.job_cost({"start": "x", "end": "2004", "plot_type": "bar"}) == 1
+
+def test_list_jobs(monkeypatch):
+    monkeypatch.setattr(jobs, "jdb", fakeredis.FakeRedis())
+    monkeypatch.setattr(jobs.time, "time", lambda: 1000.0)
+    batch = jobs.add_jobs([{"start": "2000", "end": "2001", "plot_type": "bar"}] * 5)["jobs"] # same submission time
+    monkeypatch.setattr(jobs.time, "time", lambda: 2000.0)
+    line = jobs.add_job({"start": "2000", "end": "2001"})
+    jobs.update_job_status(batch[0]["id"], "complete")
+    jobs.update_job_status(line["id"], "complete")
+
+    seen, cursor = [], None
+    while True:
+        jids, cursor = jobs.list_jobs(cursor, limit=2)
+        seen.extend(jids)
+        if cursor is None:
+            break
+    assert seen[0] == line["id"] and sorted(seen) == sorted([line["id"], *(job["id"] for job in batch)])
+
+    assert jobs.list_jobs(status="complete", plot_type="bar") == ([batch[0]["id"]], None)
+    assert jobs.list_jobs(status="submitted", limit=10)[0] == sorted((job["id"] for job in batch[1:]), reverse=True)
+    assert jobs.list_jobs(since=line["submitted_at"] + 1) == ([], None)
+
+    jobs.delete_job(line["id"])
+    assert jobs.list_jobs(status="complete") == ([batch[0]["id"]], None)
+
+def test_list_jobs_rebuilds_index(monkeypatch):
+    monkeypatch.setattr(jobs, "jdb", fakeredis.FakeRedis())
+    job = jobs.add_job({"start": "2000", "end": "2001"})
+    jobs.jdb.delete(jobs.SUBMITTED_INDEX, jobs._index_key("status", "submitted"))
+    assert jobs.list_jobs(status="submitted") == ([job["id"]], None)
+
+def test_cancel_job(monkeypatch):
+    monkeypatch.setattr(jobs, "q", HotQueue("queue", connection_pool=fakeredis.FakeRedis().connection_pool))
+    running = jobs.add_job({"start": "2000", "end": "2009", "plot_type": "bar"})
+    queued = jobs.add_job({"start": "2000", "end": "2009", "plot_type": "bar"})
+    assert jobs.q.get() == running["id"] # taken off the queue by a worker
+    jobs.job_started(running["id"])
+    jobs.update_job_status(running["id"], "in progress")
+    done = jobs.add_job({"start": "2000", "end": "2009"})
+    jobs.update_job_status(done["id"], "complete")
+
+    assert jobs.cancel_job(queued["id"])["status"] == "cancelled"
+    assert jobs.q.get() == done["id"] and not jobs.is_cancelled(queued["id"]) # never reaches a worker
+    assert jobs.queue_stats()["backlog_cost"] == 1
+    assert jobs.cancel_job(running["id"])["status"] == "cancelled"
+    assert jobs.is_cancelled(running["id"])
+    with pytest.raises(jobs.JobCancelled):
+        jobs.check_cancelled(running["id"])
+    jobs.clear_cancelled(running["id"])
+    jobs.check_cancelled(running["id"])
+
+    assert "error" in jobs.cancel_job(done["id"])
+    assert "error" in jobs.cancel_job("missing-job")
+
+def test_finished_job_keeps_its_status_and_ttl():
+    job = jobs.add_job({"start": "2000", "end": "2009", "plot_type": "bar"})
+    jobs.update_job_status(job["id"], "in progress")
+    jobs.update_job_status(job["id"], "complete")
+    jobs.apply_retention(job["id"], "complete")
+
+    with pytest.raises(jobs.JobFinished) as finished:
+        jobs.update_job_status(job["id"], "error") # e.g. a late write of a worker
+    assert finished.value.status == "complete"
+    assert jobs.cancel_job(job["id"]) == {"error": f"Job ID '{job['id']}' is already complete."}
+    assert jobs.get_job_by_id(job["id"])["status"] == "complete"
+    assert 0 < jobs.jdb.ttl(job["id"]) <= jobs.RETENTION["complete"]
+    assert jobs.jdb.zscore(jobs._index_key("status", "cancelled"), job["id"]) is None
+
+def test_status_write_keeps_ttl():
+    job = jobs.add_job({"start": "2000", "end": "2009"})
+    jobs.jdb.expire(job["id"], 600)
+    jobs.update_job_status(job["id"], "in progress")
+    assert 0 < jobs.jdb.ttl(job["id"]) <= 600
@@ -0,0 +1,64 @@
+import asyncio
+import fakeredis
+import pytest
+import dataset
+import locations
+import query
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+ROWS = [
+    {"Location": "World", "LocID": "900"},
+    {"Location": "Chile", "ISO3_code": "CHL", "ISO2_code": "CL", "LocID": "152"},
+    {"Location": "China", "ISO3_code": "CHN", "ISO2_code": "CN", "LocID": "156"},
+    {"Location": "Côte_d'Ivoire", "ISO3_code": "CIV", "ISO2_code": "CI", "LocID": "384"},
+    {"Location": "United_Republic_of_Tanzania", "ISO3_code": "TZA", "ISO2_code": "TZ", "LocID": "834"},
+    {"Location": "Namibia", "ISO3_code": "NAM", "ISO2_code": "NA", "LocID": "516"},
+]
+
+def load(years=("2000", "2001")):
+    dataset.apply_update({year: [{**row, "Time": year, "TFR": "2"} for row in ROWS] for year in years})
+
+def test_location_table_is_stored_at_ingest_and_backfilled():
+    load()
+    table = dataset.location_table()
+    assert [entry["Location"] for entry in table] == sorted(row["Location"] for row in ROWS)
+    assert {"Location": "World", "LocID": "900"} in table
+    dataset.rd.delete(f"{dataset.LOCATIONS_PREFIX}1") # as if loaded before the table was stored
+    assert dataset.location_table() == table
+    assert dataset.rd.exists(f"{dataset.LOCATIONS_PREFIX}1")
+    assert asyncio.run(dataset.alocation_table(fakeredis.FakeAsyncRedis(), 0)) == []
+    dataset.clear()
+    assert not dataset.rd.exists(f"{dataset.LOCATIONS_PREFIX}1")
+
+def test_resolve():
+    load()
+    assert locations.resolve(["cote d'ivoire", "CIV", "ci", "384", "Côte_d'Ivoire", "COTE_D_IVOIRE"]) == \
+        ["Côte_d'Ivoire"] * 6
+    assert locations.resolve(["na", "world", "Atlantis"]) == ["Namibia", "World", "Atlantis"]
+    assert locations.resolve([]) == []
+
+def test_search():
+    load()
+    index = locations.index()
+    assert [(m["Location"], m["match"]) for m in index.search("chi")] == [("Chile", "prefix"), ("China", "prefix")]
+    assert index.search("CHN")[0] == {"Location": "China", "ISO3_code": "CHN", "ISO2_code": "CN", "LocID": "156",
+                                      "match": "exact"}
+    assert [m["Location"] for m in index.search("tanz")] == ["United_Republic_of_Tanzania"]
+    assert index.search("tanz")[0]["match"] == "word"
+    assert index.search("Tanzanai")[0]["Location"] == "United_Republic_of_Tanzania"
+    assert index.search("Chile", limit=1) == [{**ROWS[1], "match": "exact"}]
+    assert index.search("  ") == [] and index.search("xyzzy") == []
+
+def test_index_follows_the_dataset_version():
+    load()
+    assert locations.index() is locations.index()
+    dataset.rd.flushdb()
+    dataset.apply_update({"2000": [{"Location": "Peru", "ISO3_code": "PER", "Time": "2000"}]})
+    assert locations.resolve(["per"]) == ["Peru"]
+
+def test_plans_hold_location_names():
+    load()
+    plan = query.plan(2000, 2000, ["chl", "Atlantis"])
+    assert plan.regions == ["Chile", "Atlantis"]
+    assert [row["Location"] for row in query.execute(plan)[0]] == ["Chile"]
@@ -0,0 +1,36 @@
+import logging
+import log_config
+
+def test_lazy_not_evaluated_when_disabled(caplog):
+    calls = []
+    logger = logging.getLogger("test_lazy")
+    with caplog.at_level(logging.INFO, logger="test_lazy"):
+        logger.debug("keys %s", log_config.Lazy(lambda: calls.append(1)))
+    assert calls == []
+
+    with caplog.at_level(logging.DEBUG, logger="test_lazy"):
+        logger.debug("keys %s", log_config.Lazy(lambda: calls.append(1)))
+    assert calls == [1]
+    assert caplog.records[0].getMessage() == "keys None"
+
+def test_log_sampled(caplog):
+    logger = logging.getLogger("test_sampled")
+    logger.setLevel(logging.DEBUG)
+    with caplog.at_level(logging.DEBUG, logger="test_sampled"):
+        for i in range(25):
+            log_config.log_sampled(logger, logging.DEBUG, "row %s", i, every=10)
+    assert [r.getMessage() for r in caplog.records] == [
+        "row 0 (1 in 10 logged)", "row 10 (1 in 10 logged)", "row 20 (1 in 10 logged)"]
+
+def test_log_sampled_disabled_level_is_not_counted():
+    logger = logging.getLogger("test_sampled_disabled")
+    logger.setLevel(logging.WARNING)
+    log_config.log_sampled(logger, logging.DEBUG, "row %s", 1)
+    assert ("test_sampled_disabled", "row %s") not in log_config._sample_counts
+
+def test_json_formatter():
+    record = logging.makeLogRecord({"name": "api", "levelname": "INFO", "msg": "job %s", "args": ("abc",),
+                                    "jobid": "abc"})
+    line = log_config.JsonFormatter().format(record)
+    assert '"message": "job abc"' in line
+    assert '"jobid": "abc"' in line
@@ -0,0 +1,80 @@
+import fakeredis
+import pytest
+import metrics
+
+def test_counter_and_gauge_render():
+    requests_total = metrics.counter("test_requests_total", "Requests.", ("route",))
+    requests_total.inc(route="/years")
+    requests_total.inc(2, route="/years")
+    metrics.gauge("test_depth", "Depth.").set_function(lambda: 7)
+
+    text = metrics.render()
+    assert "# TYPE test_requests_total counter" in text
+    assert 'test_requests_total{route="/years"} 3' in text
+    assert "test_depth 7" in text
+
+def test_histogram_buckets():
+    latency = metrics.histogram("test_latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+    latency.observe(0.05, route="a")
+    latency.observe(0.5, route="a")
+    latency.observe(5, route="a")
+
+    text = metrics.render()
+    assert 'test_latency_seconds_bucket{route="a",le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{route="a",le="1.0"} 2' in text
+    assert 'test_latency_seconds_bucket{route="a",le="+Inf"} 3' in text
+    assert 'test_latency_seconds_count{route="a"} 3' in text
+
+def test_registry_rejects_conflicting_metric():
+    metrics.counter("test_conflict_total", "Conflict.", ("a",))
+    with pytest.raises(ValueError):
+        metrics.gauge("test_conflict_total", "Conflict.", ("a",))
+    with pytest.raises(ValueError):
+        metrics.counter("test_conflict_total", "Conflict.").inc(b="x")
+
+def test_instrument_redis_records_call_site():
+    client = metrics.instrument_redis(fakeredis.FakeRedis(), "test")
+    with metrics.site("test_site"):
+        client.set("key", "value")
+        pipe = client.pipeline()
+        pipe.get("key")
+        assert pipe.execute() == [b"value"]
+
+    text = metrics.render()
+    assert 'wpp_redis_command_seconds_count{db="test",command="SET",site="test_site"} 1' in text
+    assert 'wpp_redis_command_seconds_count{db="test",command="PIPELINE",site="test_site"} 1' in text
+
+def test_drain_and_merge():
+    jobs_total = metrics.counter("test_drained_total", "Jobs.", ("status",))
+    duration = metrics.histogram("test_drained_seconds", "Duration.", buckets=(1.0,))
+    jobs_total.inc(status="complete")
+    duration.observe(0.5)
+    state = metrics.drain()
+    assert 'test_drained_total{status="complete"}' not in metrics.render()
+
+    metrics.merge(state)
+    metrics.merge(state)
+    text = metrics.render()
+    assert 'test_drained_total{status="complete"} 2' in text
+    assert 'test_drained_seconds_bucket{le="1.0"} 2' in text
+    assert "test_drained_seconds_sum 1.0" in text
+
+def test_processes_share_their_metrics(tmp_path, monkeypatch):
+    served = metrics.counter("test_shared_total", "Requests.", ("route",))
+    latency = metrics.histogram("test_shared_seconds", "Latency.", buckets=(1.0,))
+    served.inc(route="/years")
+    latency.observe(0.5)
+    monkeypatch.setattr(metrics, "_shared_dir", str(tmp_path))
+    # what two sibling processes wrote, one of which exited since
+    metrics._dump({"test_shared_total": {("/years",): 2}, "test_shared_seconds": {(): ([1, 1], 0.5)}},
+                  str(tmp_path / "101.json"))
+    metrics._dump({"test_shared_total": {("/years",): 4}}, str(tmp_path / "102.json"))
+    metrics.archive(str(tmp_path), 102)
+    metrics.archive(str(tmp_path), 103) # exited before its first snapshot
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["101.json", metrics.EXITED]
+
+    text = metrics.render()
+    assert 'test_shared_total{route="/years"} 7' in text
+    assert 'test_shared_seconds_bucket{le="1.0"} 2' in text and "test_shared_seconds_sum 1.0" in text
+    metrics.snapshot(str(tmp_path)) # its own snapshot is not counted twice
+    assert 'test_shared_total{route="/years"} 7' in metrics.render()
@@ -0,0 +1,71 @@
+import asyncio
+import fakeredis
+import pytest
+import dataset
+import query
+import storage
+
+pytestmark = pytest.mark.usefixtures("redis_server")
+
+def load():
+    dataset.apply_update({
+        str(year): [{"Location": location, "Time": str(year), "TPopulation1Jan": str(year), "TFR": "2"}
+                    for location in ("World", "Chile")]
+        for year in (2000, 2001, 2002)
+    })
+
+def test_plan_skips_years_the_dataset_lacks():
+    load()
+    plan = query.plan(1999, 2001)
+    assert plan.year_keys == ["1999", "2000", "2001"]
+    assert plan.fetch == ["2000", "2001"]
+    years_data = query.execute(plan)
+    assert years_data[0] is None
+    assert [len(rows) for rows in years_data[1:]] == [2, 2]
+
+def test_plan_every_year_of_the_version():
+    load()
+    assert query.plan().year_keys == ["2000", "2001", "2002"]
+
+def test_execute_keeps_regions_and_fields():
+    load()
+    plan = query.plan(2000, 2000, ["Chile"], ["TFR", ""])
+    assert query.execute(plan) == [[{"Location": "Chile", "Time": "2000", "TFR": "2"}]]
+
+def test_empty_plan_makes_no_fetch(monkeypatch):
+    load()
+    monkeypatch.setattr(storage.get_client("data"), "mget", lambda *args: pytest.fail("fetched"))
+    plan = query.plan(1900, 1901)
+    assert plan.empty
+    assert query.execute(plan) == [None, None]
+
+def test_async_plan_matches_sync(redis_server):
+    client = fakeredis.FakeAsyncRedis(server=redis_server)
+    load()
+
+    async def run():
+        plan = await query.aplan(client, 2001, 2003, ["World"])
+        return plan.fetch, await query.aexecute(client, plan)
+
+    fetch, years_data = asyncio.run(run())
+    assert fetch == ["2001", "2002"]
+    assert years_data == query.execute(query.plan(2001, 2003, ["World"]))
+
+def test_plan_reads_the_partition_of_a_variant(redis_server):
+    client = fakeredis.FakeAsyncRedis(server=redis_server)
+    low = {"2000": [{"Location": "World", "Time": "2000", "TPopulation1Jan": "1", "Variant": "Low"}]}
+    dataset.apply_update({"2000": [], "2001": []}, None, {"WPP2024:Low": low}, "WPP2024:Medium")
+
+    plan = query.plan(2000, 2001, variant="low")
+    assert plan.partition == "WPP2024:Low" and plan.fetch == ["2000"]
+    assert query.execute(plan) == [low["2000"], None]
+    assert query.plan(2000, 2001).partition is None
+    with pytest.raises(ValueError):
+        query.plan(variant="High")
+
+    async def run():
+        plan = await query.aplan(client, 2000, 2000, variant="WPP2024:Low")
+        return await query.aexecute(client, plan)
+
+    dataset._partitions.clear()
+    assert asyncio.run(run()) == [low["2000"]]
@@ -0,0 +1,57 @@
+import fakeredis
+import pytest
+from hotqueue import HotQueue
+import jobs
+import retention
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch):
+    """Point jobs.py and retention.py at the same fake jobs, results and queue databases"""
+    jdb, resdb = fakeredis.FakeRedis(), fakeredis.FakeRedis()
+    for module in (jobs, retention):
+        monkeypatch.setattr(module, "jdb", jdb)
+        monkeypatch.setattr(module, "resdb", resdb)
+    monkeypatch.setattr(jobs, "q", HotQueue("queue", connection_pool=fakeredis.FakeRedis().connection_pool))
+
+def test_retention(monkeypatch):
+    monkeypatch.setattr(jobs, "RETENTION", {"complete": 100, "error": 10})
+    monkeypatch.setattr(jobs, "RETENTION_LARGE_BYTES", 1000)
+    monkeypatch.setattr(jobs, "RETENTION_LARGE", 50)
+    assert jobs.retention("complete") == 100
+    assert jobs.retention("complete", 2000) == 50
+    assert jobs.retention("error", 2000) == 10
+    assert jobs.retention("submitted") == 0
+
+def test_apply_retention(monkeypatch):
+    monkeypatch.setattr(jobs, "RETENTION", {"complete": 100})
+    job = jobs.add_job({"start": "2000", "end": "2001"})
+    jobs.resdb.hset(job["id"], mapping={"image": b"x" * 10, "thumb": b"y" * 5})
+    assert jobs.result_size(job["id"]) == 15
+    jobs.update_job_status(job["id"], "complete")
+    assert jobs.apply_retention(job["id"], "complete") == 100
+    assert 0 < jobs.jdb.ttl(job["id"]) <= 100 and 0 < jobs.resdb.ttl(job["id"]) <= 100
+    assert jobs.apply_retention(job["id"], "in progress") == 0
+
+def test_compact():
+    kept = jobs.add_job({"start": "2000", "end": "2001"})
+    gone = jobs.add_jobs([{"start": "2000", "end": "2001", "plot_type": "bar"}] * 2)
+    jobs.resdb.hset(kept["id"], "image", b"k")
+    for job in gone["jobs"]:
+        jobs.resdb.hset(job["id"], "image", b"x" * 100)
+        jobs.jdb.delete(job["id"]) # as if expired
+    jobs.resdb.hset(f"{retention.CHART_PREFIX}abc", "image", b"c")
+    jobs.resdb.hset(f"{retention.FRAME_PREFIX}abc", "image", b"f")
+
+    stats = retention.compact()
+    assert stats == {"results": 2, "index_entries": 2, "groups": 1, "bytes": 200}
+    assert sorted(jobs.resdb.keys()) == sorted([kept["id"].encode(), f"{retention.CHART_PREFIX}abc".encode(),
+                                                f"{retention.FRAME_PREFIX}abc".encode()])
+    assert jobs.list_jobs() == ([kept["id"]], None)
+    assert jobs.list_jobs(plot_type="bar") == ([], None)
+    assert retention.compact() == {"results": 0, "index_entries": 0, "groups": 0, "bytes": 0}
+
+def test_unlink_all():
+    for i in range(2500):
+        jobs.resdb.set(f"key{i}", i)
+    assert retention.unlink_all(jobs.resdb) == 2500
+    assert jobs.resdb.dbsize() == 0
@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+HEAVY = ("flask", "werkzeug", "pandas", "matplotlib", "sklearn", "pyarrow", "requests")
+
+def loaded(module):
+    code = f"import sys, {module}; print(' '.join(p for p in {HEAVY!r} if p in sys.modules))"
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, LOG_LEVEL="WARNING")
+    return subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, env=env, capture_output=True,
+                          text=True, check=True).stdout.split()
+
+def test_worker_loads_plotting_and_flask_on_demand():
+    assert loaded("worker") == []
+
+@pytest.mark.parametrize("module", ["api", "asgi"])
+def test_api_loads_ingest_dependencies_on_demand(module):
+    assert loaded(module) == ["flask", "werkzeug"]
@@ -0,0 +1,40 @@
+import fakeredis
+import storage
+
+def setup_function(function):
+    storage.reset()
+
+def teardown_function(function):
+    storage.reset()
+
+def test_clients_are_created_lazily_and_shared():
+    lazy = storage.LazyClient("jobs")
+    assert "jobs" not in storage._clients
+    assert "jobs" not in storage._pools
+
+    assert lazy.connection_pool is storage.get_pool("jobs")
+    assert storage.get_client("jobs") is storage.get_client("jobs")
+    assert storage.get_pool("jobs").connection_kwargs["db"] == 2
+
+def test_pool_configuration_from_environment(monkeypatch):
+    monkeypatch.setenv("REDIS_MAX_CONNECTIONS", "7")
+    monkeypatch.setenv("REDIS_SOCKET_TIMEOUT", "1.5")
+    monkeypatch.setenv("REDIS_SOCKET", "/tmp/redis.sock")
+    pool = storage.get_pool("results")
+    assert pool.max_connections == 7
+    assert pool.connection_kwargs["socket_timeout"] == 1.5
+    assert pool.connection_kwargs["path"] == "/tmp/redis.sock"
+    assert pool.connection_kwargs["db"] == 3
+
+def test_queue_client_uses_pool():
+    queue = storage.get_client("queue")
+    assert queue.name == storage.QUEUE_NAME
+    assert queue._HotQueue__redis.connection_pool is storage.get_pool("queue")
+    assert storage.get_pool("queue").connection_kwargs["socket_timeout"] is None
+
+def test_set_client_is_seen_by_lazy_clients():
+    fake = fakeredis.FakeRedis()
+    storage.set_client("data", fake)
+    lazy = storage.LazyClient("data")
+    lazy.set("1950", "[]")
+    assert fake.get("1950") == b"[]"
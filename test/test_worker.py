@@ -1,6 +1,14 @@
+import os
 import requests
+import signal
+import threading
 import time
 import logging
+import pytest
+import dataset
+import jobs
+import storage
+import worker
 
 API_URL = "http://worldpop.coe332.tacc.cloud"
 
@@ -31,3 +39,112 @@ def test_full_job_lifecycle():
             assert len(result_data["result"]) == payload["end"] - payload["start"] + 1 
             assert result_data["job"]["status"] == "complete"
             assert result_data["result"]["World"] is not None
+
+def test_render_pool_runs_jobs_in_warm_processes(tcp_redis_server):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": str(year)}]
+                          for year in (2000, 2001)})
+    ids = [jobs.add_job({"start": "2000", "end": "2001", "plot_type": "bar"})["id"] for _ in range(3)]
+    before = worker.job_run._values.get(("bar", "complete"), ([0], 0))[0][-1]
+
+    worker.RenderPool(2, recycle=1).run(timeout=1)
+
+    assert [jobs.get_job_by_id(jid)["status"] for jid in ids] == ["complete"] * 3
+    assert storage.get_client("results").hget(ids[0], "image_2001").startswith(b"\x89PNG")
+    assert worker.job_run._values[("bar", "complete")][0][-1] == before + 3
+
+def test_render_pool_survives_a_killed_process(tcp_redis_server):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": str(year)}]
+                          for year in range(1950, 2051)})
+    killed = jobs.add_job({"start": "1950", "end": "2050", "plot_type": "bar"})["id"]
+    pool = worker.RenderPool(1)
+    runner = threading.Thread(target=pool.run, kwargs={"timeout": 2})
+    runner.start()
+    deadline = time.monotonic() + 60
+    while jobs.get_job_by_id(killed)["status"] != "in progress" and time.monotonic() < deadline:
+        time.sleep(0.05)
+    os.kill(list(pool._busy)[0].process.pid, signal.SIGKILL) # e.g. by the OOM killer
+    after = jobs.add_job({"start": "2000", "end": "2001", "plot_type": "bar"})["id"]
+    runner.join(60)
+
+    assert not runner.is_alive()
+    assert jobs.get_job_by_id(killed)["status"] == "error"
+    assert jobs.get_job_by_id(after)["status"] == "complete"
+    assert jobs.queue_stats()["running"] == 0
+
+def test_cancelled_job_stops_between_frames(redis_server, monkeypatch):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": str(year)}]
+                          for year in range(2000, 2010)})
+    jid = jobs.add_job({"start": "2000", "end": "2009", "plot_type": "bar"})["id"]
+    assert storage.get_client("queue").get() == jid # a worker takes it
+    frames_saved = []
+    save_frame = worker.save_frame
+    def save_and_cancel(fig, jobid, field, *args):
+        files = save_frame(fig, jobid, field, *args)
+        frames_saved.append(field)
+        jobs.cancel_job(jobid) # the user cancels while the first frame renders
+        return files
+    monkeypatch.setattr(worker, "save_frame", save_and_cancel)
+
+    worker.process_job(jid)
+
+    assert frames_saved == ["image_2000"]
+    assert jobs.get_job_by_id(jid)["status"] == "cancelled"
+    assert not storage.get_client("results").exists(jid)
+    assert not jobs.is_cancelled(jid)
+
+def test_job_cancelled_as_it_completes_stays_cancelled(redis_server, monkeypatch):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": str(year)}]
+                          for year in (2000, 2001)})
+    jid = jobs.add_job({"start": "2000", "end": "2001", "plot_type": "bar"})["id"]
+    assert storage.get_client("queue").get() == jid
+    update_job_status = worker.update_job_status
+    def cancel_then_update(jobid, status):
+        if status == "complete":
+            jobs.cancel_job(jobid) # the user cancels after the last frame
+        update_job_status(jobid, status)
+    monkeypatch.setattr(worker, "update_job_status", cancel_then_update)
+
+    worker.process_job(jid)
+
+    assert jobs.get_job_by_id(jid)["status"] == "cancelled"
+    assert not storage.get_client("results").exists(jid)
+    assert 0 < storage.get_client("jobs").ttl(jid) <= jobs.RETENTION["cancelled"]
+
+def test_stopped_worker_requeues_its_job(redis_server, monkeypatch):
+    dataset.apply_update({str(year): [{"Location": "World", "Time": str(year), "TPopulation1Jan": str(year)}]
+                          for year in range(2000, 2005)})
+    jid = jobs.add_job({"start": "2000", "end": "2004", "plot_type": "bar"})["id"]
+    save_frame = worker.save_frame
+    def save_and_stop(*args):
+        files = save_frame(*args)
+        worker.stop() # SIGTERM while the first frame renders
+        return files
+    monkeypatch.setattr(worker, "save_frame", save_and_stop)
+
+    worker.serve(worker.update)
+
+    assert jobs.get_job_by_id(jid)["status"] == "submitted"
+    assert storage.get_client("queue").get() == jid # for another worker
+    assert jobs.queue_stats()["running"] == 0 and jobs.queue_stats()["backlog_cost"] == 5
+    assert not storage.get_client("results").exists(jid)
+
+def test_serve_exits_when_idle(redis_server):
+    start = time.monotonic()
+    worker.serve(worker.update, idle_exit=1)
+    assert time.monotonic() - start < 5
+
+def test_plot_data_plots_query2_over_the_default_query(redis_server, monkeypatch):
+    import frames
+    plotted = []
+    for plot_type, renderer in frames.RENDERERS.items():
+        def record(*args, renderer=renderer):
+            plotted.append(args[3:])
+            return renderer(*args)
+        monkeypatch.setitem(frames.RENDERERS, plot_type, record)
+    data = {"2000": {loc: [{"Location": loc, "Time": "2000", "TFR": str(i + 2), "TPopulation1Jan": str(i + 1)}]
+                     for i, loc in enumerate(("Chile", "World"))}}
+
+    worker.plot_data(data, "bar-job", 2000, 2000, "bar", ["World"], "TPopulation1Jan", "TFR")
+    worker.plot_data(data, "scatter-job", 2000, 2000, "scatter", ["Chile", "World"], "TPopulation1Jan", "TFR")
+
+    assert plotted == [("TFR", None), ("TPopulation1Jan", "TFR")]